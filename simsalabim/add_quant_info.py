@@ -2,15 +2,19 @@ from __future__ import print_function
 
 import sys
 import os
-import csv
-import copy
+import contextlib
 import re
+import warnings
+import zipfile
 
 import numpy as np
 
 from .simsalabim import __version__, __copyright__
 from . import helpers
-from .transform import MzMLTransformerMultiOut
+from .transform import MzMLTransformerMultiOut, PrecursorOverlay
+from .mzml_headers import iter_spectrum_headers
+from .feature_index import FeatureSweep
+from .mzml_encoding import add_encoding_arguments, get_encoding
 
 def main(argv):
   print('add-quant-info version %s\n%s' % (__version__, __copyright__))
@@ -18,7 +22,7 @@ def main(argv):
   
   args, params = parseArgs()
   
-  add_accurate_precursors(args.feature_fn, args.mzml_fn, args.output_fn, params)
+  add_accurate_precursors(args.feature_fn, args.mzml_fn, [] if args.map_only else args.output_fn, params)
 
 def parseArgs():
   import argparse
@@ -35,8 +39,9 @@ def parseArgs():
                      help='feature csv table from Dinosaur or OpenMS',
                      required = True)
   
-  apars.add_argument('--output_fn', default = "spectra.mzML", metavar='OUT', 
-                     help='''output file in ms2, mgf or mzML format (optional).
+  apars.add_argument('--output_fn', default = ["spectra.mzML"], metavar='OUT', nargs='+',
+                     help='''output file(s) in ms2, mgf or mzML format (optional). With several output files 
+                             all of them are written in a single pass over the mzML file.
                           ''')
   
   apars.add_argument('--split_precursors',
@@ -53,149 +58,271 @@ def parseArgs():
                      help='''tab separated file containing a mapping from spectra to precursor information.
                           ''')
   
+  apars.add_argument('--map_only',
+                     help='''only write the --map_fn file and no spectrum output. The spectra are read without 
+                             decoding their binary arrays, which is much faster.
+                          ''',
+                     action='store_true')
+  
+  apars.add_argument('--workers', default = 1, metavar='W', type=int,
+                     help='''number of processes used to parse the mzML file and decode its binary arrays. 
+                             Requires an uncompressed, indexed mzML file.
+                          ''')
+  
+  apars.add_argument('--mzml_writer', default = "psims", metavar='W', choices=["psims", "fast"],
+                     help='''writer for mzML output: psims or fast, a templated writer that is considerably faster 
+                             and also writes the offset index and the file checksum.
+                          ''')
+  
+  apars.add_argument('--no_feature_cache',
+                     help='''do not read or write the cached feature table (<feature_fn>.cache.npz).
+                          ''',
+                     action='store_true')
+  
+  add_encoding_arguments(apars)
+  
   # ------------------------------------------------
   args = apars.parse_args()
   
   params = dict()
   params['specPrecMapFile'] = args.map_fn
-  params['splitPrecursors'] = args.split_precursors or args.mzml_fn.lower().endswith(".mgf")
+  params['workers'] = args.workers
+  params['mzmlWriter'] = args.mzml_writer
+  params['mzmlEncoding'] = get_encoding(args)
+  params['featureCache'] = not args.no_feature_cache
+  params['splitPrecursors'] = args.split_precursors
+  
+  if args.map_only and len(args.map_fn) == 0:
+    sys.exit("ERROR: --map_only requires a --map_fn output file")
   
   return args, params
   
+FEATURE_DTYPE = np.dtype([('mz', np.float64), ('charge', np.int32), ('rt_left', np.float64), ('rt_right', np.float64), ('rt', np.float64), ('intensity', np.float64)])
+
+# the features in the order of their left RT border, mz_rank is their position when sorted by m/z
+SWEEP_DTYPE = np.dtype(FEATURE_DTYPE.descr + [('mz_rank', np.int64)])
+
+FEATURE_CACHE_VERSION = 2
+FEATURE_CACHE_SUFFIX = ".cache.npz"
+FEATURE_CHUNK_SIZE = 65536
+
 def load_feature_table(fn):
-  table = []
+  # OpenMS TextExporter: FEATURE,rt,mz,intensity,charge,width,quality,rt_quality,mz_quality,rt_start,rt_end
   with helpers.openVersionSafe(fn, 'r') as fh:
-    rd = csv.reader(fh, delimiter=',')
-    for row in rd:
-      if row[0] == 'FEATURE':
-        _, rt, mz, _, chg, _, _, _, _, rtl, rtr = row
-        table.append([float(mz), int(chg), float(rtl), float(rtr), float(rt)])
-  table.sort(key=lambda x: x[3])
-  return table
+    lines = [line for line in fh if line.startswith("FEATURE,")]
+  columns = load_columns(lines, ',', (1, 2, 3, 4, 9, 10), ['rt', 'mz', 'intensity', 'charge', 'rt_left', 'rt_right'])
+  return to_sorted_features(columns)
 
 def load_dinosaur_table(fn, minCharge=1):
-  table = []
   with helpers.openVersionSafe(fn, 'r') as fh:
-    rd = csv.reader(fh, delimiter='\t')
-    for row in rd:
-      if row[0] != 'mz':
-        mz, _, chg, rtl, rt, rtr, _, _, _, _, _, _, int_apex, int_sum = row
-        z = int(chg)
-        if z >= minCharge:
-          table.append([float(mz), z, float(rtl)*60, float(rtr)*60, float(rt)*60, float(int_sum)])
-  table.sort(key=lambda x: x[3])
-  return table
+    columns = load_columns(fh, '\t', (0, 2, 3, 4, 5, 13), ['mz', 'charge', 'rt_left', 'rt', 'rt_right', 'intensity'], skiprows = 1)
+  columns = columns[columns['charge'] >= minCharge]
+  for column in ['rt_left', 'rt', 'rt_right']:
+    columns[column] *= 60
+  return to_sorted_features(columns)
 
-def add_accurate_precursors(feature_fn, mzml_fn, ms2_outpath, params):
+def load_columns(lines, delimiter, usecols, names, skiprows=0):
+  dtype = [(name, FEATURE_DTYPE[name]) for name in names]
+  with warnings.catch_warnings():
+    # tables without features
+    warnings.simplefilter("ignore", UserWarning)
+    return np.loadtxt(lines, delimiter = delimiter, usecols = usecols, dtype = dtype, skiprows = skiprows, ndmin = 1)
+
+def to_sorted_features(columns):
+  """Sorts by m/z, with ties in the order of the right RT border and then the file order"""
+  features = np.empty(len(columns), dtype=FEATURE_DTYPE)
+  for name in FEATURE_DTYPE.names:
+    features[name] = columns[name]
+  return features[np.lexsort((features['rt_right'], features['mz']))]
+
+def to_sweep_order(features):
+  """Sorts features that are sorted by m/z by their left RT border"""
+  swept = np.empty(len(features), dtype=SWEEP_DTYPE)
+  for name in FEATURE_DTYPE.names:
+    swept[name] = features[name]
+  swept['mz_rank'] = np.arange(len(features))
+  return swept[np.argsort(features['rt_left'], kind='stable')]
+
+def read_feature_table(feature_fn):
   if feature_fn[-13:] == ".features.tsv" or feature_fn[-13:] == ".features.csv":
-    features = load_dinosaur_table(feature_fn)
+    return load_dinosaur_table(feature_fn)
   else:
-    features = load_feature_table(feature_fn)
-  features.sort(key=lambda x: x[0])
-  fmz_all = np.array([f[0] for f in features])
+    return load_feature_table(feature_fn)
 
-  if ms2_outpath and not ms2_outpath.endswith(".dummy.txt") and not (ms2_outpath.lower().endswith(".ms2") or ms2_outpath.lower().endswith(".mzml") or ms2_outpath.lower().endswith(".mgf")):
-    sys.exit("ERROR: Could not detect output format from filename. Please use the extension .mzML, .ms2 or .mgf for your output file")  
+def get_feature_reader(feature_fn, useCache=True):
+  """Returns a function that opens an iterator over chunks of the features in SWEEP_DTYPE, sorted by their left 
+  RT border. With the cache, the chunks are read from the cache file while the sweep line advances, so only 
+  the currently eluting features are kept in memory. Writing the cache, or reading without it, loads the 
+  whole feature table once. The cache is reused as long as the feature file's hash does not change."""
+  cache_file = feature_fn + FEATURE_CACHE_SUFFIX
+  if useCache:
+    source_hash = helpers.getFileHash(feature_fn)
+    if is_valid_cache(cache_file, source_hash):
+      return lambda: iter_cached_chunks(cache_file)
   
-  transformSpectra(features, fmz_all, mzml_fn, ms2_outpath, params)
-      
-def transformSpectra(features, fmz_all, mzml_fn, ms2_outpath, params):
-  transform = replace_precursors_multi_out if params['splitPrecursors'] else replace_precursors
-  if len(params['specPrecMapFile']) > 0:
-    specPrecMapWriter = helpers.openVersionSafe(params['specPrecMapFile'], 'w')
-    specPrecMapWriter.write('FileName\tScanNr\tPrecMz\tCharge\tRTime\tIntensity\n')
+  features = to_sweep_order(read_feature_table(feature_fn))
+  if useCache:
+    try:
+      tmp_file = cache_file + ".tmp"
+      with open(tmp_file, 'wb') as f:
+        np.savez(f, features = features, source_hash = source_hash, version = FEATURE_CACHE_VERSION)
+      os.replace(tmp_file, cache_file)
+      return lambda: iter_cached_chunks(cache_file)
+    except OSError:
+      print("WARNING: Could not write feature cache %s" % cache_file)
+  return lambda: iter_chunks(features)
+
+def load_features(feature_fn, useCache=True):
+  """Returns all features sorted by m/z in FEATURE_DTYPE"""
+  features = np.concatenate(list(get_feature_reader(feature_fn, useCache)()))
+  return features[np.argsort(features['mz_rank'])][list(FEATURE_DTYPE.names)].astype(FEATURE_DTYPE)
+
+def is_valid_cache(cache_file, source_hash):
+  if not os.path.isfile(cache_file):
+    return False
+  try:
+    with np.load(cache_file) as cache:
+      if int(cache['version']) != FEATURE_CACHE_VERSION or str(cache['source_hash']) != source_hash:
+        return False
+    _, dtype = read_cache_header(cache_file)
+    return dtype == SWEEP_DTYPE
+  except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+    return False
+
+def read_cache_header(cache_file):
+  with zipfile.ZipFile(cache_file) as z, z.open("features.npy") as f:
+    return read_array_header(f)
+
+def read_array_header(f):
+  version = np.lib.format.read_magic(f)
+  if version == (1, 0):
+    shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+  elif version == (2, 0):
+    shape, _, dtype = np.lib.format.read_array_header_2_0(f)
   else:
-    specPrecMapWriter = None
+    raise ValueError("Unsupported .npy format version %s" % (version, ))
+  return shape[0], dtype
+
+def iter_cached_chunks(cache_file, chunkSize=FEATURE_CHUNK_SIZE):
+  """Reads the features from the uncompressed cache in chunks, without loading the whole array"""
+  with zipfile.ZipFile(cache_file) as z, z.open("features.npy") as f:
+    remaining, dtype = read_array_header(f)
+    while True:
+      n = min(chunkSize, remaining)
+      yield np.frombuffer(f.read(n * dtype.itemsize), dtype=dtype)
+      remaining -= n
+      if remaining == 0:
+        return
+
+def iter_chunks(features, chunkSize=FEATURE_CHUNK_SIZE):
+  # at least one, possibly empty, chunk
+  for start in range(0, max(len(features), 1), chunkSize):
+    yield features[start:start + chunkSize]
+
+def add_accurate_precursors(feature_fn, mzml_fn, ms2_outpath, params):
+  # the spectra of an mzML file are sorted by RT, so the features are read in RT order as the spectra pass by
+  featureIndex = FeatureSweep(get_feature_reader(feature_fn, params.get('featureCache', True)))
+
+  outputFiles = [ms2_outpath] if isinstance(ms2_outpath, str) else ms2_outpath
+  for outputFile in outputFiles:
+    if outputFile and not outputFile.endswith(".dummy.txt") and getOutputFormat(outputFile) not in (".ms2", ".mzml", ".mgf"):
+      sys.exit("ERROR: Could not detect output format from filename. Please use the extension .mzML, .ms2 or .mgf for your output file")  
   
+  # MGF does not support multiple precursors per spectrum, set here so that every caller gets the same output
+  if any(outputFile and getOutputFormat(outputFile) == ".mgf" for outputFile in outputFiles):
+    params = dict(params, splitPrecursors = True)
+  
+  transformSpectra(featureIndex, mzml_fn, outputFiles, params)
+
+def getOutputFormat(outputFile):
+  return helpers.getExt(helpers.stripCompressionExt(outputFile)).lower()
+      
+def transformSpectra(featureIndex, mzml_fn, outputFiles, params):
+  transform = replace_precursors_multi_out if params['splitPrecursors'] else replace_precursors
   mzml_fn_base = os.path.basename(mzml_fn)
   
-  writeMode = 'w'
-  if ms2_outpath.lower().endswith(".mzml"):
-    writeMode = 'wb'
-  
-  with helpers.openVersionSafe(ms2_outpath, writeMode) as out:
-    trans = MzMLTransformerMultiOut(mzml_fn, out, transform = lambda x : transform(x, features, fmz_all, specPrecMapWriter, mzml_fn_base), transform_description = "Assigned accurate precursor information from Dinosaur")
-    if ms2_outpath.lower().endswith(".mzml"):
-      trans.write()
-    elif ms2_outpath.lower().endswith(".ms2"):
-      trans.write_ms2()
-    elif ms2_outpath.lower().endswith(".mgf"):
-      trans.write_mgf()
+  with contextlib.ExitStack() as stack:
+    if len(params['specPrecMapFile']) > 0:
+      specPrecMapWriter = stack.enter_context(helpers.openVersionSafe(params['specPrecMapFile'], 'w'))
+      specPrecMapWriter.write('FileName\tScanNr\tPrecMz\tCharge\tRTime\tIntensity\n')
     else:
-      trans.transform_only()
+      specPrecMapWriter = None
+    
+    # .dummy.txt outputs are not written, they only trigger the transformation
+    outputFiles = [f for f in outputFiles if f and not f.endswith(".dummy.txt")]
+    if len(outputFiles) == 0:
+      # only the precursor map is written, the spectra are read without their binary arrays
+      for i, spectrum in enumerate(iter_spectrum_headers(mzml_fn)):
+        transform(spectrum, featureIndex, specPrecMapWriter, mzml_fn_base)
+        if i % 1000 == 0:
+          print("Handled %d spectra" % (i, ))
+    else:
+      outputs = list()
+      for outputFile in outputFiles:
+        writeMode = 'wb' if getOutputFormat(outputFile) == ".mzml" else 'w'
+        outputs.append((getOutputFormat(outputFile), stack.enter_context(helpers.openVersionSafe(outputFile, writeMode))))
+      
+      # the fast mzML writer needs the number of output spectra up front, the assignment is run once on the headers to count them
+      numSpectra = None
+      if params.get('mzmlWriter') == "fast" and any(f == ".mzml" for f, _ in outputs):
+        numSpectra = sum(len(transform(spectrum, featureIndex, None, mzml_fn_base)) for spectrum in iter_spectrum_headers(mzml_fn))
+        featureIndex.reset()
+      
+      # the transformer's own output stream is used for mzML output
+      out = next((o for f, o in outputs if f == ".mzml"), outputs[0][1])
+      trans = MzMLTransformerMultiOut(mzml_fn, out, transform = lambda x : transform(x, featureIndex, specPrecMapWriter, mzml_fn_base), transform_description = "Assigned accurate precursor information from Dinosaur", workers = params.get('workers', 1), mzml_writer = params.get('mzmlWriter', "psims"), array_encoding = params.get('mzmlEncoding'), num_spectra = numSpectra)
+      trans.write_multi(outputs)
   
   print("Done")
 
   
-def replace_precursors(spectrum, features, fmz_all, specPrecMapWriter, mzml_fn_base):
+def replace_precursors(spectrum, featureIndex, specPrecMapWriter, mzml_fn_base):
   if spectrum["ms level"] == 2:
     rt = get_rtime(spectrum)
     precursors = spectrum.get("precursorList", {}).get("precursor")
-    returnSpectrum = False
+    new_precursors = list()
     if precursors:
-      new_precursors = list()
-      for prec in precursors:
+      for precIdx, prec in enumerate(precursors):
         pmz, iso_width_lower, iso_width_upper = get_isolation_window(prec)
-        candidates = get_candidate_precursors(features, fmz_all, pmz, iso_width_lower, iso_width_upper, rt)
-        if len(candidates) > 0:
-          returnSpectrum = True
-          for f in candidates:
-            prec_copy = update_precursor(prec, f)
-            new_precursors.append(prec_copy)
-            
-            writeSpecPrecRow(specPrecMapWriter, spectrum["id"], f, mzml_fn_base)
+        candidates = get_candidates(featureIndex, pmz, iso_width_lower, iso_width_upper, rt)
+        for f in candidates:
+          new_precursors.append(get_selected_ion(precIdx, f))
           
-          spectrum["precursorList"]["precursor"] = new_precursors
+          writeSpecPrecRow(specPrecMapWriter, spectrum["id"], f, mzml_fn_base)
     
-    if returnSpectrum:
-      return [spectrum]
+    if len(new_precursors) > 0:
+      return [PrecursorOverlay(spectrum, spectrum["id"], new_precursors)]
     else:
       return []
   else:
     return [spectrum]
 
-def replace_precursors_multi_out(spectrum, features, fmz_all, specPrecMapWriter, mzml_fn_base):
+def replace_precursors_multi_out(spectrum, featureIndex, specPrecMapWriter, mzml_fn_base):
   if spectrum["ms level"] == 2:
     rt = get_rtime(spectrum)
     precursors = spectrum.get("precursorList", {}).get("precursor")
     if precursors:
       spectra = list()
-      for prec in precursors:
+      originalScanNr = helpers.getScanNr(spectrum["id"])
+      for precIdx, prec in enumerate(precursors):
         pmz, iso_width_lower, iso_width_upper = get_isolation_window(prec)
-        candidates = get_candidate_precursors(features, fmz_all, pmz, iso_width_lower, iso_width_upper, rt)
-        if len(candidates) > 0:
-          for precIdx, f in enumerate(candidates[:99]):
-            fmz, fz, frt_left, frt_right, frt, fint = f
-            spectrum_copy = spectrum.copy()
-            spectrum_copy["precursorList"] = spectrum["precursorList"].copy()
-            
-            originalScanNr = helpers.getScanNr(spectrum_copy["id"])
-            newScanNr = originalScanNr*100+precIdx+1
-            spectrum_copy["id"] = replaceScanNr(spectrum_copy["id"], str(newScanNr) + " originalScan=" + str(originalScanNr))
-            #spectrum_copy["id"] += " precursorIdx=" + str(precIdx+1)
-            prec_copy = update_precursor(prec, f)
-            spectrum_copy["precursorList"]["precursor"] = [prec_copy]
-            spectra.append(spectrum_copy)
-            
-            writeSpecPrecRow(specPrecMapWriter, spectrum_copy["id"], f, mzml_fn_base)
+        candidates = get_candidates(featureIndex, pmz, iso_width_lower, iso_width_upper, rt)
+        for candidateIdx, f in enumerate(candidates[:99]):
+          newScanNr = originalScanNr*100+candidateIdx+1
+          specId = replaceScanNr(spectrum["id"], str(newScanNr) + " originalScan=" + str(originalScanNr))
+          #specId += " precursorIdx=" + str(candidateIdx+1)
+          spectra.append(PrecursorOverlay(spectrum, specId, [get_selected_ion(precIdx, f)]))
+          
+          writeSpecPrecRow(specPrecMapWriter, specId, f, mzml_fn_base)
       return spectra
     else:
       return []
   else:
     return [spectrum]
 
-def update_precursor(prec, new_prec_info):
+def get_selected_ion(precIdx, new_prec_info):
   fmz, fz, _, _, _, fint = new_prec_info
-  prec_copy = copy.deepcopy(prec)
-  ion = prec_copy['selectedIonList'].get("selectedIon")[0]
-  for key, value in list(ion.items()):
-    if key == "selected ion m/z":
-      ion[key] = fmz
-    elif key == "peak intensity":
-      ion[key] = fint
-    elif key in ("charge state", "possible charge state"):
-      ion[key] = fz
-  return prec_copy
+  return (precIdx, fmz, fz, fint)
   
 def get_isolation_window(prec):
   ion = prec['selectedIonList'].get("selectedIon")[0]
@@ -223,15 +350,9 @@ def get_rtime(spectrum):
   
   return rtime * timescale
 
-def get_candidate_precursors(features, fmz_all, pmz, iso_width_lower, iso_width_upper, rt):
-  l_idx = fmz_all.searchsorted(pmz - iso_width_lower, side='left')
-  r_idx = fmz_all.searchsorted(pmz + iso_width_upper, side='right')
-  candidates = list()
-  for f in features[l_idx:r_idx]:
-    fmz, fz, frt_left, frt_right, frt, fint = f
-    if frt_left < rt < frt_right:
-      candidates.append(f)
-  return candidates
+def get_candidates(featureIndex, pmz, iso_width_lower, iso_width_upper, rt):
+  # features in m/z order, as tuples of Python scalars
+  return featureIndex.query(pmz - iso_width_lower, pmz + iso_width_upper, rt)[list(FEATURE_DTYPE.names)].tolist()
 
 def replaceScanNr(specId, newScanNr):
   return re.sub(r'scan=([0-9]*)', 'scan=%s' % newScanNr, specId)
@@ -9,9 +9,16 @@
 import sys
 import os
 
-from .spectrum import Spectrum
+from .spectrum import Spectrum, peaks_from_text
 from .precursor import Precursor
 from . import helpers
+from . import spectrum_index
+from . import block_reader
+from . import parallel_parser
+
+
+APL_RECORD_START = b'peaklist start'
+APL_RECORD_END = b'peaklist end'
 
 
 def parseAplHeaders(inputFile):
@@ -22,34 +29,85 @@ def parseAplHeaders(inputFile):
             else:
                 break
 
-def parse_apl(inputFile, storeFragmentIons = False):
+def parse_apl(inputFile, storeFragmentIons = False, reader = "lines", workers = 1, spectrumFilter = None):
     if not os.path.isfile(inputFile):
         sys.exit("ERROR: Could not open apl file: " + inputFile)
     
-    if not inputFile.lower().endswith(".apl"):
+    if not helpers.stripCompressionExt(inputFile).lower().endswith(".apl"):
         sys.exit("ERROR: File does not have the .apl file extension: " + inputFile)
     
+    check_apl_spectrum_filter(spectrumFilter)
+    
+    # with an up to date sidecar index, records rejected by the filter are not even read
+    index = spectrum_index.load_existing_index(inputFile, parse_apl_header, APL_RECORD_END) if spectrumFilter and spectrumFilter.uses_index() else None
+    if index:
+        yield from index.iter_filtered(spectrumFilter, storeFragmentIons)
+    elif workers > 1 and not helpers.getCompression(inputFile):
+        yield from parallel_parser.parse_parallel(inputFile, APL_RECORD_START, parse_apl_header, storeFragmentIons, APL_RECORD_END, workers, spectrumFilter = spectrumFilter)
+    elif reader == "lines":
+        with helpers.openVersionSafe(inputFile, 'r') as f:
+            yield from parse_apl_lines(f, storeFragmentIons, spectrumFilter)
+    else:
+        records = block_reader.iter_records(inputFile, APL_RECORD_START, useMmap = (reader == "mmap"))
+        yield from block_reader.parse_records(records, parse_apl_header, storeFragmentIons, APL_RECORD_END, spectrumFilter)
+
+def check_apl_spectrum_filter(spectrumFilter):
+    # apl headers carry no retention times, a retention time filter would reject every spectrum
+    if spectrumFilter and spectrumFilter.has_rtime_range():
+        sys.exit("ERROR: Retention time filters are not supported for .apl input, apl files do not store retention times")
+
+def parse_apl_lines(lines, storeFragmentIons = False, spectrumFilter = None):
+    # peak lines are only collected here and converted in one batch per spectrum
+    headerLines, peakLines = list(), list()
+    for line in lines:
+        if line[:1].isdigit():
+            if storeFragmentIons:
+                peakLines.append(line)
+        elif line.startswith('peaklist start'):
+            headerLines, peakLines = list(), list()
+        elif line.startswith('peaklist end'):
+            header = parse_apl_header(headerLines)
+            if header:
+                scannr, raw_file, rtime, precursors = header
+                if spectrumFilter and not spectrumFilter.accepts(scannr, rtime, precursors):
+                    continue
+                fragmentIons = peaks_from_text("".join(peakLines)) if storeFragmentIons else None
+                yield Spectrum(scannr, precursors, fragmentIons, raw_file)
+        else:
+            headerLines.append(line)
+
+def parse_apl_header(headerLines):
     scannr = -1
     rtime = 0.0
-    fragmentIons = list() if storeFragmentIons else None
-    with open(inputFile, 'r') as f:
-        for line in f:
-            if line.startswith('peaklist start'):
-                fragmentIons = list() if storeFragmentIons else None
-            elif line.startswith('header'):
-                header = line.split('=')[1]
-                scannr = int(header.split("Index: ")[1].split()[0]) # e.g. header=RawFile: 01308_D03_P013387_B00_N20_R1 Index: 55569 Precursor: 0 _multi_
-                raw_file = header.split("RawFile: ")[1].split()[0]
-            elif line.startswith('mz'):
-                fields = line.split('=')[1].split()
-                pepmass = float(fields[0])
-                intensity = None if len(fields) <= 1 else float(fields[1])
-            elif line.startswith('charge'):
-                charge = int(line.split('=')[1][0])
-            elif line[0].isdigit():
-                fragmentIons.append(map(float, line.split()))
-            elif line.startswith('peaklist end'):
-                if scannr != -1:
-                    pepmz = helpers.precMzFromPrecMass(pepmass, charge)
-                    yield Spectrum(scannr, [{'mz': pepmz, 'charge': charge, 'intensity': intensity}], fragmentIons, raw_file)
+    for line in headerLines:
+        if line.startswith('header'):
+            header = line.split('=')[1]
+            scannr = int(header.split("Index: ")[1].split()[0]) # e.g. header=RawFile: 01308_D03_P013387_B00_N20_R1 Index: 55569 Precursor: 0 _multi_
+            raw_file = header.split("RawFile: ")[1].split()[0]
+        elif line.startswith('mz'):
+            fields = line.split('=')[1].split()
+            pepmass = float(fields[0])
+            intensity = None if len(fields) <= 1 else float(fields[1])
+        elif line.startswith('charge'):
+            charge = int(line.split('=')[1][0])
+    
+    if scannr == -1:
+        return None
+    
+    pepmz = helpers.precMzFromPrecMass(pepmass, charge)
+    return scannr, raw_file, None, [Precursor(rtime, pepmz, charge, intensity)]
+
+def parse_apl_metadata(inputFile, reader = "mmap"):
+    # peak blocks are skipped without decoding, only their lines are counted
+    records = block_reader.iter_records(inputFile, APL_RECORD_START, useMmap = (reader == "mmap"))
+    yield from block_reader.parse_record_headers(records, parse_apl_header, APL_RECORD_END)
+
+def load_apl_index(inputFile):
+    return spectrum_index.load_index(inputFile, APL_RECORD_START, parse_apl_header, APL_RECORD_END)
+
+def get_by_scan(inputFile, scannr, raw_file = None, storeFragmentIons = True):
+    return next(iter_scans(inputFile, [scannr], raw_file, storeFragmentIons), None)
 
+def iter_scans(inputFile, scannrs, raw_file = None, storeFragmentIons = True):
+    # seeks directly to the requested records using the sidecar index
+    yield from load_apl_index(inputFile).iter_scans(scannrs, raw_file, storeFragmentIons)
@@ -1,19 +1,37 @@
 import sys
+import io
+import collections
 from pathlib import Path
 
 from . import helpers
+from .spectrum import peaks_to_text
 
 
 class AplWriter:
     def __init__(self, output_stream):
-        self.apl_writer = output_stream
+        self.apl_writer = helpers.BufferedTextWriter(output_stream)
     
     def write(self, spectra):
+        self.start()
         for i, spectrum in enumerate(spectra):
-            if spectrum.get_ms_level() == 2:
-                self.write_apl_spectrum(**spectrum.spectrum, raw_file=spectrum.raw_file)
+            self.write_spectrum(spectrum)
             if i % 1000 == 0:
                 print("Handled %d spectra" % (i, ))
+        self.finish()
+    
+    def start(self):
+        pass
+    
+    def write_spectrum(self, spectrum):
+        if spectrum.ms_level == 2:
+            self.write_apl_spectrum(**spectrum.spectrum, raw_file=spectrum.raw_file)
+    
+    def finish(self):
+        self.flush()
+    
+    def flush(self):
+        """Writes out the buffered spectra, needed after calling write_apl_spectrum directly"""
+        self.apl_writer.flush()
 
     def write_apl_spectrum(self, mz_array=None, intensity_array=None, charge_array=None, id=None,
              polarity='positive scan', centroided=True, precursor_information=None,
@@ -36,24 +54,89 @@ class AplWriter:
             self.apl_writer.write("mz=%f\n" % (p['mz']))
             self.apl_writer.write("charge=%d+\n" % (p['charge']))
             
-            for a, b in zip(mz_array, intensity_array):
-                self.apl_writer.write("%f %f\n" % (a, b))
-            
+            self.apl_writer.write(peaks_to_text(mz_array, intensity_array))
             self.apl_writer.write("peaklist end\n\n")
 
 
 class AplWriterMultiFile:
-    def __init__(self, output_dir):
+    """Writes the spectra of each raw file to <output_dir>/<raw_file>.apl.
+
+    Spectra are buffered in memory per raw file and written out in large batches once 
+    bufferSize characters are buffered in total. At most maxOpenFiles output files are 
+    open at the same time, the least recently used one is closed when another file is 
+    needed and files that are opened again are appended to.
+    """
+    def __init__(self, output_dir, compression=None, maxOpenFiles=64, bufferSize=64 * 1024 * 1024):
         self.output_dir = Path(output_dir)
-        self.apl_writers = dict()
+        self.compression = compression or ""
+        self.maxOpenFiles = max(1, maxOpenFiles)
+        self.bufferSize = bufferSize
+        self.buffers = dict()
+        self.buffered_size = 0
+        self.open_files = collections.OrderedDict()
+        self.created_files = set()
+        self.formatted = io.StringIO()
+        self.formatter = AplWriter(self.formatted)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
     
     def write(self, spectra):
+        self.start()
         for i, spectrum in enumerate(spectra):
-            if spectrum.get_ms_level() == 2:
-                if spectrum.raw_file not in self.apl_writers:
-                    output_file = self.output_dir / Path(spectrum.raw_file + ".apl")
-                    output_stream = open(output_file, 'w')
-                    self.apl_writers[spectrum.raw_file] = AplWriter(output_stream)
-                self.apl_writers[spectrum.raw_file].write_apl_spectrum(**spectrum.spectrum)
+            self.write_spectrum(spectrum)
             if i % 1000 == 0:
                 print("Handled %d spectra" % (i, ))
+        self.finish()
+    
+    def start(self):
+        pass
+    
+    def write_spectrum(self, spectrum):
+        if spectrum.ms_level == 2:
+            self.formatter.write_spectrum(spectrum)
+            self.formatter.flush()
+            text = self.formatted.getvalue()
+            self.formatted.seek(0)
+            self.formatted.truncate()
+            
+            self.buffers.setdefault(spectrum.raw_file, list()).append(text)
+            self.buffered_size += len(text)
+            if self.buffered_size >= self.bufferSize:
+                self.flush()
+    
+    def finish(self):
+        self.close()
+    
+    def flush(self):
+        # sorted, so that files are written in the same order on every run
+        for raw_file in sorted(self.buffers.keys()):
+            self.get_output_stream(raw_file).write("".join(self.buffers[raw_file]))
+        self.buffers = dict()
+        self.buffered_size = 0
+    
+    def close(self):
+        """Writes out all buffered spectra and closes all output files, compressed outputs are only complete after closing"""
+        self.flush()
+        while self.open_files:
+            _, output_stream = self.open_files.popitem(last=False)
+            output_stream.close()
+    
+    def get_output_stream(self, raw_file):
+        if raw_file in self.open_files:
+            self.open_files.move_to_end(raw_file)
+            return self.open_files[raw_file]
+        
+        if len(self.open_files) >= self.maxOpenFiles:
+            _, output_stream = self.open_files.popitem(last=False)
+            output_stream.close()
+        
+        # files from previous runs are overwritten, files that were closed by the pool are appended to
+        output_file = str(self.output_dir / Path(raw_file + ".apl" + self.compression))
+        output_stream = helpers.openVersionSafe(output_file, 'a' if raw_file in self.created_files else 'w')
+        self.created_files.add(raw_file)
+        self.open_files[raw_file] = output_stream
+        return output_stream
@@ -0,0 +1,208 @@
+import sys
+import os
+import io
+import glob
+import time
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from .simsalabim import __version__, __copyright__
+
+from .convert import convert
+from .spectrum_store import STORE_EXT
+from .mzml_encoding import add_encoding_arguments, get_encoding
+from .result_cache import TMP_PREFIX, get_tmp_file, replace_file, remove_file
+from . import helpers
+
+
+INPUT_FORMATS = (".mzml", ".ms2", ".mgf", ".apl", STORE_EXT)
+
+
+def main(argv):
+    print('simsalabim-batch-convert version %s\n%s' % (__version__, __copyright__))
+    print('Issued command:', os.path.basename(__file__) + " " + " ".join(map(str, sys.argv[1:])))
+
+    args, params = parseArgs()
+
+    results = batch_convert(args.inputs, args.output_dir, args.output_format, params)
+    failed = [r for r in results if r['status'] == "failed"]
+    if failed:
+        sys.exit("ERROR: %d of %d files could not be converted" % (len(failed), len(results)))
+
+
+def parseArgs():
+    import argparse
+    apars = argparse.ArgumentParser(
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    apars.add_argument('inputs', nargs='+', metavar = "IN",
+                                         help='''input files, directories or glob patterns, e.g. "raw/*.apl.gz". Directories are searched
+                                                         for ms2, mgf, apl, mzML and .spectra inputs, optionally compressed.
+                                                    ''')
+
+    apars.add_argument('--output_dir', default = "./converted", metavar='OUT',
+                                         help='''output directory.
+                                                    ''')
+
+    apars.add_argument('--output_format', default = [".mzML"], metavar='F', nargs='+',
+                                         help='''output format(s), e.g. .mzML or .mgf.gz. With several formats each input is parsed only once.
+                                                    ''')
+
+    apars.add_argument('--jobs', default = 1, metavar='J', type=int,
+                                         help='''number of files that are converted in parallel.
+                                                    ''')
+
+    apars.add_argument('--force',
+                                         help='''convert all inputs, also if the outputs are up to date.
+                                                    ''',
+                                         action='store_true')
+
+    apars.add_argument('--reader', default = "mmap", metavar='R', choices=["lines", "mmap", "blocks"],
+                                         help='''how apl, mgf and ms2 files are read, see simsalabim.convert.
+                                                    ''')
+
+    apars.add_argument('--split_precursors',
+                                         help='''create a new spectrum for each precursor, see simsalabim.convert.
+                                                    ''',
+                                         action='store_true')
+
+    apars.add_argument('--mzml_writer', default = "psims", metavar='W', choices=["psims", "fast"],
+                                         help='''writer for mzML output: psims or fast.
+                                                    ''')
+
+    add_encoding_arguments(apars)
+
+    # ------------------------------------------------
+    args = apars.parse_args()
+
+    params = dict()
+    params['specPrecMapFile'] = ""
+    params['reader'] = args.reader
+    params['workers'] = 1
+    params['force'] = args.force
+    params['jobs'] = args.jobs
+    params['mzmlWriter'] = args.mzml_writer
+    params['mzmlEncoding'] = get_encoding(args)
+    params['splitPrecursors'] = args.split_precursors or any(helpers.stripCompressionExt(f).lower().endswith(".mgf") for f in args.output_format)
+
+    return args, params
+
+
+def batch_convert(inputs, output_dir, output_formats, params):
+    """Converts all input files, skipping those with up to date outputs, and returns a result dict per input file"""
+    helpers.createDir(output_dir)
+    input_files = find_input_files(inputs)
+    if not input_files:
+        sys.exit("ERROR: No input files found in %s" % " ".join(inputs))
+
+    producers = dict()
+    for input_file in input_files:
+        for output_file in get_output_files(input_file, output_dir, output_formats):
+            if output_file in producers:
+                sys.exit("ERROR: %s and %s would both be converted to %s" % (producers[output_file], input_file, output_file))
+            producers[output_file] = input_file
+
+    start = time.perf_counter()
+    results, tasks = list(), list()
+    for input_file in input_files:
+        output_files = get_output_files(input_file, output_dir, output_formats)
+        if not params.get('force') and is_up_to_date(input_file, output_files):
+            print("Skipping %s, outputs are up to date" % input_file)
+            results.append({'input_file': input_file, 'status': "skipped"})
+        else:
+            tasks.append((input_file, output_files))
+
+    jobs = max(1, params.get('jobs', 1))
+    if jobs == 1:
+        for input_file, output_files in tasks:
+            results.append(report_result(convert_file(input_file, output_files, params)))
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(convert_file, input_file, output_files, params) for input_file, output_files in tasks]
+            for future in as_completed(futures):
+                results.append(report_result(future.result()))
+
+    print_summary(results, time.perf_counter() - start)
+    return results
+
+
+def find_input_files(inputs):
+    input_files = list()
+    for pattern in inputs:
+        if os.path.isdir(pattern) and not is_input_file(pattern):
+            paths = sorted(os.path.join(pattern, name) for name in os.listdir(pattern))
+        elif glob.has_magic(pattern):
+            paths = sorted(glob.glob(pattern))
+        else:
+            paths = [pattern]
+        for path in paths:
+            if is_input_file(path) and path not in input_files:
+                input_files.append(path)
+    return input_files
+
+
+def is_input_file(path):
+    path = path.rstrip("/\\")
+    if os.path.basename(path).startswith(TMP_PREFIX):
+        return False
+    return helpers.getExt(helpers.stripCompressionExt(path)).lower() in INPUT_FORMATS
+
+
+def get_output_files(input_file, output_dir, output_formats):
+    base = helpers.getBase(helpers.stripCompressionExt(os.path.basename(input_file.rstrip("/\\"))))
+    return [os.path.join(output_dir, base + output_format) for output_format in output_formats]
+
+
+def is_up_to_date(input_file, output_files):
+    """Outputs only get their final name once they are complete, so existing outputs newer than the input are up to date"""
+    input_mtime = os.path.getmtime(input_file)
+    return all(os.path.exists(f) and os.path.getmtime(f) >= input_mtime for f in output_files)
+
+
+def convert_file(input_file, output_files, params):
+    """Converts a single input file to temporary files that are renamed to output_files once all of them are complete"""
+    result = {'input_file': input_file, 'num_spectra': 0, 'num_bytes': get_size(input_file), 'status': "converted", 'error': None}
+    tmp_files = [get_tmp_file(f) for f in output_files]
+    start = time.perf_counter()
+    try:
+        # the progress messages of parallel conversions would be interleaved
+        with contextlib.redirect_stdout(io.StringIO()):
+            result['num_spectra'] = convert(input_file, tmp_files, params)
+        for tmp_file, output_file in zip(tmp_files, output_files):
+            replace_file(tmp_file, output_file)
+    except (Exception, SystemExit) as e:
+        result['status'], result['error'] = "failed", str(e)
+        for tmp_file in tmp_files:
+            # .spectra outputs are written to <tmp_file>.tmp first
+            remove_file(tmp_file)
+            remove_file(tmp_file + ".tmp")
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+def get_size(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+    return os.path.getsize(path)
+
+
+def report_result(result):
+    if result['status'] == "failed":
+        print("ERROR: Failed to convert %s: %s" % (result['input_file'], result['error']))
+    else:
+        print("Converted %s: %d spectra in %.1f s" % (result['input_file'], result['num_spectra'], result['seconds']))
+    return result
+
+
+def print_summary(results, seconds):
+    converted = [r for r in results if r['status'] == "converted"]
+    num_spectra = sum(r['num_spectra'] for r in converted)
+    num_bytes = sum(r['num_bytes'] for r in converted)
+    seconds = max(seconds, 1e-9)
+    print("%d converted, %d skipped, %d failed in %.1f s" % (len(converted), sum(r['status'] == "skipped" for r in results),
+                                                              sum(r['status'] == "failed" for r in results), seconds))
+    print("Throughput: %.2f files/s, %.0f spectra/s, %.1f MB/s" % (len(converted) / seconds, num_spectra / seconds, num_bytes / seconds / 1e6))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
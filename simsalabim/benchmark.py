@@ -0,0 +1,274 @@
+import sys
+import os
+import time
+import tempfile
+
+import numpy as np
+
+from .simsalabim import __version__, __copyright__
+
+from .spectrum import Spectrum, peaks_to_text
+from .precursor import Precursor
+from .apl_parser import parse_apl
+from .mgf_parser import parse_mgf
+from .ms2_parser import parse_ms2
+from .apl_writer import AplWriter
+from .mgf_writer import MgfWriter
+from .ms2_writer import Ms2Writer
+from .mzml_writer import MzMLWriter2
+from .mzml_fast_writer import FastMzMLWriter
+from . import block_reader
+from . import spectrum_index
+from .apl_parser import load_apl_index
+from .spectrum_filter import SpectrumFilter
+from .mzml_encoding import MzMLEncoding, has_numpress
+from .feature_index import FeatureSweep
+
+
+def main(argv):
+    print('simsalabim-benchmark version %s\n%s' % (__version__, __copyright__))
+    print('Issued command:', os.path.basename(__file__) + " " + " ".join(map(str, sys.argv[1:])))
+
+    args, params = parseArgs()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for benchmark in args.benchmarks:
+            BENCHMARKS[benchmark](tmp_dir, params)
+
+
+def parseArgs():
+    import argparse
+    apars = argparse.ArgumentParser(
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    apars.add_argument('benchmarks', nargs='+', metavar='B', choices=sorted(BENCHMARKS.keys()),
+                                         help='''benchmarks to run: %s.
+                                                    ''' % ", ".join(sorted(BENCHMARKS.keys())))
+
+    apars.add_argument('--num_spectra', default=20000, metavar='N', type=int,
+                                         help='''number of synthetic spectra.
+                                                    ''')
+
+    apars.add_argument('--num_peaks', default=300, metavar='P', type=int,
+                                         help='''number of fragment peaks per synthetic spectrum.
+                                                    ''')
+
+    apars.add_argument('--num_features', default=200000, metavar='F', type=int,
+                                         help='''number of synthetic MS1 features for the features benchmark.
+                                                    ''')
+
+    # ------------------------------------------------
+    args = apars.parse_args()
+
+    params = dict()
+    params['numSpectra'] = args.num_spectra
+    params['numPeaks'] = args.num_peaks
+    params['numFeatures'] = args.num_features
+
+    return args, params
+
+
+def synthetic_spectra(num_spectra, num_peaks, num_raw_files=3, seed=1):
+    rng = np.random.default_rng(seed)
+    for i in range(num_spectra):
+        charge = int(rng.integers(1, 5))
+        precursors = [Precursor(0.0, float(rng.uniform(400.0, 1500.0)), charge, None)]
+        mzs = np.sort(rng.uniform(100.0, 2000.0, num_peaks))
+        intensities = rng.uniform(0.0, 1e6, num_peaks)
+        yield Spectrum.from_arrays(i + 1, precursors, mzs, intensities, raw_file="raw_file_%d" % (i % num_raw_files))
+
+
+def write_synthetic_file(output_file, params):
+    writers = {".apl": AplWriter, ".mgf": MgfWriter, ".ms2": Ms2Writer}
+    with open(output_file, 'w') as out:
+        writer = writers[os.path.splitext(output_file)[1]](out)
+        writer.write(synthetic_spectra(params['numSpectra'], params['numPeaks']))
+
+
+def report(label, num_spectra, num_bytes, seconds):
+    print("%-32s %8.2f s %10.0f spectra/s %8.1f MB/s" % (label, seconds, num_spectra / seconds, num_bytes / seconds / 1e6))
+
+
+def benchmark_parsers(tmp_dir, params):
+    for ext, parser in [(".apl", parse_apl), (".mgf", parse_mgf), (".ms2", parse_ms2)]:
+        input_file = os.path.join(tmp_dir, "synthetic" + ext)
+        if not os.path.isfile(input_file):
+            write_synthetic_file(input_file, params)
+
+        for reader in block_reader.READERS:
+            start = time.perf_counter()
+            num_spectra = sum(1 for _ in parser(input_file, storeFragmentIons=True, reader=reader))
+            report("parse_%s (%s)" % (ext[1:], reader), num_spectra, os.path.getsize(input_file), time.perf_counter() - start)
+
+
+def benchmark_parallel(tmp_dir, params):
+    input_file = os.path.join(tmp_dir, "synthetic.apl")
+    if not os.path.isfile(input_file):
+        write_synthetic_file(input_file, params)
+
+    workers = 1
+    while workers <= os.cpu_count():
+        start = time.perf_counter()
+        num_spectra = sum(1 for _ in parse_apl(input_file, storeFragmentIons=True, reader="mmap", workers=workers))
+        report("parse_apl (%d workers)" % workers, num_spectra, os.path.getsize(input_file), time.perf_counter() - start)
+        workers *= 2
+
+
+def benchmark_filter(tmp_dir, params):
+    input_file = os.path.join(tmp_dir, "synthetic.apl")
+    if not os.path.isfile(input_file):
+        write_synthetic_file(input_file, params)
+
+    # selects about 1% of the spectra
+    scannrs = range(1, params['numSpectra'] + 1, 100)
+    spectrumFilters = [("no filter", None),
+                       ("charge 2", SpectrumFilter(minCharge=2, maxCharge=2)),
+                       ("1% of scans", SpectrumFilter(scannrs=scannrs))]
+    for label, spectrumFilter in spectrumFilters:
+        start = time.perf_counter()
+        num_spectra = sum(1 for _ in parse_apl(input_file, storeFragmentIons=True, reader="mmap", spectrumFilter=spectrumFilter))
+        report("parse_apl (%s)" % label, num_spectra, os.path.getsize(input_file), time.perf_counter() - start)
+
+    load_apl_index(input_file)
+    start = time.perf_counter()
+    num_spectra = sum(1 for _ in parse_apl(input_file, storeFragmentIons=True, spectrumFilter=SpectrumFilter(scannrs=scannrs)))
+    report("parse_apl (1% of scans, index)", num_spectra, os.path.getsize(input_file), time.perf_counter() - start)
+    os.remove(spectrum_index.get_index_file(input_file))
+
+
+def benchmark_writers(tmp_dir, params):
+    spectra = list(synthetic_spectra(params['numSpectra'], params['numPeaks']))
+    output_file = os.path.join(tmp_dir, "peaks.txt")
+
+    # the peak formatting of the writers before bulk formatting: one format and write call per peak
+    start = time.perf_counter()
+    with open(output_file, 'w') as out:
+        for spectrum in spectra:
+            for a, b in zip(spectrum.mz_array, spectrum.intensity_array):
+                out.write("%f %f\n" % (a, b))
+    report("peaks (per peak)", len(spectra), os.path.getsize(output_file), time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with open(output_file, 'w') as out:
+        for spectrum in spectra:
+            out.write(peaks_to_text(spectrum.mz_array, spectrum.intensity_array))
+    report("peaks (bulk)", len(spectra), os.path.getsize(output_file), time.perf_counter() - start)
+
+    for ext, writer in [(".apl", AplWriter), (".mgf", MgfWriter), (".ms2", Ms2Writer)]:
+        output_file = os.path.join(tmp_dir, "written" + ext)
+        start = time.perf_counter()
+        with open(output_file, 'w') as out:
+            writer(out).write(spectra)
+        report("%s (%s)" % (writer.__name__, ext[1:]), len(spectra), os.path.getsize(output_file), time.perf_counter() - start)
+
+    for writer in [MzMLWriter2, FastMzMLWriter]:
+        output_file = os.path.join(tmp_dir, "written.mzML")
+        start = time.perf_counter()
+        with open(output_file, 'wb') as out:
+            writer(out).write(spectra)
+        report("%s (mzML)" % (writer.__name__, ), len(spectra), os.path.getsize(output_file), time.perf_counter() - start)
+
+
+def benchmark_encodings(tmp_dir, params):
+    from pyteomics import mzml
+    spectra = list(synthetic_spectra(params['numSpectra'], params['numPeaks']))
+    # (m/z precision, intensity precision, m/z compression, intensity compression)
+    encodings = [(64, 32, "none", "none"), (64, 32, "zlib", "zlib"), (32, 32, "zlib", "zlib"), (64, 64, "zlib", "zlib")]
+    if has_numpress():
+        encodings += [(64, 32, "numpress_linear", "numpress_slof"), (64, 32, "numpress_linear", "numpress_pic")]
+    else:
+        print("pynumpress is not installed, skipping the MS-Numpress encodings")
+
+    output_file = os.path.join(tmp_dir, "encoded.mzML")
+    for writer in [MzMLWriter2, FastMzMLWriter]:
+        for encoding in encodings:
+            label = "%s %d/%d %s/%s" % (writer.__name__, *encoding)
+            start = time.perf_counter()
+            with open(output_file, 'wb') as out:
+                writer(out, array_encoding=MzMLEncoding(*encoding)).write(spectra)
+            write_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            num_spectra = sum(1 for _ in mzml.MzML(output_file))
+            read_time = time.perf_counter() - start
+            print("%-48s %8.1f MB  write %6.2f s  read %6.2f s" % (label, os.path.getsize(output_file) / 1e6, write_time, read_time))
+
+
+def synthetic_features(num_features, seed=1):
+    """Feature rows [mz, charge, rt_left, rt_right, rt, intensity] sorted like in add_quant_info"""
+    rng = np.random.default_rng(seed)
+    mzs = rng.uniform(300.0, 1500.0, num_features)
+    rt_lefts = rng.uniform(0.0, 7200.0, num_features)
+    rt_rights = rt_lefts + rng.exponential(30.0, num_features)
+    features = [[float(mz), 2, float(l), float(r), float((l + r) / 2), 1e6] for mz, l, r in zip(mzs, rt_lefts, rt_rights)]
+    features.sort(key=lambda x: x[3])
+    features.sort(key=lambda x: x[0])
+    return features
+
+
+def get_candidate_precursors(features, fmz_all, pmz, iso_width_lower, iso_width_upper, rt):
+    """Reference for the feature queries: m/z search on the features sorted by m/z followed by an RT check per feature"""
+    l_idx = fmz_all.searchsorted(pmz - iso_width_lower, side='left')
+    r_idx = fmz_all.searchsorted(pmz + iso_width_upper, side='right')
+    candidates = list()
+    for f in features[l_idx:r_idx]:
+        fmz, fz, frt_left, frt_right, frt, fint = f
+        if frt_left < rt < frt_right:
+            candidates.append(f)
+    return candidates
+
+
+def report_queries(label, num_queries, seconds):
+    print("%-32s %8.2f s %10.0f spectra/s" % (label, seconds, num_queries / seconds))
+
+
+def benchmark_features(tmp_dir, params):
+    from .add_quant_info import to_sweep_order, iter_chunks, FEATURE_DTYPE
+    features = synthetic_features(params['numFeatures'])
+    rng = np.random.default_rng(2)
+    num_queries = params['numSpectra']
+    pmzs = rng.uniform(300.0, 1500.0, num_queries)
+    rts = rng.uniform(0.0, 7200.0, num_queries)
+    # wide, DIA-like isolation windows
+    width = 12.5
+
+    start = time.perf_counter()
+    fmz_all = np.array([f[0] for f in features])
+    expected = [get_candidate_precursors(features, fmz_all, pmz, width, width, rt) for pmz, rt in zip(pmzs, rts)]
+    report_queries("m/z searchsorted + RT loop", num_queries, time.perf_counter() - start)
+
+    # the sweep line needs the spectra in RT order, as in an mzML file
+    swept = to_sweep_order(np.array([tuple(f) for f in features], dtype=FEATURE_DTYPE))
+    sweep = FeatureSweep(lambda: iter_chunks(swept))
+    start = time.perf_counter()
+    candidates = [None] * num_queries
+    for i in np.argsort(rts, kind='stable'):
+        candidates[i] = [features[j] for j in sweep.query(pmzs[i] - width, pmzs[i] + width, rts[i])['mz_rank']]
+    report_queries("FeatureSweep.query", num_queries, time.perf_counter() - start)
+    if candidates != expected:
+        sys.exit("ERROR: FeatureSweep.query returned different candidates")
+
+    sweep.reset()
+    start = time.perf_counter()
+    order = np.argsort(rts, kind='stable')
+    offsets, found = sweep.query_batch(pmzs[order] - width, pmzs[order] + width, rts[order])
+    candidates = [None] * num_queries
+    for i, q in enumerate(order):
+        candidates[q] = [features[j] for j in found['mz_rank'][offsets[i]:offsets[i + 1]]]
+    report_queries("FeatureSweep.query_batch", num_queries, time.perf_counter() - start)
+    if candidates != expected:
+        sys.exit("ERROR: FeatureSweep.query_batch returned different candidates")
+
+
+BENCHMARKS = {
+    'parsers': benchmark_parsers,
+    'parallel': benchmark_parallel,
+    'filter': benchmark_filter,
+    'writers': benchmark_writers,
+    'encodings': benchmark_encodings,
+    'features': benchmark_features,
+}
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
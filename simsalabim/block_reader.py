@@ -0,0 +1,150 @@
+#############################################################
+## binary, record based reader for the text peak list      ##
+## formats (apl, mgf, ms2)                                 ##
+##                                                         ##
+## instead of decoding and iterating the file line by line ##
+## the file is memory mapped (or read in large blocks),    ##
+## record boundaries are located with bytes.find and only  ##
+## the header lines of each record are decoded             ##
+#############################################################
+
+import os
+import re
+import mmap
+
+import numpy as np
+
+from .spectrum import Spectrum, peaks_from_text
+from . import helpers
+
+
+BLOCK_SIZE = 16 * 1024 * 1024
+
+READERS = ("lines", "mmap", "blocks")
+
+PEAK_LINE = re.compile(rb'^[0-9]', re.M)
+
+WHITESPACE = frozenset(b' \t\n\r\x0b\x0c')
+
+
+def iter_record_spans(buffer, recordStart, start=0, end=None):
+    """Yields (start, end) byte ranges of the records in buffer, a record runs until the next record start"""
+    if end is None:
+        end = len(buffer)
+    separator = b'\n' + recordStart
+    if buffer[start:start + len(recordStart)] == recordStart and (start == 0 or buffer[start - 1:start] == b'\n'):
+        pos = start
+    else:
+        pos = buffer.find(separator, start, end)
+        pos = -1 if pos == -1 else pos + 1
+    while pos != -1:
+        next_pos = buffer.find(separator, pos + len(recordStart), end)
+        if next_pos == -1:
+            yield pos, end
+            return
+        yield pos, next_pos + 1
+        pos = next_pos + 1
+
+
+def iter_records(inputFile, recordStart, useMmap=True, blockSize=BLOCK_SIZE):
+    """Yields each record of inputFile as a memoryview slice"""
+    if helpers.getCompression(inputFile):
+        with helpers.openVersionSafe(inputFile, 'rb') as f:
+            yield from iter_records_from_stream(f, recordStart, blockSize)
+    elif useMmap and os.path.getsize(inputFile) > 0:
+        with open(inputFile, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                view = memoryview(mm)
+                for start, end in iter_record_spans(mm, recordStart):
+                    yield view[start:end]
+                view.release()
+                mm.close()
+            except BufferError:
+                pass # a consumer still holds a slice, the map is closed when it is garbage collected
+    else:
+        with open(inputFile, 'rb') as f:
+            yield from iter_records_from_stream(f, recordStart, blockSize)
+
+
+def iter_records_from_stream(f, recordStart, blockSize=BLOCK_SIZE):
+    """Yields each record of a binary stream as a memoryview slice, reading blockSize bytes at a time"""
+    buffer = b''
+    while True:
+        block = f.read(blockSize)
+        if not block:
+            break
+        buffer += block
+        view = memoryview(buffer)
+        # the last record of a block might be incomplete, keep it for the next block
+        for start, end in iter_record_spans(buffer, recordStart):
+            if end == len(buffer):
+                consumed = start
+                break
+            yield view[start:end]
+        else:
+            consumed = max(0, len(buffer) - len(recordStart) - 1)
+        buffer = buffer[consumed:]
+
+    view = memoryview(buffer)
+    for start, end in iter_record_spans(buffer, recordStart):
+        yield view[start:end]
+
+
+def split_record(record, recordEnd=None):
+    """Returns the decoded header lines and the peak block of a record, the peak block is a slice of the record
+    without a copy, only the header and trailer lines are copied and decoded"""
+    record = memoryview(record)
+    peaks = PEAK_LINE.search(record)
+    if not peaks:
+        return record.tobytes().decode().splitlines(True), record[:0]
+
+    peak_start = peaks.start()
+    peak_end = 0
+    if recordEnd:
+        end = get_record_end_pattern(recordEnd).search(record, peak_start)
+        peak_end = end.start() + 1 if end else 0
+    if peak_end <= 0:
+        peak_end = len(record)
+    headerLines = (record[:peak_start].tobytes() + record[peak_end:].tobytes()).decode().splitlines(True)
+    return headerLines, record[peak_start:peak_end]
+
+
+_RECORD_END_PATTERNS = dict()
+
+def get_record_end_pattern(recordEnd):
+    # memoryviews have no find, a literal pattern is searched just as fast
+    if recordEnd not in _RECORD_END_PATTERNS:
+        _RECORD_END_PATTERNS[recordEnd] = re.compile(re.escape(b'\n' + recordEnd))
+    return _RECORD_END_PATTERNS[recordEnd]
+
+
+def count_lines(block):
+    """Number of lines of a block without its trailing whitespace, like block.rstrip().count(b'\n') + 1"""
+    end = len(block)
+    while end > 0 and block[end - 1] in WHITESPACE:
+        end -= 1
+    if end == 0:
+        return 0
+    return int(np.count_nonzero(np.frombuffer(block[:end], dtype=np.uint8) == ord('\n'))) + 1
+
+
+def parse_records(records, parseHeader, storeFragmentIons=False, recordEnd=None, spectrumFilter=None):
+    for record in records:
+        headerLines, peakBlock = split_record(record, recordEnd)
+        header = parseHeader(headerLines)
+        if header:
+            scannr, raw_file, rtime, precursors = header
+            if spectrumFilter and not spectrumFilter.accepts(scannr, rtime, precursors):
+                continue
+            fragmentIons = peaks_from_text(peakBlock) if storeFragmentIons else None
+            yield Spectrum(scannr, precursors, fragmentIons, raw_file, rtime=rtime)
+
+
+def parse_record_headers(records, parseHeader, recordEnd=None):
+    """Yields (scannr, raw_file, rtime, precursors, num_peaks) per record without converting the peaks"""
+    for record in records:
+        headerLines, peakBlock = split_record(record, recordEnd)
+        header = parseHeader(headerLines)
+        if header:
+            yield header + (count_lines(peakBlock),)
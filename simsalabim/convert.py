@@ -1,18 +1,25 @@
 import sys
 import os
+import contextlib
 
 from .simsalabim import __version__, __copyright__
 
 from .ms2_parser import parse_ms2
 from .mgf_parser import parse_mgf
-from .apl_parser import parse_apl
+from .apl_parser import parse_apl, check_apl_spectrum_filter
 from .mzml_parser import parse_mzml
+from .spectrum_store import parse_spectrum_store, SpectrumStoreWriter, STORE_EXT
 
 from .mzml_writer import MzMLWriter2
+from .mzml_fast_writer import FastMzMLWriter
 from .ms2_writer import Ms2Writer
 from .mgf_writer import MgfWriter
+from .apl_writer import AplWriter
 
 from . import helpers
+from . import block_reader
+from .spectrum_filter import SpectrumFilter
+from .mzml_encoding import add_encoding_arguments, get_encoding
 
 def main(argv):
     print('simsalabim-convert version %s\n%s' % (__version__, __copyright__))
@@ -31,11 +38,14 @@ def parseArgs():
     requiredNamed = apars.add_argument_group('required arguments')
     
     apars.add_argument('input_file', default=None, metavar = "IN_FILE",
-                                         help='''input MS/MS file, either ms2, mgf, apl or mzML format.
+                                         help='''input MS/MS file, either ms2, mgf, apl or mzML format, optionally compressed (.gz, .bz2, .xz or .zst), 
+                                                         or a .spectra directory.
                                                     ''')
     
-    apars.add_argument('--output_fn', default = "spectra.mzML", metavar='OUT', 
-                                         help='''output file in ms2, mgf or mzML format.
+    apars.add_argument('--output_fn', default = ["spectra.mzML"], metavar='OUT', nargs='+',
+                                         help='''output file(s) in ms2, mgf, apl or mzML format, or a .spectra directory with memory mappable 
+                                                         columns. The output is compressed if the file name ends in .gz, .bz2, .xz or .zst. With several output files the input is parsed only 
+                                                         once and every spectrum is written to all outputs.
                                                     ''')
     
     apars.add_argument('--split_precursors',
@@ -48,6 +58,64 @@ def parseArgs():
                                                     ''',
                                          action='store_true')
                                          
+    apars.add_argument('--reader', default = "mmap", metavar='R', choices=block_reader.READERS,
+                                         help='''reader backend for apl, mgf and ms2 input: "lines" decodes the file line by line, 
+                                                         "mmap" memory maps the file and "blocks" reads it in large binary blocks.
+                                                    ''')
+    
+    apars.add_argument('--workers', default = 1, metavar='W', type=int,
+                                         help='''number of processes used to parse the input. With more than one worker apl, mgf and ms2 
+                                                         files are split into chunks that are parsed in parallel, for indexed mzML files 
+                                                         the spectra are parsed and their binary arrays decoded in parallel.
+                                                    ''')
+    
+    apars.add_argument('--pipeline',
+                                         help='''convert apl, mgf and ms2 input in a pipeline: a reader thread reads ahead, --workers 
+                                                         processes parse and format the spectra and a writer thread writes them in input 
+                                                         order. The utilization of each stage is reported at the end.
+                                                    ''',
+                                         action='store_true')
+    
+    apars.add_argument('--mzml_writer', default = "psims", metavar='W', choices=MZML_WRITERS.keys(),
+                                         help='''writer for mzML output: psims or fast, a templated writer that is considerably faster 
+                                                         and also writes the offset index and the file checksum.
+                                                    ''')
+    
+    add_encoding_arguments(apars)
+    
+    apars.add_argument('--scans', default = None, metavar='S',
+                                         help='''only convert these scan numbers, given as a comma separated list, e.g. 132,133,2050.
+                                                    ''')
+    
+    apars.add_argument('--min_rtime', default = None, metavar='RT', type=float,
+                                         help='''minimum retention time in seconds, not supported for .apl input.
+                                                    ''')
+    
+    apars.add_argument('--max_rtime', default = None, metavar='RT', type=float,
+                                         help='''maximum retention time in seconds, not supported for .apl input.
+                                                    ''')
+    
+    apars.add_argument('--min_prec_mz', default = None, metavar='MZ', type=float,
+                                         help='''minimum precursor m/z.
+                                                    ''')
+    
+    apars.add_argument('--max_prec_mz', default = None, metavar='MZ', type=float,
+                                         help='''maximum precursor m/z.
+                                                    ''')
+    
+    apars.add_argument('--min_charge', default = None, metavar='Z', type=int,
+                                         help='''minimum precursor charge.
+                                                    ''')
+    
+    apars.add_argument('--max_charge', default = None, metavar='Z', type=int,
+                                         help='''maximum precursor charge.
+                                                    ''')
+    
+    apars.add_argument('--ms_levels', default = "2", metavar='L',
+                                         help='''comma separated list of MS levels to convert. Only mzML input contains 
+                                                         spectra other than MS2 spectra.
+                                                    ''')
+    
     apars.add_argument('--map_fn', default = "", metavar='M', 
                                          help='''tab separated file containing a mapping from spectra to precursor information.
                                                     ''')
@@ -57,38 +125,127 @@ def parseArgs():
     
     params = dict()
     params['specPrecMapFile'] = args.map_fn
-    params['splitPrecursors'] = args.split_precursors or args.output_fn.lower().endswith(".mgf")
+    params['reader'] = args.reader
+    params['workers'] = args.workers
+    params['pipeline'] = args.pipeline
+    params['mzmlWriter'] = args.mzml_writer
+    params['mzmlEncoding'] = get_encoding(args)
+    params['spectrumFilter'] = getSpectrumFilter(args)
+    params['splitPrecursors'] = args.split_precursors or any(helpers.stripCompressionExt(f).lower().endswith(".mgf") for f in args.output_fn)
     
     return args, params
 
 
+def getSpectrumFilter(args):
+    """Returns None if no filter options were given, so that the parsers skip the checks altogether"""
+    scannrs = None if args.scans is None else [int(x) for x in args.scans.split(",")]
+    msLevels = [int(x) for x in args.ms_levels.split(",")]
+    bounds = [args.min_rtime, args.max_rtime, args.min_prec_mz, args.max_prec_mz, args.min_charge, args.max_charge]
+    if scannrs is None and msLevels == [2] and all(b is None for b in bounds):
+        return None
+    return SpectrumFilter(scannrs, *bounds, msLevels=msLevels)
+
+
 def convert(input_file, output_file, params):
-    if input_file.lower().endswith(".mzml"):
+    """Converts input_file to one or more output files and returns the number of spectra that were read"""
+    # compressed files, e.g. spectra.mgf.gz, are detected by the extension before the compression suffix
+    input_format = helpers.getExt(helpers.stripCompressionExt(input_file.rstrip("/\\"))).lower()
+    if input_format == ".mzml":
         parser = parse_mzml
-    elif input_file.lower().endswith(".ms2"):
+    elif input_format == STORE_EXT:
+        parser = parse_spectrum_store
+    elif input_format == ".ms2":
         parser = parse_ms2
-    elif input_file.lower().endswith(".mgf"):
+    elif input_format == ".mgf":
         parser = parse_mgf
-    elif input_file.lower().endswith(".apl"):
+    elif input_format == ".apl":
         parser = parse_apl
+    else:
+        sys.exit("ERROR: Could not detect input format from filename %s. Supported formats are .mzML, .ms2, .mgf, .apl and .spectra" % input_file)
         
-    spectra = parser(input_file, storeFragmentIons=True)
+    output_files = [output_file] if isinstance(output_file, str) else output_file
+    if input_format == ".apl":
+        # before the output files are created, the pipelined mode does not go through parse_apl
+        check_apl_spectrum_filter(params.get('spectrumFilter'))
     
-    writeMode = 'w'
-    if output_file.lower().endswith(".mzml"):
-        writeMode = 'wb'
-
-    with helpers.openVersionSafe(output_file, writeMode) as out:
-        if output_file.lower().endswith(".mzml"):
-            writer = MzMLWriter2(out)
-        elif output_file.lower().endswith(".ms2"):
-            writer = Ms2Writer(out)
-        elif output_file.lower().endswith(".mgf"):
-            writer = MgfWriter(out)
+    # the fast mzML writer needs the spectrumList count before the first spectrum, it is taken from a header-only pass
+    numSpectra = None
+    if params.get('mzmlWriter') == "fast" and any(getOutputFormat(f) == ".mzml" for f in output_files):
+        numSpectra = sum(1 for _ in parseSpectra(parser, input_file, params, storeFragmentIons=False))
+    
+    if params.get('pipeline'):
+        if input_format in (".mzml", STORE_EXT):
+            print("WARNING: The pipelined mode does not support %s input, falling back to the serial mode" % input_format)
+        else:
+            from .pipeline import convert_pipelined
+            num_spectra, _ = convert_pipelined(input_file, output_files, params, numSpectra)
+            print("Done")
+            return num_spectra
     
-        writer.write(spectra)
+    spectra = parseSpectra(parser, input_file, params)
+    with contextlib.ExitStack() as stack:
+        writers = [getWriter(f, stack, params.get('mzmlWriter', "psims"), params.get('mzmlEncoding'), numSpectra) for f in output_files]
+        for writer in writers:
+            writer.start()
+        num_spectra = 0
+        for i, spectrum in enumerate(spectra):
+            for writer in writers:
+                writer.write_spectrum(spectrum)
+            num_spectra += 1
+            if i % 1000 == 0:
+                print("Handled %d spectra" % (i, ))
+        for writer in writers:
+            writer.finish()
 
     print("Done")
+    return num_spectra
+
+
+def parseSpectra(parser, input_file, params, storeFragmentIons=True):
+    if parser == parse_spectrum_store:
+        return parser(input_file, storeFragmentIons=storeFragmentIons, spectrumFilter=params.get('spectrumFilter'))
+    elif parser == parse_mzml:
+        return parser(input_file, storeFragmentIons=storeFragmentIons, workers=params.get('workers', 1), spectrumFilter=params.get('spectrumFilter'))
+    else:
+        return parser(input_file, storeFragmentIons=storeFragmentIons, reader=params.get('reader', "lines"), workers=params.get('workers', 1), spectrumFilter=params.get('spectrumFilter'))
+
+
+def getOutputFormat(output_file):
+    return helpers.getExt(helpers.stripCompressionExt(output_file.rstrip("/\\"))).lower()
+
+
+def getWriter(output_file, stack, mzmlWriter="psims", mzmlEncoding=None, numSpectra=None):
+    """Opens output_file on the ExitStack and returns the writer for its format, numSpectra is needed by the fast mzML writer"""
+    output_format = getOutputFormat(output_file)
+    if output_format == STORE_EXT:
+        if helpers.getCompression(output_file):
+            sys.exit("ERROR: .spectra output cannot be compressed: %s" % output_file)
+        writer = SpectrumStoreWriter(output_file)
+        stack.callback(writer.abort)
+        return writer
+    if output_format not in WRITERS:
+        sys.exit("ERROR: Could not detect output format from filename %s. Please use the extension .mzML, .ms2, .mgf, .apl or .spectra for your output file" % output_file)
+
+    writeMode = 'wb' if output_format == ".mzml" else 'w'
+    out = stack.enter_context(helpers.openVersionSafe(output_file, writeMode))
+    if output_format == ".mzml" and mzmlWriter == "fast":
+        return FastMzMLWriter(out, numSpectra=numSpectra, array_encoding=mzmlEncoding)
+    if output_format == ".mzml":
+        return MZML_WRITERS[mzmlWriter](out, array_encoding=mzmlEncoding)
+    return WRITERS[output_format](out)
+
+
+WRITERS = {
+    ".mzml": MzMLWriter2,
+    ".ms2": Ms2Writer,
+    ".mgf": MgfWriter,
+    ".apl": AplWriter,
+}
+
+MZML_WRITERS = {
+    "psims": MzMLWriter2,
+    "fast": FastMzMLWriter,
+}
 
 
 if __name__ == '__main__':
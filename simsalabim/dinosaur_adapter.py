@@ -2,19 +2,40 @@ from __future__ import print_function
 
 import sys
 import os
+import re
+import time
+import shlex
+import threading
 import subprocess
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 from .simsalabim import __version__, __copyright__
 from . import add_quant_info as quant
+from .mzml_encoding import add_encoding_arguments, get_encoding, get_encoding_arguments
+from .result_cache import ResultCache, get_tmp_file, replace_file, remove_file
+from .work_queue import WorkQueue, STALE_TIMEOUT
 from . import helpers
 
+# GB reserved per concurrent feature assignment
+ASSIGNMENT_MEMORY = 2.0
+
 def main(argv):
   print('dinosaur-adapter version %s\n%s' % (__version__, __copyright__))
   print('Issued command:', os.path.basename(__file__) + " " + " ".join(map(str, sys.argv[1:])))
   
   args, params = parseArgs()
   
-  run_dinosaur(args.dinosaur_jar_path, args.mzml_fns, args.output_folder, args.spectrum_output_format, params)
+  # without --jobs the runs are processed one after the other with their output on the console
+  if params['distributed'] or params['jobs'] is not None:
+    params['jobs'] = params['jobs'] or 1
+    run = run_dinosaur_distributed if params['distributed'] else run_dinosaur_parallel
+    results = run(args.dinosaur_jar_path, args.mzml_fns, args.output_folder, args.spectrum_output_format, params)
+    failed = [r for r in results if r['status'] == "failed"]
+    if failed:
+      sys.exit("ERROR: %d of %d runs failed, see the .log files in %s" % (len(failed), len(results), args.output_folder))
+  else:
+    run_dinosaur(args.dinosaur_jar_path, args.mzml_fns, args.output_folder, args.spectrum_output_format, params)
 
 def parseArgs():
   import argparse
@@ -61,6 +82,40 @@ def parseArgs():
                           ''',
                      action='store_true')
   
+  apars.add_argument('--jobs', default=None, metavar='J', type=int,
+                     help='''number of runs that are processed concurrently. The feature assignment of a run then 
+                             overlaps with the feature detection of the next runs and the wall time and peak 
+                             memory of every step are reported, also for --jobs 1. The output of each run is 
+                             written to <output_folder>/<run>.log. Without this option the runs are processed 
+                             one after the other with their output on the console.
+                          ''')
+  
+  apars.add_argument('--max_memory', default=None, metavar='GB', type=float,
+                     help='''memory budget in GB for the concurrent runs with --jobs. Every Dinosaur run reserves 
+                             --dinosaur_mem GB and every feature assignment that can run alongside reserves 
+                             --assignment_mem GB. Defaults to the memory that is currently available.
+                          ''')
+  
+  apars.add_argument('--assignment_mem', default=ASSIGNMENT_MEMORY, metavar='GB', type=float,
+                     help='''memory in GB reserved for the feature assignment of a run with --jobs, which holds 
+                             the features and the spectra of the run that is being processed.
+                          ''')
+  
+  apars.add_argument('--distributed',
+                     help='''share the runs with the workers on other machines that are started with the same 
+                             command on the same output folder, e.g. on a shared network drive. Every run is 
+                             claimed by one worker with a <output_folder>/<run>.lock file, and its result is 
+                             recorded in <output_folder>/<run>.status.json. Can be combined with --jobs.
+                          ''',
+                     action='store_true')
+  
+  apars.add_argument('--stale_timeout', default=STALE_TIMEOUT, metavar='S', type=float,
+                     help='''with --distributed, a claim whose worker did not send a heartbeat for this many seconds 
+                             is taken over by another worker. The clocks of the machines need to be synchronized.
+                          ''')
+  
+  add_encoding_arguments(apars)
+  
   # ------------------------------------------------
   args = apars.parse_args()
   
@@ -77,32 +132,241 @@ def parseArgs():
   params['splitPrecursors'] = args.split_precursors
   params['dinosaurMemory'] = args.dinosaur_mem
   params['dinosaurFlags'] = args.dinosaur_flags
+  params['mzmlEncoding'] = get_encoding(args)
+  params['jobs'] = args.jobs
+  params['maxMemory'] = args.max_memory
+  params['assignmentMemory'] = args.assignment_mem
+  params['distributed'] = args.distributed
+  params['staleTimeout'] = args.stale_timeout
   
   return args, params
 
 def run_dinosaur(dinosaur_jar_path, mzml_fns, output_folder, spectrum_output_format, params):
-  dinosaur_binary = "java -Xmx%dM -jar %s --seed=1" % (int(params['dinosaurMemory']*1000), dinosaur_jar_path)
   helpers.createDir(output_folder)
   for mzml_fn in mzml_fns:
-    baseFN = helpers.getBase(helpers.getFileName(mzml_fn))
-    dinosaur_output_file = os.path.join(output_folder, baseFN + ".features.tsv")
-    if not os.path.isfile(dinosaur_output_file):
-      cmd_dinosaur = "%s --force --outDir=%s %s %s;" % (dinosaur_binary, output_folder, params['dinosaurFlags'], mzml_fn)
-      helpers.executeCmd(cmd_dinosaur)
-    else:
-      print("Found dinosaur output file at %s, remove this file to re-run Dinosaur on this file" % (dinosaur_output_file))
+    result = process_run(dinosaur_jar_path, mzml_fn, output_folder, spectrum_output_format, params)
+    if result['status'] == "failed":
+      sys.exit("ERROR: Dinosaur did not produce a feature file for %s" % (mzml_fn))
+
+def get_output_files(mzml_fn, output_folder, spectrum_output_format):
+  """Returns the Dinosaur feature file, the spectrum output files and the feature map file of a run"""
+  baseFN = helpers.getBase(helpers.getFileName(mzml_fn))
+  dinosaur_output_file = os.path.join(output_folder, baseFN + ".features.tsv")
+  # without spectrum output only the feature map is written, which does not need the binary arrays
+  output_fns = list()
+  if spectrum_output_format:
+    output_fns.append(os.path.join(output_folder, baseFN + ".recalibrated." + spectrum_output_format))
+  return dinosaur_output_file, output_fns, os.path.join(output_folder, baseFN + ".feature_map.tsv")
+
+def get_dinosaur_cmd(dinosaur_jar_path, mzml_fn, output_folder, params):
+  dinosaur_binary = "java -Xmx%dM -jar %s --seed=1" % (int(params['dinosaurMemory']*1000), dinosaur_jar_path)
+  return "%s --force --outDir=%s %s %s" % (dinosaur_binary, output_folder, params['dinosaurFlags'], mzml_fn)
+
+def get_assignment_cmd(dinosaur_output_file, mzml_fn, output_fns, params):
+  cmd = [sys.executable, "-m", "simsalabim.add_quant_info", mzml_fn, "--feature_fn", dinosaur_output_file, "--map_fn", params['specPrecMapFile']]
+  cmd += ["--output_fn"] + output_fns if output_fns else ["--map_only"]
+  if params['splitPrecursors']:
+    cmd.append("--split_precursors")
+  return cmd + get_encoding_arguments(params.get('mzmlEncoding'))
+
+def get_num_dinosaur_slots(params):
+  """Number of concurrent Dinosaur runs that fit into the memory budget, at least 1. Every job runs either 
+  Dinosaur or a feature assignment, so the jobs without a Dinosaur slot reserve the assignment memory."""
+  maxMemory = params.get('maxMemory') or get_available_memory()
+  if maxMemory is None:
+    return params['jobs']
+  assignmentMemory = params.get('assignmentMemory', ASSIGNMENT_MEMORY)
+  for slots in range(params['jobs'], 0, -1):
+    if slots * params['dinosaurMemory'] + (params['jobs'] - slots) * assignmentMemory <= maxMemory:
+      return slots
+  return 1
+
+def get_available_memory():
+  """Memory in GB that can be allocated without swapping, as far as the platform reports it"""
+  try:
+    with open("/proc/meminfo") as f:
+      for line in f:
+        if line.startswith("MemAvailable:"):
+          return int(line.split()[1]) * 1024 / 1e9
+  except (OSError, ValueError, IndexError):
+    pass
+  try:
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES') / 1e9
+  except (ValueError, OSError, AttributeError):
+    return None
+
+def run_dinosaur_parallel(dinosaur_jar_path, mzml_fns, output_folder, spectrum_output_format, params):
+  """Processes up to params['jobs'] runs at once, with at most as many concurrent Dinosaur runs as fit into 
+  the memory budget. The feature assignment runs in its own process as soon as a run's features are detected, 
+  so it overlaps with the feature detection of the next runs. Returns a result dict per run."""
+  helpers.createDir(output_folder)
+  dinosaurSlots = threading.Semaphore(get_num_dinosaur_slots(params))
+  print("Processing %d runs with %d jobs, at most %d concurrent Dinosaur runs" % (len(mzml_fns), params['jobs'], get_num_dinosaur_slots(params)))
+  
+  start = time.perf_counter()
+  with ThreadPoolExecutor(max_workers=params['jobs']) as executor:
+    results = list(executor.map(lambda mzml_fn: process_run_safely(dinosaur_jar_path, mzml_fn, output_folder, spectrum_output_format, params, dinosaurSlots), mzml_fns))
+  
+  print_report(results, time.perf_counter() - start)
+  return results
+
+def run_dinosaur_distributed(dinosaur_jar_path, mzml_fns, output_folder, spectrum_output_format, params):
+  """Processes the runs together with the other workers on the same output folder, see work_queue.py. 
+  Returns the result dicts of the runs processed by this worker."""
+  helpers.createDir(output_folder)
+  dinosaurSlots = threading.Semaphore(get_num_dinosaur_slots(params))
+  queue = WorkQueue(output_folder, params['staleTimeout'])
+  runs = dict((helpers.getBase(helpers.getFileName(mzml_fn)), mzml_fn) for mzml_fn in mzml_fns)
+  print("Worker %s processing up to %d runs with %d jobs, at most %d concurrent Dinosaur runs" % (queue.worker, len(runs), params['jobs'], get_num_dinosaur_slots(params)))
+  
+  start = time.perf_counter()
+  results = queue.run(list(runs.keys()), lambda name: process_run_safely(dinosaur_jar_path, runs[name], output_folder, spectrum_output_format, params, dinosaurSlots), params['jobs'])
+  
+  print_report(results, time.perf_counter() - start)
+  return results
+
+def process_run_safely(dinosaur_jar_path, mzml_fn, output_folder, spectrum_output_format, params, dinosaurSlots):
+  """Runs process_run for one of several concurrent runs, an error marks the run as failed instead of ending the batch"""
+  try:
+    return process_run(dinosaur_jar_path, mzml_fn, output_folder, spectrum_output_format, params, dinosaurSlots)
+  except Exception as e:
+    result = {'mzml_fn': mzml_fn, 'status': "failed", 'dinosaur': None, 'assignment': None, 'error': "%s: %s" % (type(e).__name__, e)}
+    with open(os.path.join(output_folder, helpers.getBase(helpers.getFileName(mzml_fn)) + ".log"), 'a') as log:
+      traceback.print_exc(file=log)
+    report_run(result, dinosaurSlots)
+    return result
+
+def process_run(dinosaur_jar_path, mzml_fn, output_folder, spectrum_output_format, params, dinosaurSlots=None):
+  """Runs the steps of a run whose inputs changed since they last ran. Without dinosaurSlots the features are 
+  assigned in this process, otherwise both steps are measured subprocesses with their output in <run>.log.
+  Outputs are written to temporary files and only get their final names once a step succeeded."""
+  baseFN = helpers.getBase(helpers.getFileName(mzml_fn))
+  dinosaur_output_file, output_fns, map_file = get_output_files(mzml_fn, output_folder, spectrum_output_format)
+  log_file = os.path.join(output_folder, baseFN + ".log")
+  cache = ResultCache(os.path.join(output_folder, baseFN + ".manifest.json"))
+  result = {'mzml_fn': mzml_fn, 'status': "done", 'dinosaur': None, 'assignment': None, 'error': None}
+  
+  dinosaurKey = get_dinosaur_key(cache, dinosaur_jar_path, mzml_fn, params)
+  if cache.is_up_to_date("dinosaur", dinosaurKey):
+    if dinosaurSlots is None:
+      print("Dinosaur features at %s are up to date, remove %s to re-run Dinosaur on this file" % (dinosaur_output_file, cache.manifest_file))
+  else:
+    tmp_folder = get_tmp_file(os.path.join(output_folder, baseFN + ".dinosaur"))
+    helpers.createDir(tmp_folder)
+    try:
+      cmd = get_dinosaur_cmd(dinosaur_jar_path, mzml_fn, tmp_folder, params)
+      if dinosaurSlots is None:
+        print(cmd)
+        sys.stdout.flush()
+        returncode = subprocess.call(shlex.split(cmd))
+      else:
+        with dinosaurSlots:
+          result['dinosaur'] = run_measured(shlex.split(cmd), log_file)
+        returncode = result['dinosaur']['returncode']
+      
+      # a crashed Dinosaur, e.g. killed for running out of memory, can leave a partial feature file
+      if returncode == 0 and os.path.isfile(os.path.join(tmp_folder, os.path.basename(dinosaur_output_file))):
+        outputs = list()
+        for name in os.listdir(tmp_folder):
+          outputs.append(os.path.join(output_folder, name))
+          replace_file(os.path.join(tmp_folder, name), outputs[-1])
+        cache.record("dinosaur", dinosaurKey, outputs)
+      else:
+        result['status'] = "failed"
+    finally:
+      remove_file(tmp_folder)
     
-    output_fn = os.path.join(output_folder, baseFN + ".dummy.txt")
-    if spectrum_output_format:
-      output_fn = os.path.join(output_folder, baseFN + ".recalibrated." + spectrum_output_format)
+    if result['status'] == "failed":
+      report_run(result, dinosaurSlots)
+      return result
+  
+  assignmentKey = get_assignment_key(cache, dinosaur_output_file, mzml_fn, spectrum_output_format, params)
+  if cache.is_up_to_date("assignment", assignmentKey):
+    if dinosaurSlots is None:
+      print("Dinosaur mapping file at %s is up to date, remove %s to re-run the assignment on this file" % (map_file, cache.manifest_file))
+  else:
+    outputs = output_fns + [map_file]
+    tmp_files = [get_tmp_file(f) for f in outputs]
+    runParams = dict(params, specPrecMapFile = tmp_files[-1])
+    try:
+      if dinosaurSlots is None:
+        quant.add_accurate_precursors(dinosaur_output_file, mzml_fn, tmp_files[:-1], runParams)
+        success = True
+      else:
+        result['assignment'] = run_measured(get_assignment_cmd(dinosaur_output_file, mzml_fn, tmp_files[:-1], runParams), log_file)
+        success = result['assignment']['returncode'] == 0
+      
+      if success:
+        for tmp_file, output in zip(tmp_files, outputs):
+          replace_file(tmp_file, output)
+        cache.record("assignment", assignmentKey, outputs)
+      else:
+        result['status'] = "failed"
+    finally:
+      for tmp_file in tmp_files:
+        remove_file(tmp_file)
+  
+  report_run(result, dinosaurSlots)
+  return result
+
+def get_dinosaur_key(cache, dinosaur_jar_path, mzml_fn, params):
+  # the jar's content identifies the Dinosaur version, the memory limit does not change the features
+  jar = cache.file_hash(dinosaur_jar_path) if os.path.isfile(dinosaur_jar_path) else dinosaur_jar_path
+  return {'mzml': cache.file_hash(mzml_fn), 'jar': jar, 'flags': shlex.split(params['dinosaurFlags'])}
+
+def get_assignment_key(cache, dinosaur_output_file, mzml_fn, spectrum_output_format, params):
+  return {'mzml': cache.file_hash(mzml_fn), 'features': cache.file_hash(dinosaur_output_file), 'version': __version__,
+          'spectrumOutputFormat': spectrum_output_format, 'splitPrecursors': params['splitPrecursors'], 
+          'encoding': get_encoding_arguments(params.get('mzmlEncoding'))}
+
+def run_measured(cmd, log_file):
+  """Runs cmd with its output appended to log_file, returns its return code, wall time and peak memory (MB)"""
+  # the subprocess imports simsalabim from the same location as this process
+  env = dict(os.environ)
+  env['PYTHONPATH'] = os.pathsep.join(filter(None, [os.path.dirname(os.path.dirname(os.path.abspath(__file__))), env.get('PYTHONPATH')]))
+  
+  start = time.perf_counter()
+  with open(log_file, 'a') as log:
+    log.write(" ".join(cmd) + "\n")
+    log.flush()
+    try:
+      proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT, env=env)
+    except OSError as e:
+      log.write("ERROR: %s\n" % e)
+      return {'returncode': 127, 'seconds': time.perf_counter() - start, 'peak_mb': None}
     
-    params['specPrecMapFile'] = os.path.join(output_folder, baseFN + ".feature_map.tsv")
-    if not os.path.isfile(params['specPrecMapFile']):
-      quant.add_accurate_precursors(dinosaur_output_file, mzml_fn, output_fn, params)
-      if output_fn.endswith(".dummy.txt"):
-        os.remove(output_fn)
+    peak_mb = None
+    if hasattr(os, 'wait4'):
+      _, status, usage = os.wait4(proc.pid, 0)
+      proc.returncode = os.waitstatus_to_exitcode(status)
+      # ru_maxrss is in kilobytes, except on macOS
+      peak_mb = usage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
     else:
-      print("Found dinosaur mapping file at %s, remove this file to re-run Dinosaur on this file" % (params['specPrecMapFile']))
+      proc.wait()
+  return {'returncode': proc.returncode, 'seconds': time.perf_counter() - start, 'peak_mb': peak_mb}
+
+def format_step(step):
+  if step is None:
+    return "%8s %10s" % ("skipped", "")
+  peak = "%7.0f MB" % step['peak_mb'] if step['peak_mb'] is not None else "%10s" % "n/a"
+  return "%7.1fs %s" % (step['seconds'], peak)
+
+def report_run(result, dinosaurSlots=None):
+  if dinosaurSlots is None:
+    return
+  print("%-6s %s  dinosaur: %s  assignment: %s" % (result['status'], os.path.basename(result['mzml_fn']), format_step(result['dinosaur']), format_step(result['assignment'])))
+  if result['error']:
+    print("  ERROR: %s" % result['error'])
+  sys.stdout.flush()
+
+def print_report(results, seconds):
+  print("")
+  print("%-40s %-6s %19s %19s" % ("run", "status", "dinosaur", "assignment"))
+  for result in results:
+    print("%-40s %-6s %s %s" % (os.path.basename(result['mzml_fn'])[-40:], result['status'], format_step(result['dinosaur']), format_step(result['assignment'])))
+    if result['error']:
+      print("  ERROR: %s" % result['error'])
+  print("Processed %d runs in %.1f s, %d failed" % (len(results), seconds, sum(r['status'] == "failed" for r in results)))
  
     
 if __name__ == '__main__':
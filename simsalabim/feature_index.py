@@ -0,0 +1,134 @@
+##############################################################
+## index over MS1 features for precursor assignment         ##
+##                                                          ##
+## answers "feature m/z in [lower, upper] and query RT      ##
+## strictly inside the feature's RT span" queries for the   ##
+## spectra of a run in RT order, with a sweep line over the ##
+## features' RT spans that only keeps the currently eluting ##
+## features in m/z order. query_batch resolves the queries  ##
+## of a whole run with vectorized searches                  ##
+##############################################################
+
+import numpy as np
+
+
+# queries per vectorized search in query_batch, the features opening within their RT range are searched as well
+QUERY_BATCH_SIZE = 256
+
+
+class FeatureSweep:
+    """Sweep line over features that are read in the order of their left RT border, for queries with
+    non-decreasing RTs, as for the spectra of an mzML file.
+
+    open_features() returns an iterator over chunks of the features sorted by rt_left, structured arrays
+    with the fields mz, rt_left, rt_right and mz_rank, the position of the feature in m/z order. Features
+    enter the active set when the query RT passes their left RT border and leave it at their right border,
+    so besides the current chunk only the concurrently eluting features are kept in memory. A query with
+    a smaller RT than the previous one restarts the sweep with a new iterator.
+    """
+    def __init__(self, open_features):
+        self.open_features = open_features
+        self.reset()
+
+    def reset(self):
+        self.rt = -np.inf
+        self.chunks = self.open_features()
+        # features of the current chunk that did not open yet
+        self.pending = next(self.chunks)
+        # active features sorted by mz_rank, which is also m/z order
+        self.active = np.empty(0, dtype=self.pending.dtype)
+        self.active_mz = np.empty(0, dtype=np.float64)
+        self.next_closing = np.inf
+
+    def advance(self, rt):
+        """Moves the sweep line to rt, a feature is active if rt_left < rt < rt_right"""
+        if rt < self.rt:
+            self.reset()
+        self.rt = rt
+
+        opened = self.take_opened(rt)
+        if len(opened) == 0 and rt < self.next_closing:
+            return
+
+        active = self.active
+        if rt >= self.next_closing:
+            active = active[active['rt_right'] > rt]
+        if len(opened) > 0:
+            opened = opened[opened['rt_right'] > rt]
+            active = merge_by_mz(active, opened)
+        self.set_active(active)
+
+    def take_opened(self, rt):
+        """Removes the features with rt_left < rt from the pending features and returns them"""
+        opened = list()
+        while True:
+            num_opened = int(self.pending['rt_left'].searchsorted(rt, side='left'))
+            opened.append(self.pending[:num_opened])
+            self.pending = self.pending[num_opened:]
+            if len(self.pending) > 0:
+                break
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.pending = chunk
+        return np.concatenate(opened) if len(opened) > 1 else opened[0]
+
+    def set_active(self, active):
+        self.active = active
+        self.active_mz = np.ascontiguousarray(active['mz'])
+        self.next_closing = float(active['rt_right'].min()) if len(active) > 0 else np.inf
+
+    def query(self, lower, upper, rt):
+        """Returns the features with lower <= mz <= upper and rt_left < rt < rt_right in m/z order"""
+        self.advance(rt)
+        start = self.active_mz.searchsorted(lower, side='left')
+        end = self.active_mz.searchsorted(upper, side='right')
+        return self.active[start:end]
+
+    def query_batch(self, lowers, uppers, rts, batchSize=QUERY_BATCH_SIZE):
+        """Resolves queries sorted by RT at once, returns (offsets, features) with the features of query i in
+        features[offsets[i]:offsets[i+1]], in the same order as query returns them"""
+        lowers = np.asarray(lowers, dtype=np.float64)
+        uppers = np.asarray(uppers, dtype=np.float64)
+        rts = np.asarray(rts, dtype=np.float64)
+        if np.any(rts[1:] < rts[:-1]):
+            raise ValueError("query_batch needs the queries sorted by RT")
+
+        counts = np.zeros(len(rts), dtype=np.int64)
+        found = [np.empty(0, dtype=self.active.dtype)]
+        for start in range(0, len(rts), batchSize):
+            end = min(start + batchSize, len(rts))
+            self.advance(rts[start])
+            # the features that are active at any RT of the batch, the exact RT check follows the m/z search
+            last_rt = rts[end - 1]
+            candidates = merge_by_mz(self.active, self.take_opened(last_rt))
+            candidate_mz = np.ascontiguousarray(candidates['mz'])
+            queries, positions = expand_ranges(np.arange(start, end),
+                                               candidate_mz.searchsorted(lowers[start:end], side='left'),
+                                               candidate_mz.searchsorted(uppers[start:end], side='right'))
+            matches = candidates[positions]
+            keep = (matches['rt_left'] < rts[queries]) & (rts[queries] < matches['rt_right'])
+            counts += np.bincount(queries[keep], minlength=len(rts))
+            found.append(matches[keep])
+
+            self.rt = last_rt
+            self.set_active(candidates[candidates['rt_right'] > last_rt])
+
+        offsets = np.zeros(len(rts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return offsets, np.concatenate(found)
+
+
+def merge_by_mz(active, opened):
+    if len(opened) == 0:
+        return active
+    merged = np.concatenate([active, opened])
+    return merged[np.argsort(merged['mz_rank'], kind='stable')]
+
+
+def expand_ranges(queries, starts, ends):
+    """Returns (query, position) pairs for all positions in [starts[i], ends[i]) of each query"""
+    counts = np.maximum(ends - starts, 0)
+    query_idxs = np.repeat(queries, counts)
+    positions = np.arange(int(counts.sum())) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(starts, counts)
+    return query_idxs, positions
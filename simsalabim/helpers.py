@@ -1,6 +1,9 @@
 import sys
 import os
+import io
 import subprocess
+import threading
+import queue
 
 ### command line helpers ###
 
@@ -19,6 +22,9 @@ def executeCmd(cmd):
 ### IO helpers ###
 
 def openVersionSafe(filename, flag):
+  if getCompression(filename):
+    return openCompressed(filename, flag)
+  
   # Python 3
   if sys.version_info[0] >= 3:
     if 'b' in flag:
@@ -29,6 +35,173 @@ def openVersionSafe(filename, flag):
   else:
     return open(filename, flag + 'b')
     
+COMPRESSION_SUFFIXES = ('.gz', '.bz2', '.xz', '.zst')
+COMPRESSION_CHUNK_SIZE = 1024 * 1024
+
+def getCompression(filename):
+  ext = getExt(filename).lower()
+  return ext if ext in COMPRESSION_SUFFIXES else None
+
+def stripCompressionExt(filename):
+  return getBase(filename) if getCompression(filename) else filename
+
+def openCompressedStream(filename, flag):
+  compression = getCompression(filename)
+  if compression == '.gz':
+    import gzip
+    return gzip.open(filename, flag)
+  elif compression == '.bz2':
+    import bz2
+    return bz2.open(filename, flag)
+  elif compression == '.xz':
+    import lzma
+    return lzma.open(filename, flag)
+  elif compression == '.zst':
+    try:
+      import zstandard
+    except ImportError:
+      sys.exit("ERROR: Reading or writing .zst files requires the zstandard package: pip install zstandard")
+    return zstandard.open(filename, flag)
+
+def openCompressed(filename, flag):
+  # (de)compression runs in a background thread, so that it overlaps with parsing and formatting
+  binaryFlag = flag.replace('b', '').replace('t', '') + 'b'
+  if 'r' in flag:
+    stream = io.BufferedReader(ThreadedReader(openCompressedStream(filename, binaryFlag)), COMPRESSION_CHUNK_SIZE)
+  else:
+    stream = io.BufferedWriter(ThreadedWriter(openCompressedStream(filename, binaryFlag)), COMPRESSION_CHUNK_SIZE)
+  
+  if 'b' in flag:
+    return stream
+  return io.TextIOWrapper(stream, newline = '')
+
+class ThreadedReader(io.RawIOBase):
+  def __init__(self, stream, maxChunks = 8):
+    self.stream = stream
+    self.chunks = queue.Queue(maxChunks)
+    self.buffer = b''
+    self.eof = False
+    self.error = None
+    self.stopped = threading.Event()
+    self.thread = threading.Thread(target = self._read, daemon = True)
+    self.thread.start()
+  
+  def _read(self):
+    try:
+      while not self.stopped.is_set():
+        chunk = self.stream.read(COMPRESSION_CHUNK_SIZE)
+        self._put(chunk)
+        if not chunk:
+          break
+    except Exception as e:
+      self.error = e
+      self._put(b'')
+  
+  def _put(self, chunk):
+    while not self.stopped.is_set():
+      try:
+        self.chunks.put(chunk, timeout = 0.1)
+        return
+      except queue.Full:
+        continue
+  
+  def readable(self):
+    return True
+  
+  def readinto(self, b):
+    if not self.buffer:
+      if not self.eof:
+        self.buffer = self.chunks.get()
+        self.eof = not self.buffer
+      if self.eof:
+        # the producer puts an empty chunk after a failure, keep raising its error on every later read
+        if self.error is not None:
+          raise self.error
+        return 0
+    n = min(len(b), len(self.buffer))
+    b[:n] = self.buffer[:n]
+    self.buffer = self.buffer[n:]
+    return n
+  
+  def close(self):
+    if not self.closed:
+      self.stopped.set()
+      self.thread.join()
+      self.stream.close()
+    super().close()
+
+class ThreadedWriter(io.RawIOBase):
+  def __init__(self, stream, maxChunks = 8):
+    self.stream = stream
+    self.chunks = queue.Queue(maxChunks)
+    self.error = None
+    self.thread = threading.Thread(target = self._write, daemon = True)
+    self.thread.start()
+  
+  def _write(self):
+    while True:
+      chunk = self.chunks.get()
+      if chunk is None:
+        break
+      if self.error is None:
+        try:
+          self.stream.write(chunk)
+        except Exception as e:
+          self.error = e
+  
+  def writable(self):
+    return True
+  
+  def write(self, b):
+    if self.error is not None:
+      raise self.error
+    self.chunks.put(bytes(b))
+    return len(b)
+  
+  def close(self):
+    if not self.closed:
+      self.chunks.put(None)
+      self.thread.join()
+      self.stream.close()
+      if self.error is not None:
+        raise self.error
+    super().close()
+    
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+class BufferedTextWriter:
+  """Collects small writes and passes them on to the output stream in chunks of about bufferSize characters"""
+  def __init__(self, stream, bufferSize = WRITE_BUFFER_SIZE):
+    self.stream = stream
+    self.bufferSize = bufferSize
+    self.parts = list()
+    self.size = 0
+  
+  def write(self, s):
+    self.parts.append(s)
+    self.size += len(s)
+    if self.size >= self.bufferSize:
+      self.flush()
+  
+  def flush(self):
+    if self.parts:
+      self.stream.write("".join(self.parts))
+      self.parts, self.size = list(), 0
+    self.stream.flush()
+  
+  def close(self):
+    self.flush()
+    self.stream.close()
+
+def getFileHash(filename, blockSize = COMPRESSION_CHUNK_SIZE):
+  """Returns the SHA-1 hex digest of the file's (compressed) contents"""
+  import hashlib
+  sha1 = hashlib.sha1()
+  with open(filename, 'rb') as f:
+    for block in iter(lambda: f.read(blockSize), b''):
+      sha1.update(block)
+  return sha1.hexdigest()
+
 def createDir(directory):
   if not os.path.isdir(directory):
     os.makedirs(directory)
@@ -8,9 +8,16 @@
 import sys
 import os
 
-from .spectrum import Spectrum
+from .spectrum import Spectrum, peaks_from_text
 from .precursor import Precursor
 from . import helpers
+from . import spectrum_index
+from . import block_reader
+from . import parallel_parser
+
+
+MGF_RECORD_START = b'BEGIN IONS'
+MGF_RECORD_END = b'END IONS'
 
 
 def parseMgfHeaders(inputFile):
@@ -21,39 +28,84 @@ def parseMgfHeaders(inputFile):
       else:
         break
 
-def parse_mgf(inputFile, storeFragmentIons = False):
+def parse_mgf(inputFile, storeFragmentIons = False, reader = "lines", workers = 1, spectrumFilter = None):
   if not os.path.isfile(inputFile):
     sys.exit("ERROR: Could not open mgf file: " + inputFile)
   
-  if not inputFile.lower().endswith(".mgf"):
+  if not helpers.stripCompressionExt(inputFile).lower().endswith(".mgf"):
     sys.exit("ERROR: File does not have the .mgf file extension: " + inputFile)
   
+  # with an up to date sidecar index, records rejected by the filter are not even read
+  index = spectrum_index.load_existing_index(inputFile, parse_mgf_header, MGF_RECORD_END) if spectrumFilter and spectrumFilter.uses_index() else None
+  if index:
+    yield from index.iter_filtered(spectrumFilter, storeFragmentIons)
+  elif workers > 1 and not helpers.getCompression(inputFile):
+    yield from parallel_parser.parse_parallel(inputFile, MGF_RECORD_START, parse_mgf_header, storeFragmentIons, MGF_RECORD_END, workers, spectrumFilter = spectrumFilter)
+  elif reader == "lines":
+    with helpers.openVersionSafe(inputFile, 'r') as f:
+      yield from parse_mgf_lines(f, storeFragmentIons, spectrumFilter)
+  else:
+    records = block_reader.iter_records(inputFile, MGF_RECORD_START, useMmap = (reader == "mmap"))
+    yield from block_reader.parse_records(records, parse_mgf_header, storeFragmentIons, MGF_RECORD_END, spectrumFilter)
+
+def parse_mgf_lines(lines, storeFragmentIons = False, spectrumFilter = None):
+  # peak lines are only collected here and converted in one batch per spectrum
+  headerLines, peakLines = list(), list()
+  for line in lines:
+    if line[:1].isdigit():
+      if storeFragmentIons:
+        peakLines.append(line)
+    elif line.startswith('BEGIN IONS'):
+      headerLines, peakLines = list(), list()
+    elif line.startswith('END IONS'):
+      header = parse_mgf_header(headerLines)
+      if header:
+        scannr, raw_file, rtime, precursors = header
+        if not spectrumFilter or spectrumFilter.accepts(scannr, rtime, precursors):
+          fragmentIons = peaks_from_text("".join(peakLines)) if storeFragmentIons else None
+          yield Spectrum(scannr, precursors, fragmentIons, rtime=rtime)
+      headerLines, peakLines = list(), list()
+    else:
+      headerLines.append(line)
+
+def parse_mgf_header(headerLines):
   scannr = -1
-  rtime = 0.0
-  fragmentIons = list() if storeFragmentIons else None
-  with open(inputFile, 'r') as f:
-    for line in f:
-      if line.startswith('TITLE'):
-        fields = line.split('=')
-        if len(fields) > 2:
-          scannr = int(line.split('=')[2].split("\"")[0])
-        else:
-          #scannr = int(line.split('=')[1].split("[")[0])
-          scannr = int(line.split('=')[1].split(".")[1])
-      elif line.startswith('SCANS'):
-        scannr = int(line.split('=')[1])
-      elif line.startswith('RTINSECONDS'):
-        rtime = float(line.split('=')[1])
-      elif line.startswith('PEPMASS'):
-        fields = line.split('=')[1].split()
-        pepmz = float(fields[0])
-        intensity = None if len(fields) <= 1 else float(fields[1])
-      elif line.startswith('CHARGE'):
-        charge = int(line.split('=')[1][0])
-      elif line[0].isdigit():
-        fragmentIons.append(map(float, line.split()))
-      elif line.startswith('END IONS'):
-        if scannr != -1:
-          yield Spectrum(scannr, [{'mz': pepmz, 'charge': charge, 'intensity': intensity}], fragmentIons)
-        fragmentIons = list() if storeFragmentIons else None
+  rtime = None
+  for line in headerLines:
+    if line.startswith('TITLE'):
+      fields = line.split('=')
+      if len(fields) > 2:
+        scannr = int(line.split('=')[2].split("\"")[0])
+      else:
+        #scannr = int(line.split('=')[1].split("[")[0])
+        scannr = int(line.split('=')[1].split(".")[1])
+    elif line.startswith('SCANS'):
+      scannr = int(line.split('=')[1])
+    elif line.startswith('RTINSECONDS'):
+      rtime = float(line.split('=')[1])
+    elif line.startswith('PEPMASS'):
+      fields = line.split('=')[1].split()
+      pepmz = float(fields[0])
+      intensity = None if len(fields) <= 1 else float(fields[1])
+    elif line.startswith('CHARGE'):
+      charge = int(line.split('=')[1][0])
+  
+  if scannr == -1:
+    return None
+  
+  return scannr, None, rtime, [Precursor(rtime, pepmz, charge, intensity)]
+
+def parse_mgf_metadata(inputFile, reader = "mmap"):
+  # peak blocks are skipped without decoding, only their lines are counted
+  records = block_reader.iter_records(inputFile, MGF_RECORD_START, useMmap = (reader == "mmap"))
+  yield from block_reader.parse_record_headers(records, parse_mgf_header, MGF_RECORD_END)
+
+def load_mgf_index(inputFile):
+  return spectrum_index.load_index(inputFile, MGF_RECORD_START, parse_mgf_header, MGF_RECORD_END)
+
+def get_by_scan(inputFile, scannr, storeFragmentIons = True):
+  return next(iter_scans(inputFile, [scannr], storeFragmentIons), None)
 
+def iter_scans(inputFile, scannrs, storeFragmentIons = True):
+  # seeks directly to the requested records using the sidecar index
+  yield from load_mgf_index(inputFile).iter_scans(scannrs, None, storeFragmentIons)
@@ -1,18 +1,34 @@
 import sys
 
 from . import helpers
+from .spectrum import peaks_to_text
 
 
 class MgfWriter:
     def __init__(self, output_stream):
-        self.mgf_writer = output_stream
+        self.mgf_writer = helpers.BufferedTextWriter(output_stream)
     
     def write(self, spectra):
+        self.start()
         for i, spectrum in enumerate(spectra):
-            if spectrum.get_ms_level() == 2:
-                self.write_mgf_spectrum(**spectrum.spectrum)
+            self.write_spectrum(spectrum)
             if i % 1000 == 0:
                 print("Handled %d spectra" % (i, ))
+        self.finish()
+    
+    def start(self):
+        pass
+    
+    def write_spectrum(self, spectrum):
+        if spectrum.ms_level == 2:
+            self.write_mgf_spectrum(**spectrum.spectrum)
+    
+    def finish(self):
+        self.flush()
+    
+    def flush(self):
+        """Writes out the buffered spectra, needed after calling write_mgf_spectrum directly"""
+        self.mgf_writer.flush()
 
     def write_mgf_spectrum(self, mz_array=None, intensity_array=None, charge_array=None, id=None,
              polarity='positive scan', centroided=True, precursor_information=None,
@@ -40,7 +56,5 @@ class MgfWriter:
             self.mgf_writer.write("CHARGE=%d+\n" % (p['charge']))
             self.mgf_writer.write("SCANS=%d\n" % (idx))
             
-            for a, b in zip(mz_array, intensity_array):
-                self.mgf_writer.write("%f %f\n" % (a, b))
-            
+            self.mgf_writer.write(peaks_to_text(mz_array, intensity_array))
             self.mgf_writer.write("END IONS\n")
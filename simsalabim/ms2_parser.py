@@ -9,9 +9,16 @@
 import sys
 import os
 
-from .spectrum import Spectrum
+from .spectrum import Spectrum, peaks_from_text
 from .precursor import Precursor
 from . import helpers
+from . import spectrum_index
+from . import block_reader
+from . import parallel_parser
+
+
+MS2_RECORD_START = b'S'
+MS2_RECORD_END = None
     
 def parseMs2Headers(inputFile):
   with open(inputFile, 'r') as f:
@@ -22,51 +29,102 @@ def parseMs2Headers(inputFile):
         break
 
 
-def parse_ms2(inputFile, storeFragmentIons = False):  
+def parse_ms2(inputFile, storeFragmentIons = False, reader = "lines", workers = 1, spectrumFilter = None):  
   if not os.path.isfile(inputFile):
     sys.exit("ERROR: Could not open ms2 file: " + inputFile)
   
-  if not inputFile.lower().endswith(".ms2"):
+  if not helpers.stripCompressionExt(inputFile).lower().endswith(".ms2"):
     sys.exit("ERROR: File does not have the .ms2 file extension: " + inputFile)
   
+  # with an up to date sidecar index, records rejected by the filter are not even read
+  index = spectrum_index.load_existing_index(inputFile, parse_ms2_header, MS2_RECORD_END) if spectrumFilter and spectrumFilter.uses_index() else None
+  if index:
+    yield from index.iter_filtered(spectrumFilter, storeFragmentIons)
+  elif workers > 1 and not helpers.getCompression(inputFile):
+    yield from parallel_parser.parse_parallel(inputFile, MS2_RECORD_START, parse_ms2_header, storeFragmentIons, MS2_RECORD_END, workers, spectrumFilter = spectrumFilter)
+  elif reader == "lines":
+    with helpers.openVersionSafe(inputFile, 'r') as f:
+      yield from parse_ms2_lines(f, storeFragmentIons, spectrumFilter)
+  else:
+    records = block_reader.iter_records(inputFile, MS2_RECORD_START, useMmap = (reader == "mmap"))
+    yield from block_reader.parse_records(records, parse_ms2_header, storeFragmentIons, MS2_RECORD_END, spectrumFilter)
+
+def parse_ms2_lines(lines, storeFragmentIons = False, spectrumFilter = None):
+  # peak lines are only collected here and converted in one batch per spectrum
+  headerLines, peakLines = list(), list()
+  for line in lines:
+    if line[:1].isdigit():
+      if storeFragmentIons:
+        peakLines.append(line)
+    elif line.startswith('S'):
+      if headerLines:
+        spectrum = make_ms2_spectrum(headerLines, peakLines, storeFragmentIons, spectrumFilter)
+        if spectrum is not None:
+          yield spectrum
+      headerLines, peakLines = [line], list()
+    elif line.startswith('H'):
+      continue
+    else:
+      headerLines.append(line)
+  
+  if headerLines:
+    spectrum = make_ms2_spectrum(headerLines, peakLines, storeFragmentIons, spectrumFilter)
+    if spectrum is not None:
+      yield spectrum
+
+def make_ms2_spectrum(headerLines, peakLines, storeFragmentIons, spectrumFilter = None):
+  """Returns None if the spectrum is rejected by spectrumFilter"""
+  scannr, raw_file, rtime, precursors = parse_ms2_header(headerLines)
+  if spectrumFilter and not spectrumFilter.accepts(scannr, rtime, precursors):
+    return None
+  fragmentIons = peaks_from_text("".join(peakLines)) if storeFragmentIons else None
+  return Spectrum(scannr, precursors, fragmentIons, rtime=rtime)
+
+def parse_ms2_header(headerLines):
   scannr = -1
+  rtime = None
   ezLines = list()
-  fragmentIons = list() if storeFragmentIons else None
   hasEZ = False
-  with open(inputFile, 'r') as f:
-    for line in f:
-      if line.startswith('S'):
-        if scannr != -1:
-          yield Spectrum(scannr, ezLines, fragmentIons)
-        fragmentIons = list() if storeFragmentIons else None
-        scannr = int(line.split('\t')[1])
-        ezLines = list()
-      elif line.startswith('Z'):
-        if not hasEZ:
-          charge = int(line.split('\t')[1])
-          pepmass = float(line.split('\t')[2])
-          pepmz = precMzFromPrecMass(pepmass, charge)
-          intensity = None
-          ezLines.append({'mz': pepmz, 'charge': charge, 'intensity': intensity})
-      elif line.startswith('I\tRTime'):
-        rtime = float(line.split('\t')[2])
-      elif line.startswith('I\tEZ'):
-        fields = line.split('\t')
-        charge = int(fields[2])
-        pepmass = float(fields[3])
-        rtimeTmp = float(fields[4])
-        intensity = float(fields[5])
-        if rtimeTmp != 0.0:
-          rtime = rtimeTmp
-        pepmz = precMzFromPrecMass(pepmass, charge)
-        if not hasEZ:
-          ezLines = list()
-        hasEZ = True
+  for line in headerLines:
+    if line.startswith('S'):
+      scannr = int(line.split('\t')[1])
+    elif line.startswith('Z'):
+      if not hasEZ:
+        charge = int(line.split('\t')[1])
+        pepmass = float(line.split('\t')[2])
+        pepmz = helpers.precMzFromPrecMass(pepmass, charge)
+        intensity = None
         ezLines.append(Precursor(rtime, pepmz, charge, intensity))
-      elif line.startswith('I') or line.startswith('H'):
-        continue
-      elif storeFragmentIons:
-        fragmentIons.append(map(float, line.split()))
-    
-    if scannr != -1:
-      yield Spectrum(scannr, ezLines, fragmentIons)
+    elif line.startswith('I\tRTime'):
+      rtime = float(line.split('\t')[2])
+    elif line.startswith('I\tEZ'):
+      fields = line.split('\t')
+      charge = int(fields[2])
+      pepmass = float(fields[3])
+      rtimeTmp = float(fields[4])
+      intensity = float(fields[5])
+      if rtimeTmp != 0.0:
+        rtime = rtimeTmp
+      pepmz = helpers.precMzFromPrecMass(pepmass, charge)
+      if not hasEZ:
+        ezLines = list()
+      hasEZ = True
+      ezLines.append(Precursor(rtime, pepmz, charge, intensity))
+  
+  # retention times in the MS2 format are in minutes
+  return scannr, None, None if rtime is None else rtime*60, ezLines
+
+def parse_ms2_metadata(inputFile, reader = "mmap"):
+  # peak blocks are skipped without decoding, only their lines are counted
+  records = block_reader.iter_records(inputFile, MS2_RECORD_START, useMmap = (reader == "mmap"))
+  yield from block_reader.parse_record_headers(records, parse_ms2_header, MS2_RECORD_END)
+
+def load_ms2_index(inputFile):
+  return spectrum_index.load_index(inputFile, MS2_RECORD_START, parse_ms2_header, MS2_RECORD_END)
+
+def get_by_scan(inputFile, scannr, storeFragmentIons = True):
+  return next(iter_scans(inputFile, [scannr], storeFragmentIons), None)
+
+def iter_scans(inputFile, scannrs, storeFragmentIons = True):
+  # seeks directly to the requested records using the sidecar index
+  yield from load_ms2_index(inputFile).iter_scans(scannrs, None, storeFragmentIons)
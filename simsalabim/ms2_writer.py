@@ -1,19 +1,34 @@
 import os
 
 from . import helpers
+from .spectrum import peaks_to_text
 
 
 class Ms2Writer:
   def __init__(self, output_stream):
-      self.ms2_writer = output_stream
+      self.ms2_writer = helpers.BufferedTextWriter(output_stream)
   
   def write(self, spectra):
-      self.write_ms2_headers()
+      self.start()
       for i, spectrum in enumerate(spectra):
-          if spectrum.get_ms_level() == 2:
-              self.write_ms2_spectrum(**spectrum.spectrum)
+          self.write_spectrum(spectrum)
           if i % 1000 == 0:
               print("Handled %d spectra" % (i, ))
+      self.finish()
+  
+  def start(self):
+      self.write_ms2_headers()
+  
+  def write_spectrum(self, spectrum):
+      if spectrum.ms_level == 2:
+          self.write_ms2_spectrum(**spectrum.spectrum)
+  
+  def finish(self):
+      self.flush()
+  
+  def flush(self):
+      """Writes out the buffered spectra, needed after calling write_ms2_spectrum directly"""
+      self.ms2_writer.flush()
 
   def write_ms2_spectrum(self, mz_array=None, intensity_array=None, charge_array=None, id=None,
        polarity='positive scan', centroided=True, precursor_information=None,
@@ -41,8 +56,7 @@ class Ms2Writer:
         self.ms2_writer.write("Z\t%d\t%f\n" % (p['charge'], fmass))
       
       if written_scan_number:
-        for a, b in zip(mz_array, intensity_array):
-          self.ms2_writer.write("%f %f\n" % (a, b))
+        self.ms2_writer.write(peaks_to_text(mz_array, intensity_array))
     
   def write_ms2_headers(self):
     from datetime import datetime
@@ -0,0 +1,130 @@
+import sys
+
+import numpy as np
+
+
+MZ_ARRAY = "m/z array"
+INTENSITY_ARRAY = "intensity array"
+CHARGE_ARRAY = "charge array"
+
+PRECISIONS = {
+    32: np.float32,
+    64: np.float64,
+}
+
+# command line name => psims compression name
+COMPRESSIONS = {
+    "none": "none",
+    "zlib": "zlib",
+    "numpress_linear": "MS-Numpress linear prediction compression",
+    "numpress_pic": "MS-Numpress positive integer compression",
+    "numpress_slof": "MS-Numpress short logged float compression",
+}
+
+# the encoding psims uses if none is specified
+DEFAULT_ENCODING = {
+    MZ_ARRAY: np.float64,
+    INTENSITY_ARRAY: np.float32,
+    CHARGE_ARRAY: np.int32,
+}
+DEFAULT_COMPRESSION = "zlib"
+
+
+class MzMLEncoding:
+    """Per-array precision and compression of the binary arrays in mzML output.
+
+    Options that are None keep the writer's default, or for transformed mzML files
+    the encoding of the input file.
+    """
+    __slots__ = ['mzPrecision', 'intensityPrecision', 'mzCompression', 'intensityCompression']
+
+    def __init__(self, mzPrecision=None, intensityPrecision=None, mzCompression=None, intensityCompression=None):
+        self.mzPrecision = mzPrecision
+        self.intensityPrecision = intensityPrecision
+        self.mzCompression = mzCompression
+        self.intensityCompression = intensityCompression
+        for compression in (mzCompression, intensityCompression):
+            if compression is not None and compression not in COMPRESSIONS:
+                sys.exit("ERROR: Unknown compression %s, choose from %s" % (compression, ", ".join(COMPRESSIONS.keys())))
+            if compression is not None and compression.startswith("numpress") and not has_numpress():
+                sys.exit("ERROR: MS-Numpress compression requires the pynumpress package: pip install pynumpress")
+
+    def __getstate__(self):
+        return [getattr(self, name) for name in self.__slots__]
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    def __repr__(self):
+        return "MzMLEncoding(mz=%s/%s, intensity=%s/%s)" % (self.mzPrecision, self.mzCompression, self.intensityPrecision, self.intensityCompression)
+
+    def apply(self, kwargs):
+        """Sets the encoding and compression in the keyword arguments of a write_spectrum call"""
+        encoding = dict(DEFAULT_ENCODING)
+        encoding.update({k: v for k, v in (kwargs.get('encoding') or {}).items() if v is not None})
+        if self.mzPrecision is not None:
+            encoding[MZ_ARRAY] = PRECISIONS[self.mzPrecision]
+        if self.intensityPrecision is not None:
+            encoding[INTENSITY_ARRAY] = PRECISIONS[self.intensityPrecision]
+        kwargs['encoding'] = encoding
+
+        compression = kwargs.get('compression')
+        if not isinstance(compression, dict):
+            compression = {array: compression or DEFAULT_COMPRESSION for array in DEFAULT_ENCODING}
+        if self.mzCompression is not None:
+            compression[MZ_ARRAY] = COMPRESSIONS[self.mzCompression]
+        if self.intensityCompression is not None:
+            compression[INTENSITY_ARRAY] = COMPRESSIONS[self.intensityCompression]
+        kwargs['compression'] = compression
+        return kwargs
+
+
+def has_numpress():
+    try:
+        import pynumpress
+        return True
+    except ImportError:
+        return False
+
+
+def add_encoding_arguments(apars):
+    apars.add_argument('--mz_precision', default = None, metavar='P', type=int, choices=sorted(PRECISIONS.keys()),
+                                         help='''float precision of the m/z arrays in mzML output, 32 or 64 bit (default: 64
+                                                         or, for mzML input, the precision of the input).
+                                                    ''')
+
+    apars.add_argument('--intensity_precision', default = None, metavar='P', type=int, choices=sorted(PRECISIONS.keys()),
+                                         help='''float precision of the intensity arrays in mzML output, 32 or 64 bit (default: 32
+                                                         or, for mzML input, the precision of the input).
+                                                    ''')
+
+    apars.add_argument('--mz_compression', default = None, metavar='C', choices=COMPRESSIONS.keys(),
+                                         help='''compression of the m/z arrays in mzML output: %s (default: zlib).
+                                                         MS-Numpress requires the pynumpress package.
+                                                    ''' % ", ".join(COMPRESSIONS.keys()))
+
+    apars.add_argument('--intensity_compression', default = None, metavar='C', choices=COMPRESSIONS.keys(),
+                                         help='''compression of the intensity arrays in mzML output: %s (default: zlib).
+                                                         numpress_slof is a lossy, but compact encoding for intensities.
+                                                    ''' % ", ".join(COMPRESSIONS.keys()))
+
+
+def get_encoding_arguments(encoding):
+    """Returns the command line arguments for an MzMLEncoding, e.g. to pass it on to a subprocess"""
+    if encoding is None:
+        return []
+    arguments = list()
+    for option, value in [('--mz_precision', encoding.mzPrecision), ('--intensity_precision', encoding.intensityPrecision),
+                          ('--mz_compression', encoding.mzCompression), ('--intensity_compression', encoding.intensityCompression)]:
+        if value is not None:
+            arguments += [option, str(value)]
+    return arguments
+
+
+def get_encoding(args):
+    """Returns None if no encoding options were given, so that the writers keep their defaults"""
+    options = [args.mz_precision, args.intensity_precision, args.mz_compression, args.intensity_compression]
+    if all(option is None for option in options):
+        return None
+    return MzMLEncoding(*options)
@@ -0,0 +1,464 @@
+##############################################################
+## templated indexed-mzML writer                            ##
+##                                                          ##
+## takes the same arguments as psims' write_spectrum, but   ##
+## emits precomputed XML fragments and tracks the byte      ##
+## offsets of the spectra itself, which are written to the  ##
+## indexList together with the SHA-1 file checksum.         ##
+## the number of spectra has to be known up front, as the   ##
+## output is written as a single checksummed stream         ##
+##############################################################
+
+import re
+import zlib
+import base64
+import hashlib
+from xml.sax.saxutils import escape, quoteattr
+
+import numpy as np
+
+from .simsalabim import __version__
+from .spectrum import Spectrum
+from .mzml_encoding import DEFAULT_ENCODING, DEFAULT_COMPRESSION
+
+
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+PSI_MS_URI = "http://purl.obolibrary.org/obo/ms/psi-ms.obo"
+UO_URI = "http://purl.obolibrary.org/obo/uo.obo"
+
+# terms used by the writer itself, other terms are looked up in the psims vocabularies
+COMMON_TERMS = {
+    "MS:1000511": "ms level",
+    "MS:1000130": "positive scan",
+    "MS:1000129": "negative scan",
+    "MS:1000127": "centroid spectrum",
+    "MS:1000128": "profile spectrum",
+    "MS:1000579": "MS1 spectrum",
+    "MS:1000580": "MSn spectrum",
+    "MS:1000795": "no combination",
+    "MS:1000016": "scan start time",
+    "MS:1000501": "scan window lower limit",
+    "MS:1000500": "scan window upper limit",
+    "MS:1000744": "selected ion m/z",
+    "MS:1000041": "charge state",
+    "MS:1000633": "possible charge state",
+    "MS:1000042": "peak intensity",
+    "MS:1000827": "isolation window target m/z",
+    "MS:1000828": "isolation window lower offset",
+    "MS:1000829": "isolation window upper offset",
+    "MS:1000514": "m/z array",
+    "MS:1000515": "intensity array",
+    "MS:1000516": "charge array",
+    "MS:1000574": "zlib compression",
+    "MS:1000576": "no compression",
+    "MS:1002312": "MS-Numpress linear prediction compression",
+    "MS:1002313": "MS-Numpress positive integer compression",
+    "MS:1002314": "MS-Numpress short logged float compression",
+    "MS:1000519": "32-bit integer",
+    "MS:1000522": "64-bit integer",
+    "MS:1000523": "64-bit float",
+    "MS:1000521": "32-bit float",
+    "MS:1000040": "m/z",
+    "MS:1000131": "number of detector counts",
+    "UO:0000010": "second",
+    "UO:0000031": "minute",
+    "UO:0000266": "electronvolt",
+    "UO:0000187": "percent",
+}
+TERM_ACCESSIONS = {name: accession for accession, name in COMMON_TERMS.items()}
+
+ISOLATION_WINDOW_KEYS = {
+    "target": "isolation window target m/z",
+    "lower": "isolation window lower offset",
+    "upper": "isolation window upper offset",
+}
+
+ARRAY_TERMS = {
+    "m/z array": ("m/z", "m/z array"),
+    "intensity array": ("number of detector counts", "intensity array"),
+    "charge array": (None, "charge array"),
+}
+
+DTYPE_TERMS = {
+    np.dtype(np.float64): "64-bit float",
+    np.dtype(np.float32): "32-bit float",
+    np.dtype(np.int64): "64-bit integer",
+    np.dtype(np.int32): "32-bit integer",
+}
+
+COMPRESSION_TERMS = {
+    "none": "no compression",
+    "zlib": "zlib compression",
+}
+
+_vocabularies = dict()
+
+
+def lookup_term(key):
+    """Returns the (accession, name) of a controlled vocabulary term given by name or accession"""
+    if key in COMMON_TERMS:
+        return key, COMMON_TERMS[key]
+    if key in TERM_ACCESSIONS:
+        return TERM_ACCESSIONS[key], key
+
+    # loading the vocabularies takes about a second, so this only happens for uncommon terms
+    from psims.controlled_vocabulary.controlled_vocabulary import load_psims, load_uo
+    for loader in (load_psims, load_uo):
+        if loader not in _vocabularies:
+            _vocabularies[loader] = loader()
+        try:
+            term = _vocabularies[loader][key]
+            return term.id, term.name
+        except KeyError:
+            continue
+    raise KeyError("Unknown controlled vocabulary term: %s" % key)
+
+
+def format_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, (bool, np.bool_)):
+        return "true" if value else "false"
+    if isinstance(value, (float, np.floating)):
+        return repr(float(value))
+    if isinstance(value, (int, np.integer)):
+        return str(int(value))
+    return str(value)
+
+
+def encode_array(array, dtype, compression):
+    if compression.startswith("MS-Numpress"):
+        from psims.mzml.binary_encoding import encode_array as encode_numpress
+        return encode_numpress(array, compression, dtype)
+    data = np.asarray(array, dtype=np.dtype(dtype).newbyteorder('<')).tobytes()
+    if compression == "zlib":
+        data = zlib.compress(data)
+    return base64.b64encode(data)
+
+
+def read_mzml_metadata(inputFile):
+    """Returns the raw XML between the <mzML> start tag and the <run> element of an mzML file"""
+    from . import helpers
+    head = b''
+    with helpers.openVersionSafe(inputFile, 'rb') as f:
+        while b'<run' not in head:
+            block = f.read(1024 * 1024)
+            if not block:
+                break
+            head += block
+    mzml_start = re.search(rb'<mzML\b[^>]*>', head)
+    run_start = head.find(b'<run')
+    if not mzml_start or run_start == -1:
+        return None
+    return head[mzml_start.end():run_start].decode('utf-8')
+
+
+class FastMzMLWriter:
+    """Indexed mzML writer with the same start / write_spectrum / finish interface as MzMLWriter2.
+
+    numSpectra is the number of spectra that will be written, which goes into the
+    spectrumList count before the first spectrum, write() takes it from the length
+    of its spectra if not given. metadata is the raw XML of the file level
+    elements (cvList up to the run), e.g. from read_mzml_metadata, by default a minimal
+    description of a converted file is written. array_encoding is an MzMLEncoding with
+    the precision and compression of the binary arrays.
+    """
+    def __init__(self, output_stream, metadata=None, numSpectra=None, array_encoding=None):
+        self.output_stream = output_stream
+        self.metadata = metadata
+        self.numSpectra = numSpectra
+        self.array_encoding = array_encoding
+        self.offset = 0
+        self.parts = list()
+        self.buffered_size = 0
+        self.checksum = hashlib.sha1()
+        self.spectrum_offsets = list()
+        self.cv_psims = "PSI-MS"
+        self.cv_uo = "UO"
+        self.templates = dict()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.finish()
+
+    def write(self, spectra):
+        if self.numSpectra is None and hasattr(spectra, '__len__'):
+            self.numSpectra = len(spectra)
+        self.start()
+        for i, spectrum in enumerate(spectra):
+            self.write_spectrum(spectrum)
+            if i % 1000 == 0:
+                print("Handled %d spectra" % (i, ))
+        self.finish()
+
+    def emit(self, text):
+        data = text.encode('utf-8')
+        self.parts.append(data)
+        self.checksum.update(data)
+        self.offset += len(data)
+        self.buffered_size += len(data)
+        if self.buffered_size >= WRITE_BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.parts:
+            self.output_stream.write(b''.join(self.parts))
+            self.parts, self.buffered_size = list(), 0
+        self.output_stream.flush()
+
+    def start(self):
+        if self.numSpectra is None:
+            raise ValueError("FastMzMLWriter needs the number of spectra before the first one is written")
+        self.emit("<?xml version='1.0' encoding='utf-8'?>\n"
+                  '<indexedmzML xmlns="http://psi.hupo.org/ms/mzml" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+                  'xsi:schemaLocation="http://psi.hupo.org/ms/mzml http://psidev.info/files/ms/mzML/xsd/mzML1.1.3_idx.xsd">\n'
+                  '  <mzML xmlns="http://psi.hupo.org/ms/mzml" version="1.1.0" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+                  'xsi:schemaLocation="http://psi.hupo.org/ms/mzml http://psidev.info/files/ms/mzML/xsd/mzML1.1.1.xsd">\n')
+        if self.metadata:
+            header, instrument_configuration, data_processing = self.prepare_metadata(self.metadata)
+            self.emit(header)
+        else:
+            instrument_configuration, data_processing = "IC1", "simsalabim_processing"
+            self.emit(self.default_metadata())
+
+        self.emit('    <run id="run" defaultInstrumentConfigurationRef=%s>\n' % quoteattr(instrument_configuration))
+        self.emit('      <spectrumList count="%d" defaultDataProcessingRef=%s>\n' % (self.numSpectra, quoteattr(data_processing)))
+
+    def default_metadata(self):
+        return ('    <cvList count="2">\n'
+                '      <cv id="PSI-MS" fullName="PSI-MS" URI="%s"/>\n'
+                '      <cv id="UO" fullName="UNIT-ONTOLOGY" URI="%s"/>\n'
+                '    </cvList>\n'
+                '    <fileDescription>\n'
+                '      <fileContent>\n'
+                '        %s\n'
+                '      </fileContent>\n'
+                '    </fileDescription>\n'
+                '    <softwareList count="1">\n'
+                '      <software id="simsalabim" version="%s">\n'
+                '        %s\n'
+                '      </software>\n'
+                '    </softwareList>\n'
+                '    <instrumentConfigurationList count="1">\n'
+                '      <instrumentConfiguration id="IC1">\n'
+                '        %s\n'
+                '      </instrumentConfiguration>\n'
+                '    </instrumentConfigurationList>\n'
+                '    <dataProcessingList count="1">\n'
+                '      <dataProcessing id="simsalabim_processing">\n'
+                '        <processingMethod order="0" softwareRef="simsalabim">\n'
+                '          %s\n'
+                '        </processingMethod>\n'
+                '      </dataProcessing>\n'
+                '    </dataProcessingList>\n') % (
+                    PSI_MS_URI, UO_URI, self.cv_param("MSn spectrum"), escape(__version__),
+                    self.cv_param("custom unreleased software tool", "simsalabim"),
+                    self.cv_param("instrument model"), self.cv_param("Conversion to mzML"))
+
+    def prepare_metadata(self, metadata):
+        """Finds the controlled vocabulary ids and the references needed by the run and spectrumList elements"""
+        for cv in re.finditer(r'<cv\s[^>]*>', metadata):
+            cv_id = re.search(r'\bid="([^"]*)"', cv.group(0))
+            uri = re.search(r'\bURI="([^"]*)"', cv.group(0))
+            if not cv_id:
+                continue
+            if cv_id.group(1) in ("MS", "PSI-MS") or (uri and "psi-ms" in uri.group(1).lower()):
+                self.cv_psims = cv_id.group(1)
+            elif cv_id.group(1) == "UO" or (uri and "uo.obo" in uri.group(1).lower()):
+                self.cv_uo = cv_id.group(1)
+
+        if not re.search(r'<cv\s[^>]*\bid="%s"' % re.escape(self.cv_uo), metadata):
+            metadata = re.sub(r'<cvList count="(\d+)">', lambda m: '<cvList count="%d">\n      <cv id="UO" fullName="UNIT-ONTOLOGY" URI="%s"/>' % (int(m.group(1)) + 1, UO_URI), metadata, count=1)
+
+        instrument_configuration = re.search(r'<instrumentConfiguration\s[^>]*\bid="([^"]*)"', metadata)
+        data_processing = re.search(r'<dataProcessing\s[^>]*\bid="([^"]*)"', metadata)
+        return (metadata.lstrip('\r\n').rstrip(' '),
+                instrument_configuration.group(1) if instrument_configuration else "IC1",
+                data_processing.group(1) if data_processing else "simsalabim_processing")
+
+    def cv_param_template(self, key, unit=None):
+        if (key, unit) not in self.templates:
+            self.templates[(key, unit)] = self.make_cv_param_template(key, unit)
+        return self.templates[(key, unit)]
+
+    def make_cv_param_template(self, key, unit):
+        accession, name = lookup_term(key)
+        cv = self.cv_uo if accession.startswith("UO:") else self.cv_psims
+        prefix = '<cvParam cvRef="%s" accession="%s" name=%s value="' % (cv, accession, quoteattr(name))
+        if unit is None:
+            return prefix, '"/>'
+        unit_accession, unit_name = lookup_term(unit)
+        unit_cv = self.cv_uo if unit_accession.startswith("UO:") else self.cv_psims
+        return prefix, '" unitCvRef="%s" unitAccession="%s" unitName=%s/>' % (unit_cv, unit_accession, quoteattr(unit_name))
+
+    def cv_param(self, key, value=None, unit=None):
+        prefix, suffix = self.cv_param_template(key, unit)
+        return prefix + escape(format_value(value), {'"': "&quot;"}) + suffix
+
+    def params_to_xml(self, params, indent):
+        """Converts params in any of the forms accepted by psims: {'name': ..., 'value': ...}, {name: value},
+        "name" or (key, value) items as produced by MzMLTransformer.format_spectrum"""
+        lines = list()
+        for param in params or []:
+            unit = None
+            if isinstance(param, dict):
+                if "name" in param or "accession" in param:
+                    key, value = param.get("accession") or param["name"], param.get("value")
+                    unit = param.get("unit_accession") or param.get("unit_name")
+                else:
+                    (key, value), = param.items()
+            elif isinstance(param, tuple):
+                key, value = param
+            else:
+                key, value = param, None
+            key = getattr(key, 'accession', None) or str(key)
+            unit = unit or getattr(value, 'unit_info', None)
+            lines.append(indent + self.cv_param(key, value, unit))
+        return lines
+
+    def write_spectrum(self, mz_array=None, intensity_array=None, charge_array=None, id=None,
+                       polarity='positive scan', centroided=True, precursor_information=None,
+                       scan_start_time=None, params=None, compression=None,
+                       encoding=None, other_arrays=None, scan_params=None, scan_window_list=None,
+                       instrument_configuration_id=None, intensity_unit=None):
+        # accepts a Spectrum as well as the keyword arguments of psims' write_spectrum
+        if isinstance(mz_array, Spectrum):
+            return self.write_spectrum(**mz_array.spectrum)
+
+        mz_array = np.empty(0) if mz_array is None else mz_array
+        intensity_array = np.empty(0) if intensity_array is None else intensity_array
+        params = list(params or [])
+        ms_level = 2
+        for param in params:
+            if isinstance(param, dict) and ("ms level" in param or param.get("name") in ("ms level", "MS:1000511")):
+                ms_level = int(param.get("ms level", param.get("value", 2)))
+
+        lines = ['<spectrum index="%d" defaultArrayLength="%d" id=%s>' % (len(self.spectrum_offsets), len(mz_array), quoteattr(id))]
+        lines.extend(self.params_to_xml(params, '        '))
+        if polarity in (1, 'positive scan'):
+            lines.append('        ' + self.cv_param("positive scan"))
+        elif polarity in (-1, 'negative scan'):
+            lines.append('        ' + self.cv_param("negative scan"))
+        lines.append('        ' + self.cv_param("centroid spectrum" if centroided else "profile spectrum"))
+        if not any(l.find('"MS:1000579"') != -1 or l.find('"MS:1000580"') != -1 for l in lines[1:]):
+            lines.append('        ' + self.cv_param("MSn spectrum" if ms_level > 1 else "MS1 spectrum"))
+
+        lines.append('        <scanList count="1">')
+        lines.append('          ' + self.cv_param("no combination"))
+        if instrument_configuration_id:
+            lines.append('          <scan instrumentConfigurationRef=%s>' % quoteattr(instrument_configuration_id))
+        else:
+            lines.append('          <scan>')
+        if scan_start_time is not None:
+            if isinstance(scan_start_time, dict):
+                lines.append('            ' + self.cv_param("scan start time", scan_start_time['value'], scan_start_time.get('unit_name', "minute")))
+            else:
+                lines.append('            ' + self.cv_param("scan start time", scan_start_time, getattr(scan_start_time, 'unit_info', None) or "minute"))
+        lines.extend(self.params_to_xml(scan_params, '            '))
+        if scan_window_list:
+            lines.append('            <scanWindowList count="%d">' % len(scan_window_list))
+            for lower, upper in scan_window_list:
+                lines.append('              <scanWindow>')
+                lines.append('                ' + self.cv_param("scan window lower limit", lower, "m/z"))
+                lines.append('                ' + self.cv_param("scan window upper limit", upper, "m/z"))
+                lines.append('              </scanWindow>')
+            lines.append('            </scanWindowList>')
+        lines.append('          </scan>')
+        lines.append('        </scanList>')
+
+        if precursor_information:
+            if isinstance(precursor_information, dict):
+                precursor_information = [precursor_information]
+            lines.append('        <precursorList count="%d">' % len(precursor_information))
+            for p in precursor_information:
+                lines.extend(self.precursor_to_xml(p))
+            lines.append('        </precursorList>')
+
+        if self.array_encoding is not None:
+            options = self.array_encoding.apply({'encoding': encoding, 'compression': compression})
+            encoding, compression = options['encoding'], options['compression']
+        encoding = dict(DEFAULT_ENCODING, **{k: v for k, v in (encoding or {}).items() if v is not None})
+        if not isinstance(compression, dict):
+            compression = {array_name: compression or DEFAULT_COMPRESSION for array_name in DEFAULT_ENCODING}
+        arrays = [("m/z array", mz_array), ("intensity array", intensity_array)]
+        if charge_array is not None:
+            arrays.append(("charge array", charge_array))
+        lines.append('        <binaryDataArrayList count="%d">' % len(arrays))
+        for array_name, array in arrays:
+            lines.extend(self.binary_array_to_xml(array_name, array, encoding[array_name], compression.get(array_name) or "none", intensity_unit))
+        lines.append('        </binaryDataArrayList>')
+        lines.append('      </spectrum>\n')
+
+        # the index points at the start tag, not at its indentation
+        self.emit('      ')
+        self.spectrum_offsets.append((id, self.offset))
+        self.emit('\n'.join(lines))
+
+    def precursor_to_xml(self, p):
+        lines = list()
+        if p.get('scan_id'):
+            lines.append('          <precursor spectrumRef=%s>' % quoteattr(p['scan_id']))
+        else:
+            lines.append('          <precursor>')
+
+        isolation_window = p.get('isolation_window_args') or p.get('isolation_window')
+        if isolation_window:
+            lines.append('            <isolationWindow>')
+            if isinstance(isolation_window, dict):
+                isolation_window = isolation_window.items()
+            elif isinstance(isolation_window, (list, tuple)):
+                isolation_window = zip(["lower", "target", "upper"], isolation_window)
+            for key, value in isolation_window:
+                key = ISOLATION_WINDOW_KEYS.get(key, key)
+                lines.append('              ' + self.cv_param(getattr(key, 'accession', None) or key, value, "m/z"))
+            lines.append('            </isolationWindow>')
+
+        lines.append('            <selectedIonList count="1">')
+        lines.append('              <selectedIon>')
+        lines.append('                ' + self.cv_param("selected ion m/z", p['mz'], "m/z"))
+        if p.get('intensity') is not None:
+            lines.append('                ' + self.cv_param("peak intensity", p['intensity'], "number of detector counts"))
+        if p.get('charge') is not None:
+            lines.append('                ' + self.cv_param("charge state", p['charge']))
+        lines.extend(self.params_to_xml(p.get('params'), '                '))
+        lines.append('              </selectedIon>')
+        lines.append('            </selectedIonList>')
+        lines.append('            <activation>')
+        lines.extend(self.params_to_xml(p.get('activation'), '              '))
+        lines.append('            </activation>')
+        lines.append('          </precursor>')
+        return lines
+
+    def binary_array_to_xml(self, array_name, array, dtype, compression, intensity_unit=None):
+        unit, name = ARRAY_TERMS[array_name]
+        if array_name == "intensity array" and intensity_unit:
+            unit = intensity_unit
+        encoded = encode_array(array, dtype, compression).decode('ascii')
+        return ['          <binaryDataArray encodedLength="%d">' % len(encoded),
+                '            ' + self.cv_param(name, None, unit),
+                '            ' + self.cv_param(COMPRESSION_TERMS.get(compression, compression)),
+                '            ' + self.cv_param(DTYPE_TERMS[np.dtype(dtype)]),
+                '            <binary>%s</binary>' % encoded,
+                '          </binaryDataArray>']
+
+    def finish(self):
+        if len(self.spectrum_offsets) != self.numSpectra:
+            raise ValueError("FastMzMLWriter wrote %d spectra, but the spectrumList count is %d" % (len(self.spectrum_offsets), self.numSpectra))
+        self.emit('      </spectrumList>\n'
+                  '    </run>\n'
+                  '  </mzML>\n'
+                  '  ')
+        index_offset = self.offset
+        lines = ['<indexList count="1">', '    <index name="spectrum">']
+        lines.extend('      <offset idRef=%s>%d</offset>' % (quoteattr(spectrum_id), offset) for spectrum_id, offset in self.spectrum_offsets)
+        lines.extend(['    </index>', '  </indexList>',
+                      '  <indexListOffset>%d</indexListOffset>' % index_offset,
+                      '  <fileChecksum>'])
+        self.emit('\n'.join(lines))
+        self.emit('%s</fileChecksum>\n</indexedmzML>\n' % self.checksum.hexdigest())
+        self.flush()
@@ -0,0 +1,155 @@
+###############################################################
+## reads the spectrum metadata of an mzML file without its   ##
+## binary arrays                                             ##
+##                                                           ##
+## spectrum elements are located with bytes.find, only the   ##
+## part before <binaryDataArrayList> is decoded and turned   ##
+## into a dict with the same structure and keys as the       ##
+## spectra of pyteomics, without m/z and intensity arrays    ##
+###############################################################
+
+import os
+import re
+import mmap
+import html
+
+from pyteomics.auxiliary import cvstr, unitfloat
+
+from . import helpers
+
+
+BLOCK_SIZE = 16 * 1024 * 1024
+
+SPECTRUM_START = b'<spectrum '
+SPECTRUM_END = b'</spectrum>'
+BINARY_START = b'<binaryDataArrayList'
+
+TAG = re.compile(r'<(/?)(\w+)([^>]*?)(/?)>')
+ATTRIBUTE = re.compile(r'(\w+)="([^"]*)"')
+PARAM_GROUP = re.compile(rb'<referenceableParamGroup\s[^>]*?id="([^"]*)"[^>]*>(.*?)</referenceableParamGroup>', re.S)
+
+INT_ATTRIBUTES = ("index", "count", "defaultArrayLength")
+
+
+def iter_spectrum_headers(inputFile, blockSize=BLOCK_SIZE):
+    """Yields the spectra of an mzML file as pyteomics-like dicts without the binary arrays"""
+    if helpers.getCompression(inputFile) or os.path.getsize(inputFile) == 0:
+        with helpers.openVersionSafe(inputFile, 'rb') as f:
+            yield from iter_spectrum_headers_from_stream(f, blockSize)
+    else:
+        with open(inputFile, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            paramGroups = None
+            for start, header_end, _ in iter_header_spans(mm):
+                if paramGroups is None:
+                    paramGroups = parse_param_groups(mm[:start])
+                yield parse_spectrum_header(mm[start:header_end], paramGroups)
+
+
+def iter_spectrum_headers_from_stream(f, blockSize=BLOCK_SIZE):
+    buffer = b''
+    paramGroups = None
+    while True:
+        block = f.read(blockSize)
+        buffer += block
+        pos = 0
+        for start, header_end, end in iter_header_spans(buffer):
+            if paramGroups is None:
+                paramGroups = parse_param_groups(buffer[:start])
+            yield parse_spectrum_header(buffer[start:header_end], paramGroups)
+            pos = end
+        if not block:
+            break
+        # keep the incomplete spectrum at the end of the buffer, or only a possibly cut off start tag,
+        # everything before the first spectrum is kept for the referenceableParamGroups
+        if paramGroups is None:
+            continue
+        if buffer.find(SPECTRUM_START, pos) == -1:
+            pos = max(pos, len(buffer) - len(SPECTRUM_START))
+        buffer = buffer[pos:]
+
+
+def iter_header_spans(buffer, pos=0):
+    """Yields (start, header end, end) of each complete spectrum element, the header ends at the binary arrays"""
+    while True:
+        start = buffer.find(SPECTRUM_START, pos)
+        if start == -1:
+            return
+        end = buffer.find(SPECTRUM_END, start)
+        if end == -1:
+            return
+        header_end = buffer.find(BINARY_START, start, end)
+        if header_end == -1:
+            header_end = end
+        pos = end + len(SPECTRUM_END)
+        yield start, header_end, pos
+
+
+def parse_param_groups(prelude):
+    """Returns the cvParams of the referenceableParamGroups by group id"""
+    paramGroups = dict()
+    for group_id, content in PARAM_GROUP.findall(prelude):
+        paramGroups[unescape(group_id.decode())] = [parse_attributes(attributes) for _, tag, attributes, _ in TAG.findall(content.decode()) if tag in ("cvParam", "userParam")]
+    return paramGroups
+
+
+def parse_spectrum_header(header, paramGroups):
+    spectrum = dict()
+    # (tag, element) of the open elements
+    stack = list()
+    for closing, tag, attributes, selfClosing in TAG.findall(header.decode()):
+        if closing:
+            if len(stack) > 1:
+                stack.pop()
+            continue
+
+        attributes = parse_attributes(attributes)
+        if not stack:
+            spectrum.update(attributes)
+            stack.append((tag, spectrum))
+            continue
+
+        parent_tag, parent = stack[-1]
+        if tag in ("cvParam", "userParam"):
+            add_param(parent, attributes)
+        elif tag == "referenceableParamGroupRef":
+            for param in paramGroups.get(attributes.get("ref"), []):
+                add_param(parent, param)
+        else:
+            # children of list elements, e.g. the scans of a scanList, are collected in a list like in pyteomics
+            if parent_tag.endswith("List"):
+                parent.setdefault(tag, []).append(attributes)
+            else:
+                parent[tag] = attributes
+            if not selfClosing:
+                stack.append((tag, attributes))
+    return spectrum
+
+
+def parse_attributes(attributes):
+    parsed = dict()
+    for key, value in ATTRIBUTE.findall(attributes):
+        value = unescape(value)
+        parsed[key] = int(value) if key in INT_ATTRIBUTES else value
+    return parsed
+
+
+def add_param(element, attributes):
+    name = attributes.get("name")
+    accession = attributes.get("accession")
+    key = cvstr(name, accession, attributes.get("unitAccession")) if accession else name
+    element[key] = parse_value(attributes.get("value", ""), attributes.get("unitName"))
+
+
+def parse_value(value, unit=None):
+    try:
+        return unitfloat(value, unit) if unit else int(value)
+    except ValueError:
+        pass
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def unescape(value):
+    return html.unescape(value) if '&' in value else value
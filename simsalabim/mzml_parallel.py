@@ -0,0 +1,55 @@
+################################################################
+## multi-process XML parsing and binary array decoding for    ##
+## indexed mzML files                                         ##
+##                                                            ##
+## the offset index of the mzML file is used to hand chunks   ##
+## of spectrum ids to a process pool, every worker has its    ##
+## own reader and the spectra are yielded in file order       ##
+################################################################
+
+import os
+import collections
+from concurrent.futures import ProcessPoolExecutor
+
+from pyteomics.mzml import MzML as mzMLParser
+
+
+CHUNK_SIZE = 250
+
+_reader = None
+
+
+def _init_worker(inputFile, decodeBinary):
+    global _reader
+    _reader = mzMLParser(inputFile, use_index=True, decode_binary=decodeBinary)
+
+
+def _parse_chunk(spectrum_ids, convert):
+    spectra = list()
+    for i, spectrum_id in spectrum_ids:
+        spectrum = _reader.get_by_id(spectrum_id)
+        spectra.append(convert(spectrum, i) if convert else spectrum)
+    return spectra
+
+
+def get_spectrum_ids(inputFile):
+    with mzMLParser(inputFile, use_index=True, decode_binary=False) as reader:
+        return list(reader._offset_index['spectrum'].keys())
+
+
+def iter_spectra_parallel(inputFile, workers=None, decodeBinary=True, convert=None, chunkSize=CHUNK_SIZE):
+    """Yields the spectra of an indexed mzML file in file order, parsed and decoded in a process pool.
+
+    convert(spectrum, i) is applied to each spectrum in the worker, e.g. to send back compact
+    Spectrum objects instead of the full pyteomics dicts. At most 2 chunks per worker are in flight.
+    """
+    workers = workers or os.cpu_count()
+    spectrum_ids = list(enumerate(get_spectrum_ids(inputFile)))
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(inputFile, decodeBinary)) as executor:
+        pending = collections.deque()
+        for start in range(0, len(spectrum_ids), chunkSize):
+            pending.append(executor.submit(_parse_chunk, spectrum_ids[start:start + chunkSize], convert))
+            if len(pending) >= 2 * workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
@@ -1,3 +1,5 @@
+import functools
+
 from pyteomics.mzml import MzML as mzMLParser
 
 from .spectrum import Spectrum
@@ -12,51 +14,94 @@ from . import helpers
 
 # this function was loosely adapted from MzMLTransformer:
 # https://github.com/mobiusklein/psims/blob/master/psims/transform/mzml.py
-def parse_mzml(inputFile, storeFragmentIons = False):
-  parser = mzMLParser(inputFile, iterative = True)
+def parse_mzml(inputFile, storeFragmentIons = False, workers = 1, spectrumFilter = None):
+  # without fragment ions the binary arrays are not decoded at all, with a filter 
+  # they are only decoded for the spectra that pass it
+  decodeBinary = storeFragmentIons and spectrumFilter is None
+  convert = functools.partial(make_mzml_spectrum, storeFragmentIons = storeFragmentIons, spectrumFilter = spectrumFilter)
+  if workers > 1 and not helpers.getCompression(inputFile):
+    from . import mzml_parallel
+    spectra = mzml_parallel.iter_spectra_parallel(inputFile, workers, decodeBinary = decodeBinary, convert = convert)
+  else:
+    parser = open_mzml(inputFile, decodeBinary = decodeBinary)
+    spectra = (convert(spectrum, i) for i, spectrum in enumerate(parser.iterfind("spectrum")))
+  
+  for spectrum in spectra:
+    if spectrum is not None:
+      yield spectrum
+
+def make_mzml_spectrum(spectrum, i, storeFragmentIons = False, spectrumFilter = None):
+  """Returns None for spectra that are rejected by spectrumFilter, or that are not MS2 spectra if there is no filter"""
+  msLevel = spectrum["ms level"]
+  if spectrumFilter is None and msLevel != 2:
+    return None
+  
+  scannr, raw_file, rtime, ezLines = parse_mzml_header(spectrum, i)
+  if spectrumFilter and not spectrumFilter.accepts(scannr, rtime, ezLines, msLevel):
+    return None
+  
+  if storeFragmentIons:
+    return Spectrum.from_arrays(scannr, ezLines, decode_array(spectrum["m/z array"]), decode_array(spectrum["intensity array"]), ms_level=msLevel, rtime=rtime)
+  else:
+    return Spectrum(scannr, ezLines, None, ms_level=msLevel, rtime=rtime)
+
+def decode_array(array):
+  # arrays read with decode_binary = False are only decoded on request
+  return array.decode() if hasattr(array, 'decode') else array
+
+def parse_mzml_metadata(inputFile):
+  parser = open_mzml(inputFile, decodeBinary = False)
   for i, spectrum in enumerate(parser.iterfind("spectrum")):
     if spectrum["ms level"] != 2:
       continue
     
-    if storeFragmentIons:
-      fragmentIons = zip(spectrum["m/z array"], spectrum["intensity array"])
-    else:
-      fragmentIons = None
-    
-    if "scan=" in spectrum["id"]:
-      scannr = int(spectrum["id"].split("scan=")[1])
-    else:
-      scannr = i + 1
-    
-    scans = spectrum.get("scanList", {}).get('scan', [{}])[0]
-    for key, value in list(scans.items()):
-      if not hasattr(key, 'accession'):
-        continue
-      accession = key.accession
-      if accession == "MS:1000016":
-        rtime = value
-    
-    ezLines = list()
-    precursors = spectrum.get("precursorList", {}).get("precursor")
-    if precursors:
-      for prec in precursors:
-        ion = prec['selectedIonList'].get("selectedIon")[0]
-        for key, value in list(ion.items()):
-          if key == "selected ion m/z":
-            pepmz = value
-          elif key == "peak intensity":
-            intensity = value
-          elif key in ("charge state", "possible charge state"):
-            charge = value
-        
-        #for key, value in prec.get("isolationWindow", {}).items():
-        #  if key == "isolation window target m/z":
-        #    isolationWindowTarget = value
-        #  elif key == "isolation window lower offset":
-        #    isolationWindowLowerOffset = value
-        #  elif key == "isolation window upper offset":
-        #    isolationWindowUpperOffset = value
-        
-        ezLines.append({'mz': pepmz, 'charge': charge, 'intensity': intensity})
-    
-    yield Spectrum(scannr, ezLines, fragmentIons)
+    yield parse_mzml_header(spectrum, i) + (int(spectrum["defaultArrayLength"]),)
+
+def open_mzml(inputFile, decodeBinary = True):
+  if helpers.getCompression(inputFile):
+    # pyteomics needs to seek back to the start of the file, which the threaded
+    # decompression stream does not support, so the plain decompressor is used here
+    return mzMLParser(helpers.openCompressedStream(inputFile, 'rb'), iterative = True, use_index = False, decode_binary = decodeBinary)
+  else:
+    return mzMLParser(inputFile, iterative = True, decode_binary = decodeBinary)
+
+def parse_mzml_header(spectrum, i):
+  if "scan=" in spectrum["id"]:
+    scannr = int(spectrum["id"].split("scan=")[1])
+  else:
+    scannr = i + 1
+  
+  rtime = None
+  scans = spectrum.get("scanList", {}).get('scan', [{}])[0]
+  for key, value in list(scans.items()):
+    if not hasattr(key, 'accession'):
+      continue
+    accession = key.accession
+    if accession == "MS:1000016":
+      rtime = value * 60 if getattr(value, 'unit_info', None) == "minute" else value
+  
+  ezLines = list()
+  precursors = spectrum.get("precursorList", {}).get("precursor")
+  if precursors:
+    for prec in precursors:
+      ion = prec['selectedIonList'].get("selectedIon")[0]
+      intensity = None
+      for key, value in list(ion.items()):
+        if key == "selected ion m/z":
+          pepmz = value
+        elif key == "peak intensity":
+          intensity = value
+        elif key in ("charge state", "possible charge state"):
+          charge = value
+      
+      #for key, value in prec.get("isolationWindow", {}).items():
+      #  if key == "isolation window target m/z":
+      #    isolationWindowTarget = value
+      #  elif key == "isolation window lower offset":
+      #    isolationWindowLowerOffset = value
+      #  elif key == "isolation window upper offset":
+      #    isolationWindowUpperOffset = value
+      
+      ezLines.append(Precursor(rtime, pepmz, charge, intensity))
+  
+  return scannr, None, rtime, ezLines
@@ -1,19 +1,44 @@
+import contextlib
+
 from psims.transform.mzml import MzMLWriter
 
+from .spectrum import Spectrum
+
 from .mgf_writer import MgfWriter
 from .ms2_writer import Ms2Writer
 
 
 class MzMLWriter2(MzMLWriter):
+    def __init__(self, outfile, array_encoding=None, **kwargs):
+        super(MzMLWriter2, self).__init__(outfile, **kwargs)
+        # MzMLEncoding with the precision and compression of the binary arrays
+        self.array_encoding = array_encoding
+    
     def write(self, spectra):
         '''Write out the the transformed mzML file
         '''
-        with self:
-            self.controlled_vocabularies()
-            #self.copy_metadata()
-            with self.run(id="id"):
-                for i, spectrum in enumerate(spectra):
-                    self.write_spectrum(**spectrum.spectrum)
-                    if i % 1000 == 0:
-                        print("Handled %d spectra" % (i, ))
-
+        self.start()
+        for i, spectrum in enumerate(spectra):
+            self.write_spectrum(**spectrum.spectrum)
+            if i % 1000 == 0:
+                print("Handled %d spectra" % (i, ))
+        self.finish()
+    
+    def start(self):
+        # the document and run elements are closed in finish()
+        self._elements = contextlib.ExitStack()
+        self._elements.enter_context(self)
+        self.controlled_vocabularies()
+        #self.copy_metadata()
+        self._elements.enter_context(self.run(id="id"))
+    
+    def write_spectrum(self, *args, **kwargs):
+        # accepts a Spectrum as well as the keyword arguments of MzMLWriter.write_spectrum
+        if len(args) == 1 and not kwargs and isinstance(args[0], Spectrum):
+            args, kwargs = (), args[0].spectrum
+        if self.array_encoding is not None:
+            kwargs = self.array_encoding.apply(dict(kwargs))
+        return super(MzMLWriter2, self).write_spectrum(*args, **kwargs)
+    
+    def finish(self):
+        self._elements.close()
@@ -0,0 +1,64 @@
+###########################################################
+## multi-process parsing of large apl, mgf and ms2 files ##
+##                                                       ##
+## the file is split into byte ranges at record starts,  ##
+## each range is parsed in a process pool and the        ##
+## spectra are yielded in file order                     ##
+###########################################################
+
+import os
+import mmap
+import collections
+from concurrent.futures import ProcessPoolExecutor
+
+from . import block_reader
+
+
+CHUNK_SIZE = 32 * 1024 * 1024
+
+
+def get_chunk_boundaries(inputFile, recordStart, chunkSize=CHUNK_SIZE):
+    """Returns byte offsets that split inputFile into ranges of roughly chunkSize bytes, all at record starts"""
+    file_size = os.path.getsize(inputFile)
+    if file_size == 0:
+        return [0, 0]
+
+    separator = b'\n' + recordStart
+    boundaries = list()
+    with open(inputFile, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for offset in range(0, file_size, chunkSize):
+            if offset == 0 and mm[:len(recordStart)] == recordStart:
+                pos = 0
+            else:
+                pos = mm.find(separator, max(0, offset - 1))
+                pos = file_size if pos == -1 else pos + 1
+            if not boundaries or pos > boundaries[-1]:
+                boundaries.append(pos)
+    if boundaries[-1] != file_size:
+        boundaries.append(file_size)
+    return boundaries
+
+
+def parse_chunk(inputFile, start, end, recordStart, parseHeader, storeFragmentIons, recordEnd, spectrumFilter=None):
+    with open(inputFile, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        records = (mm[s:e] for s, e in block_reader.iter_record_spans(mm, recordStart, start, end))
+        return list(block_reader.parse_records(records, parseHeader, storeFragmentIons, recordEnd, spectrumFilter))
+
+
+def parse_parallel(inputFile, recordStart, parseHeader, storeFragmentIons=False, recordEnd=None, workers=None, chunkSize=CHUNK_SIZE, spectrumFilter=None):
+    """Parses the chunks of inputFile in a process pool and yields the spectra in file order.
+
+    At most 2 chunks per worker are in flight, which bounds the memory used for parsed spectra
+    that are waiting to be consumed.
+    """
+    workers = workers or os.cpu_count()
+    boundaries = get_chunk_boundaries(inputFile, recordStart, chunkSize)
+    chunks = iter(zip(boundaries[:-1], boundaries[1:]))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque()
+        for start, end in chunks:
+            pending.append(executor.submit(parse_chunk, inputFile, start, end, recordStart, parseHeader, storeFragmentIons, recordEnd, spectrumFilter))
+            if len(pending) >= 2 * workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
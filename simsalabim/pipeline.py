@@ -0,0 +1,218 @@
+##############################################################
+## pipelined conversion of apl, mgf and ms2 files           ##
+##                                                          ##
+## a reader thread reads batches of raw records ahead, a    ##
+## process pool parses and formats them and a writer thread ##
+## writes the results in input order. Bounded queues        ##
+## between the stages cap the memory use                    ##
+##############################################################
+
+import io
+import time
+import queue
+import threading
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+
+from .apl_parser import APL_RECORD_START, APL_RECORD_END, parse_apl_header
+from .mgf_parser import MGF_RECORD_START, MGF_RECORD_END, parse_mgf_header
+from .ms2_parser import MS2_RECORD_START, MS2_RECORD_END, parse_ms2_header
+from .mzml_writer import MzMLWriter2
+from .mzml_fast_writer import FastMzMLWriter
+from .mgf_writer import MgfWriter
+from .ms2_writer import Ms2Writer
+from .apl_writer import AplWriter
+from .spectrum_store import SpectrumStoreWriter, STORE_EXT
+from . import block_reader
+from . import helpers
+
+
+BATCH_SIZE = 500
+
+# record start, header parser and record end per input format
+RECORD_FORMATS = {
+    ".apl": (APL_RECORD_START, parse_apl_header, APL_RECORD_END),
+    ".mgf": (MGF_RECORD_START, parse_mgf_header, MGF_RECORD_END),
+    ".ms2": (MS2_RECORD_START, parse_ms2_header, MS2_RECORD_END),
+}
+
+# text outputs are formatted by the workers, mzML output needs a single
+# stateful writer and is formatted by the writer thread
+TEXT_WRITERS = {
+    ".mgf": MgfWriter,
+    ".ms2": Ms2Writer,
+    ".apl": AplWriter,
+}
+
+
+class StageTimer:
+    """Accumulates the time a pipeline stage spends working, as opposed to waiting for other stages"""
+    def __init__(self):
+        self.busy = 0.0
+        self.resumed = None
+
+    def resume(self):
+        self.resumed = time.perf_counter()
+
+    def pause(self):
+        self.busy += time.perf_counter() - self.resumed
+
+    def __enter__(self):
+        self.resume()
+        return self
+
+    def __exit__(self, *exc):
+        self.pause()
+
+
+def format_batch(records, parseHeader, recordEnd, spectrumFilter, output_formats):
+    """Parses a batch of records and returns (num_spectra, [text or spectra per output], busy seconds)"""
+    start = time.perf_counter()
+    spectra = list(block_reader.parse_records(records, parseHeader, True, recordEnd, spectrumFilter))
+    results = list()
+    for output_format in output_formats:
+        if output_format in TEXT_WRITERS:
+            out = io.StringIO()
+            writer = TEXT_WRITERS[output_format](out)
+            for spectrum in spectra:
+                writer.write_spectrum(spectrum)
+            writer.flush()
+            results.append(out.getvalue())
+        else:
+            results.append(spectra)
+    return len(spectra), results, time.perf_counter() - start
+
+
+def read_batches(inputFile, recordStart, useMmap, batchSize, batches, timer, errors, stop):
+    try:
+        batch = list()
+        timer.resume()
+        for record in block_reader.iter_records(inputFile, recordStart, useMmap=useMmap):
+            batch.append(bytes(record))
+            if len(batch) == batchSize:
+                if stop.is_set():
+                    break
+                # waiting for a free slot in the queue does not count as busy time
+                timer.pause()
+                batches.put(batch)
+                timer.resume()
+                batch = list()
+        timer.pause()
+        if batch and not stop.is_set():
+            batches.put(batch)
+    except Exception as e:
+        errors.append(e)
+    finally:
+        batches.put(None)
+
+
+def write_results(results, outputs, timer, errors, counts):
+    num_spectra = 0
+    try:
+        while True:
+            future = results.get()
+            if future is None:
+                break
+            n, formatted, _ = future.result()
+            with timer:
+                for (output_format, out, writer), result in zip(outputs, formatted):
+                    if output_format in TEXT_WRITERS:
+                        out.write(result)
+                    else:
+                        for spectrum in result:
+                            writer.write_spectrum(spectrum)
+            num_spectra += n
+            print("Handled %d spectra" % (num_spectra, ))
+        counts.append(num_spectra)
+    except Exception as e:
+        errors.append(e)
+        # keep consuming, so that the submitting thread does not block on a full queue
+        while results.get() is not None:
+            pass
+
+
+def convert_pipelined(input_file, output_files, params, numSpectra=None):
+    """Converts input_file to all output_files, returns the number of spectra and the utilization of the reader, worker and writer stages.
+    numSpectra is the number of spectra that pass the filter, which the fast mzML writer needs up front"""
+    input_format = helpers.getExt(helpers.stripCompressionExt(input_file)).lower()
+    recordStart, parseHeader, recordEnd = RECORD_FORMATS[input_format]
+    workers = max(1, params.get('workers', 1))
+    output_formats = [helpers.getExt(helpers.stripCompressionExt(f.rstrip("/\\"))).lower() for f in output_files]
+
+    start = time.perf_counter()
+    reader_timer, worker_timer, writer_timer = StageTimer(), StageTimer(), StageTimer()
+    errors, counts = list(), list()
+    with contextlib.ExitStack() as stack:
+        outputs = list()
+        for output_file, output_format in zip(output_files, output_formats):
+            if output_format == STORE_EXT:
+                out, writer = None, SpectrumStoreWriter(output_file)
+                # removes the partial store if a stage fails, after finish() there is nothing left to remove
+                stack.callback(writer.abort)
+                writer.start()
+                outputs.append((output_format, out, writer))
+                continue
+            out = stack.enter_context(helpers.openVersionSafe(output_file, 'wb' if output_format == ".mzml" else 'w'))
+            if output_format in TEXT_WRITERS:
+                writer = TEXT_WRITERS[output_format](out)
+            elif params.get('mzmlWriter') == "fast":
+                writer = FastMzMLWriter(out, numSpectra=numSpectra, array_encoding=params.get('mzmlEncoding'))
+            else:
+                writer = MzMLWriter2(out, array_encoding=params.get('mzmlEncoding'))
+            writer.start()
+            if output_format in TEXT_WRITERS:
+                writer.flush()
+            outputs.append((output_format, out, writer))
+
+        batches = queue.Queue(maxsize=2 * workers)
+        results = queue.Queue(maxsize=2 * workers)
+        stop = threading.Event()
+        reader_thread = threading.Thread(target=read_batches, args=(input_file, recordStart, params.get('reader', "mmap") == "mmap",
+                                                             params.get('batchSize', BATCH_SIZE), batches, reader_timer, errors, stop))
+        writer_thread = threading.Thread(target=write_results, args=(results, outputs, writer_timer, errors, counts))
+        reader_thread.start()
+        writer_thread.start()
+        read_all = False
+        try:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                # a failed stage stops the others, instead of parsing the rest of the input
+                while not errors:
+                    batch = batches.get()
+                    if batch is None:
+                        read_all = True
+                        break
+                    future = executor.submit(format_batch, batch, parseHeader, recordEnd, params.get('spectrumFilter'), output_formats)
+                    future.add_done_callback(lambda f: add_busy_time(worker_timer, f))
+                    results.put(future)
+                results.put(None)
+                writer_thread.join()
+        finally:
+            # also on errors in this thread, otherwise the reader and writer threads block forever on their queues
+            stop.set()
+            if writer_thread.is_alive():
+                results.put(None)
+                writer_thread.join()
+            while not read_all:
+                read_all = batches.get() is None
+            reader_thread.join()
+
+        if errors:
+            raise errors[0]
+
+        for output_format, out, writer in outputs:
+            writer.finish()
+
+    elapsed = time.perf_counter() - start
+    utilization = {
+        'reader': reader_timer.busy / elapsed,
+        'workers': worker_timer.busy / elapsed / workers,
+        'writer': writer_timer.busy / elapsed,
+    }
+    for stage, fraction in utilization.items():
+        print("Stage utilization %-8s %5.1f%%" % (stage, 100 * fraction))
+    return counts[0], utilization
+
+
+def add_busy_time(timer, future):
+    if not future.cancelled() and future.exception() is None:
+        timer.busy += future.result()[2]
@@ -1,10 +1,43 @@
+import numpy as np
+
+from . import helpers
+
+
+# missing intensities are stored as NaN and converted back to None in dict views
+PRECURSOR_DTYPE = np.dtype([('mz', np.float64), ('charge', np.int32), ('intensity', np.float64)])
+
+
 class Precursor():
+    __slots__ = ('mz', 'charge', 'intensity', 'rtime')
+
     def __init__(self, rtime, precmz, charge, intensity):
-        self.precursor = dict()
-        self.precursor['mz'] = precmz
-        self.precursor['intensity'] = intensity
-        self.precursor['charge'] = charge
-        self.precursor['rtime'] = rtime # not used
+        self.mz = precmz
+        self.intensity = intensity
+        self.charge = charge
+        self.rtime = rtime # not used
 
     def precMass(self):
-        return helpers.precMassFromPrecMz(self.precursor['mz'], self.precursor['charge'])
+        return helpers.precMassFromPrecMz(self.mz, self.charge)
+
+    @property
+    def precursor(self):
+        return {'mz': self.mz, 'charge': self.charge, 'intensity': self.intensity}
+
+
+def to_precursor_array(precursors):
+    """Converts a list of Precursor objects or {'mz', 'charge', 'intensity'} dicts to a structured array"""
+    if isinstance(precursors, np.ndarray) and precursors.dtype == PRECURSOR_DTYPE:
+        return precursors
+
+    precursor_array = np.empty(len(precursors), dtype=PRECURSOR_DTYPE)
+    for i, p in enumerate(precursors):
+        if isinstance(p, Precursor):
+            p = p.precursor
+        intensity = p['intensity']
+        precursor_array[i] = (p['mz'], p['charge'], np.nan if intensity is None else intensity)
+    return precursor_array
+
+
+def to_precursor_dicts(precursor_array):
+    return [{'mz': float(mz), 'charge': int(charge), 'intensity': None if np.isnan(intensity) else float(intensity)}
+            for mz, charge, intensity in precursor_array.tolist()]
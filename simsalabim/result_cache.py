@@ -0,0 +1,102 @@
+#################################################################
+## manifest of the processing steps that produced the outputs  ##
+## in a folder                                                 ##
+##                                                             ##
+## a step is keyed on the content hashes of its input files    ##
+## and its options, and is up to date as long as its key is    ##
+## unchanged and its outputs are exactly as they were written. ##
+## File hashes are only recomputed if the size or the mtime    ##
+## of a file changed since it was last hashed                  ##
+#################################################################
+
+import os
+import json
+import shutil
+
+from . import helpers
+
+
+MANIFEST_VERSION = 1
+
+# prefix of outputs that are still being written, they are renamed to the final name once complete
+TMP_PREFIX = ".tmp-"
+
+
+class ResultCache:
+    def __init__(self, manifest_file):
+        self.manifest_file = manifest_file
+        self.folder = os.path.dirname(os.path.abspath(manifest_file))
+        self.manifest = self.load()
+
+    def load(self):
+        try:
+            with open(self.manifest_file) as f:
+                manifest = json.load(f)
+            if manifest.get('version') == MANIFEST_VERSION:
+                return manifest
+        except (OSError, ValueError):
+            pass
+        return {'version': MANIFEST_VERSION, 'files': dict(), 'steps': dict()}
+
+    def save(self):
+        tmp_file = get_tmp_file(self.manifest_file)
+        with open(tmp_file, 'w') as f:
+            json.dump(self.manifest, f, indent=2, sort_keys=True)
+        os.replace(tmp_file, self.manifest_file)
+
+    def file_hash(self, path):
+        """Returns the SHA-1 of a file, reusing the previous hash if its size and mtime did not change"""
+        stat = os.stat(path)
+        path = os.path.abspath(path)
+        entry = self.manifest['files'].get(path)
+        if entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            return entry['sha1']
+        sha1 = helpers.getFileHash(path)
+        self.manifest['files'][path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha1': sha1}
+        return sha1
+
+    def is_up_to_date(self, step, key):
+        entry = self.manifest['steps'].get(step)
+        if entry is None or entry['key'] != normalize(key):
+            return False
+        return all(get_file_stat(os.path.join(self.folder, output)) == stat for output, stat in entry['outputs'].items())
+
+    def record(self, step, key, outputs):
+        """Marks the step as completed with the given key and output files, which should be complete at this point"""
+        self.manifest['steps'][step] = {
+            'key': normalize(key),
+            'outputs': {os.path.relpath(os.path.abspath(output), self.folder): get_file_stat(output) for output in outputs}
+        }
+        self.save()
+
+
+def normalize(key):
+    # the key as it is read back from the json manifest, e.g. with lists instead of tuples
+    return json.loads(json.dumps(key, sort_keys=True))
+
+
+def get_file_stat(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def get_tmp_file(path):
+    # the temporary file keeps the extensions, which determine the output format
+    folder, name = os.path.split(path.rstrip("/\\"))
+    return os.path.join(folder, "%s%d-%s" % (TMP_PREFIX, os.getpid(), name))
+
+
+def replace_file(src, dst):
+    if os.path.isdir(dst):
+        shutil.rmtree(dst)
+    os.replace(src, dst)
+
+
+def remove_file(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
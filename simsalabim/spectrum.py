@@ -1,17 +1,91 @@
+import numpy as np
+
+from .precursor import to_precursor_array, to_precursor_dicts
+
+
+MZ_DTYPE = np.float64
+# float32 would halve the memory, but the text writers print intensities with
+# "%f", which would no longer round-trip the values read from the peak lists
+INTENSITY_DTYPE = np.float64
+
+
 class Spectrum:
-    def __init__(self, scannr, precursors, fragment_ions, raw_file):
-        self.spectrum = dict()
-        self.spectrum["precursor_information"] = precursors
-        self.spectrum["id"] = f"scan={scannr}"
-        self.spectrum["params"] = [{'ms level': 2}]
-        
-        self.spectrum["mz_array"], self.spectrum["intensity_array"] = zip(*fragment_ions)
-        
+    __slots__ = ('scannr', 'precursors', 'mz_array', 'intensity_array', 'raw_file', 'ms_level', 'rtime')
+
+    def __init__(self, scannr, precursors, fragment_ions, raw_file=None, ms_level=2, rtime=None):
+        self.scannr = scannr
+        self.precursors = to_precursor_array(precursors)
+        self.mz_array, self.intensity_array = to_peak_arrays(fragment_ions)
         self.raw_file = raw_file
-    
+        self.ms_level = ms_level
+        self.rtime = rtime # in seconds, not written out to keep the output of the writers unchanged
+
+    @classmethod
+    def from_arrays(cls, scannr, precursors, mz_array, intensity_array, raw_file=None, ms_level=2, rtime=None):
+        spectrum = cls(scannr, precursors, None, raw_file, ms_level, rtime)
+        spectrum.mz_array = np.ascontiguousarray(mz_array, dtype=MZ_DTYPE)
+        spectrum.intensity_array = np.ascontiguousarray(intensity_array, dtype=INTENSITY_DTYPE)
+        return spectrum
+
+    @property
+    def spectrum(self):
+        """Dict view with the keyword arguments of psims' MzMLWriter.write_spectrum"""
+        return {
+            "precursor_information": to_precursor_dicts(self.precursors),
+            "id": f"scan={self.scannr}",
+            "params": [{'ms level': self.ms_level}],
+            "mz_array": self.mz_array,
+            "intensity_array": self.intensity_array,
+        }
+
     def get_ms_level(self):
-        for d in self.spectrum["params"]:
-            for k, v in d.items():
-                if k == "ms level":
-                    return v
-        return -1
+        return self.ms_level
+
+
+def to_peak_arrays(fragment_ions):
+    """Converts an (n, 2) array or an iterable of (m/z, intensity) pairs to contiguous peak arrays"""
+    if fragment_ions is None:
+        return np.empty(0, dtype=MZ_DTYPE), np.empty(0, dtype=INTENSITY_DTYPE)
+
+    if not isinstance(fragment_ions, np.ndarray):
+        fragment_ions = np.array([tuple(peak) for peak in fragment_ions], dtype=np.float64)
+    fragment_ions = fragment_ions.reshape(-1, 2)
+    return (np.ascontiguousarray(fragment_ions[:, 0], dtype=MZ_DTYPE),
+            np.ascontiguousarray(fragment_ions[:, 1], dtype=INTENSITY_DTYPE))
+
+
+def peaks_from_text(peak_block):
+    """Converts a block of "m/z intensity" lines (str, bytes or a memoryview) in a single call"""
+    if isinstance(peak_block, memoryview):
+        # fromstring only parses str and bytes, this is the only copy of the peak block
+        peak_block = peak_block.tobytes()
+    peaks = np.fromstring(peak_block, sep=' ')
+    newline = b"\n" if isinstance(peak_block, bytes) else "\n"
+    num_lines = peak_block.count(newline) + (len(peak_block) > 0 and not peak_block.endswith(newline))
+    if len(peaks) != 2 * num_lines:
+        # extra columns, blank or malformed lines would be mispaired by the reshape
+        return peaks_from_lines(peak_block.splitlines())
+    return peaks.reshape(-1, 2)
+
+
+def peaks_from_lines(peak_lines):
+    """Converts "m/z intensity" lines one by one, ignoring blank lines and any columns after the intensity"""
+    peaks = list()
+    for line in peak_lines:
+        values = line.split()
+        if not values:
+            continue
+        if len(values) < 2:
+            raise ValueError("Peak line without an intensity: %r" % line)
+        peaks.append((float(values[0]), float(values[1])))
+    return np.array(peaks, dtype=np.float64).reshape(-1, 2)
+
+
+def peaks_to_text(mz_array, intensity_array):
+    """Formats all peaks as "m/z intensity" lines with a single string formatting operation"""
+    num_peaks = len(mz_array)
+    if num_peaks == 0:
+        return ""
+    # float32 arrays are widened first, "%f" formats them through float() anyway
+    peaks = np.column_stack((np.asarray(mz_array, dtype=np.float64), np.asarray(intensity_array, dtype=np.float64)))
+    return ("%f %f\n" * num_peaks) % tuple(peaks.ravel().tolist())
@@ -0,0 +1,91 @@
+##############################################################
+## selection of spectra by scan number, retention time,     ##
+## precursor m/z, precursor charge and MS level             ##
+##                                                          ##
+## the filter is checked by the parsers against the header  ##
+## fields of each record, before the peaks are parsed or    ##
+## decoded, and against the sidecar index if one exists     ##
+##############################################################
+
+import numpy as np
+
+
+class SpectrumFilter:
+    __slots__ = ('scannrs', 'minRtime', 'maxRtime', 'minPrecMz', 'maxPrecMz', 'minCharge', 'maxCharge', 'msLevels')
+
+    def __init__(self, scannrs=None, minRtime=None, maxRtime=None, minPrecMz=None, maxPrecMz=None,
+                 minCharge=None, maxCharge=None, msLevels=(2,)):
+        """Ranges are inclusive and None means unbounded, retention times are in seconds"""
+        self.scannrs = None if scannrs is None else frozenset(scannrs)
+        self.minRtime = minRtime
+        self.maxRtime = maxRtime
+        self.minPrecMz = minPrecMz
+        self.maxPrecMz = maxPrecMz
+        self.minCharge = minCharge
+        self.maxCharge = maxCharge
+        self.msLevels = frozenset(msLevels)
+
+    def __getstate__(self):
+        return {key: getattr(self, key) for key in self.__slots__}
+
+    def __setstate__(self, state):
+        for key, value in state.items():
+            setattr(self, key, value)
+
+    def has_rtime_range(self):
+        return self.minRtime is not None or self.maxRtime is not None
+
+    def has_precursor_range(self):
+        return (self.minPrecMz is not None or self.maxPrecMz is not None
+                or self.minCharge is not None or self.maxCharge is not None)
+
+    def accepts(self, scannr, rtime, precursors, ms_level=2):
+        """Checks the header fields of a spectrum, a spectrum passes if any of its precursors is in range"""
+        if ms_level not in self.msLevels:
+            return False
+        if self.scannrs is not None and scannr not in self.scannrs:
+            return False
+        if self.has_rtime_range() and not self.accepts_rtime(rtime):
+            return False
+        if self.has_precursor_range() and ms_level > 1:
+            if isinstance(precursors, np.ndarray):
+                # structured PRECURSOR_DTYPE array, e.g. from a spectrum store
+                return bool(self.precursor_mask(precursors['mz'], precursors['charge']).any())
+            return any(self.accepts_precursor(p.mz, p.charge) for p in precursors)
+        return True
+
+    def accepts_rtime(self, rtime):
+        if rtime is None:
+            return False
+        return (self.minRtime is None or rtime >= self.minRtime) and (self.maxRtime is None or rtime <= self.maxRtime)
+
+    def accepts_precursor(self, mz, charge):
+        return ((self.minPrecMz is None or mz >= self.minPrecMz) and (self.maxPrecMz is None or mz <= self.maxPrecMz)
+                and (self.minCharge is None or charge >= self.minCharge) and (self.maxCharge is None or charge <= self.maxCharge))
+
+    def precursor_mask(self, mz, charge):
+        mask = np.ones(len(mz), dtype=bool)
+        if self.minPrecMz is not None:
+            mask &= mz >= self.minPrecMz
+        if self.maxPrecMz is not None:
+            mask &= mz <= self.maxPrecMz
+        if self.minCharge is not None:
+            mask &= charge >= self.minCharge
+        if self.maxCharge is not None:
+            mask &= charge <= self.maxCharge
+        return mask
+
+    def uses_index(self):
+        """The sidecar index only stores the scan number and retention time fields that are checked here"""
+        return self.scannrs is not None or self.has_rtime_range()
+
+    def index_mask(self, records):
+        """Returns a boolean mask over the rows of a sidecar index, the remaining fields are checked on the headers"""
+        mask = np.ones(len(records['scannr']), dtype=bool)
+        if self.scannrs is not None:
+            mask &= np.isin(records['scannr'], np.fromiter(self.scannrs, dtype=np.int64, count=len(self.scannrs)))
+        if self.minRtime is not None:
+            mask &= records['rtime'] >= self.minRtime
+        if self.maxRtime is not None:
+            mask &= records['rtime'] <= self.maxRtime
+        return mask
@@ -0,0 +1,138 @@
+###########################################################
+## byte offset index for random access into peak lists   ##
+##                                                       ##
+## the index is stored as a .idx.npz sidecar file next   ##
+## to the input file and is rebuilt whenever the size or ##
+## modification time of the input file changes           ##
+###########################################################
+
+import sys
+import os
+import mmap
+
+import numpy as np
+
+from . import block_reader
+from . import helpers
+
+
+INDEX_VERSION = 2
+INDEX_SUFFIX = ".idx.npz"
+
+INDEX_DTYPE = np.dtype([('offset', np.int64), ('length', np.int64), ('scannr', np.int64),
+                        ('precursor_mz', np.float64), ('rtime', np.float64), ('raw_file_idx', np.int32)])
+
+
+class SpectrumIndex:
+    def __init__(self, inputFile, records, raw_files, parseHeader, recordEnd=None):
+        self.inputFile = inputFile
+        self.records = records
+        self.raw_files = raw_files
+        self.parseHeader = parseHeader
+        self.recordEnd = recordEnd
+        self._scan_order = np.argsort(records['scannr'], kind='stable')
+        self._sorted_scannrs = records['scannr'][self._scan_order]
+
+    def __len__(self):
+        return len(self.records)
+
+    def find(self, scannr, raw_file=None):
+        """Returns the row numbers of all records with this scan number, in file order"""
+        l_idx = self._sorted_scannrs.searchsorted(scannr, side='left')
+        r_idx = self._sorted_scannrs.searchsorted(scannr, side='right')
+        rows = self._scan_order[l_idx:r_idx]
+        if raw_file is not None:
+            raw_file_idxs = np.flatnonzero(self.raw_files == raw_file)
+            raw_file_idx = raw_file_idxs[0] if len(raw_file_idxs) > 0 else -2
+            rows = rows[self.records['raw_file_idx'][rows] == raw_file_idx]
+        return rows
+
+    def read_record(self, f, row):
+        f.seek(self.records['offset'][row])
+        return f.read(self.records['length'][row])
+
+    def iter_rows(self, rows, storeFragmentIons=True, spectrumFilter=None):
+        with open(self.inputFile, 'rb') as f:
+            records = (self.read_record(f, row) for row in rows)
+            yield from block_reader.parse_records(records, self.parseHeader, storeFragmentIons, self.recordEnd, spectrumFilter)
+
+    def iter_scans(self, scannrs, raw_file=None, storeFragmentIons=True):
+        """Yields the spectra for the requested scan numbers in the order of scannrs"""
+        rows = [row for scannr in scannrs for row in self.find(scannr, raw_file)]
+        yield from self.iter_rows(rows, storeFragmentIons)
+
+    def iter_filtered(self, spectrumFilter, storeFragmentIons=True):
+        """Yields the spectra that pass spectrumFilter in file order, records rejected by the index are never read"""
+        rows = np.flatnonzero(spectrumFilter.index_mask(self.records))
+        yield from self.iter_rows(rows, storeFragmentIons, spectrumFilter)
+
+
+def get_index_file(inputFile):
+    return inputFile + INDEX_SUFFIX
+
+
+def load_index(inputFile, recordStart, parseHeader, recordEnd=None):
+    """Loads the sidecar index of inputFile, (re)building it if it is missing or outdated"""
+    if helpers.getCompression(inputFile):
+        sys.exit("ERROR: Random access is not supported for compressed files: " + inputFile)
+    
+    index = load_existing_index(inputFile, parseHeader, recordEnd)
+    if index:
+        return index
+
+    index_file = get_index_file(inputFile)
+    stat = os.stat(inputFile)
+    index = build_index(inputFile, recordStart, parseHeader, recordEnd)
+    try:
+        write_index(index, index_file, stat)
+    except OSError:
+        print("WARNING: Could not write index file %s, continuing with in-memory index" % index_file)
+    return index
+
+
+def load_existing_index(inputFile, parseHeader, recordEnd=None):
+    """Returns the sidecar index of inputFile if it exists and is up to date, without building one"""
+    index_file = get_index_file(inputFile)
+    if helpers.getCompression(inputFile) or not os.path.isfile(index_file):
+        return None
+
+    with np.load(index_file) as sidecar:
+        if is_up_to_date(sidecar, os.stat(inputFile), INDEX_VERSION):
+            return SpectrumIndex(inputFile, sidecar['records'], sidecar['raw_files'], parseHeader, recordEnd)
+    return None
+
+
+def is_up_to_date(sidecar, stat, version):
+    """Checks if a sidecar file was created for the current version of its source file"""
+    return ('version' in sidecar and int(sidecar['version']) == version
+            and int(sidecar['source_size']) == stat.st_size
+            and int(sidecar['source_mtime_ns']) == stat.st_mtime_ns)
+
+
+def build_index(inputFile, recordStart, parseHeader, recordEnd=None):
+    """Scans inputFile once, decoding and parsing only the header lines of each record"""
+    records = list()
+    raw_files = dict()
+    if os.path.getsize(inputFile) > 0:
+        with open(inputFile, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+            for start, end in block_reader.iter_record_spans(mm, recordStart):
+                # the peak block is dropped right away, a remaining slice would keep the map from closing
+                headerLines = block_reader.split_record(view[start:end], recordEnd)[0]
+                header = parseHeader(headerLines)
+                if not header:
+                    continue
+                scannr, raw_file, rtime, precursors = header
+                raw_file_idx = -1 if raw_file is None else raw_files.setdefault(raw_file, len(raw_files))
+                precursor_mz = precursors[0].mz if len(precursors) > 0 else np.nan
+                records.append((start, end - start, scannr, precursor_mz, np.nan if rtime is None else rtime, raw_file_idx))
+
+    return SpectrumIndex(inputFile, np.array(records, dtype=INDEX_DTYPE), np.array(list(raw_files.keys()), dtype=str), parseHeader, recordEnd)
+
+
+def write_index(index, index_file, stat):
+    # write to a temporary file first, so that killed jobs do not leave a truncated index behind
+    tmp_file = index_file + ".tmp"
+    with open(tmp_file, 'wb') as f:
+        np.savez(f, version=INDEX_VERSION, records=index.records, raw_files=index.raw_files,
+                 source_size=stat.st_size, source_mtime_ns=stat.st_mtime_ns)
+    os.replace(tmp_file, index_file)
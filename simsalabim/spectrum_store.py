@@ -0,0 +1,266 @@
+##############################################################
+## columnar spectrum container                              ##
+##                                                          ##
+## a <name>.spectra directory with one raw little-endian    ##
+## file per column and a header.json describing them:       ##
+##   spectrum columns: scannr, rtime, raw_file_idx,         ##
+##                     ms_level                             ##
+##   CSR offsets:      peak_offsets, precursor_offsets      ##
+##                     (num_spectra + 1 entries)            ##
+##   peaks:            mz, intensity                        ##
+##   precursors:       mz, charge, intensity records        ##
+##   scan lookup:      scan_lookup, scan_next               ##
+## all columns are opened with np.memmap, so opening a file ##
+## does not read any spectra                                ##
+##############################################################
+
+import os
+import json
+import shutil
+
+import numpy as np
+
+from .spectrum import Spectrum, MZ_DTYPE, INTENSITY_DTYPE
+from .precursor import PRECURSOR_DTYPE
+
+
+STORE_VERSION = 1
+STORE_EXT = ".spectra"
+HEADER_FILE = "header.json"
+
+# number of spectra collected in memory before they are appended to the column files
+CHUNK_SIZE = 10000
+
+COLUMNS = {
+    'scannr': np.dtype('<i8'),
+    'rtime': np.dtype('<f8'),
+    'raw_file_idx': np.dtype('<i4'),
+    'ms_level': np.dtype('<i4'),
+    'peak_offsets': np.dtype('<i8'),
+    'precursor_offsets': np.dtype('<i8'),
+    'mz': np.dtype(MZ_DTYPE).newbyteorder('<'),
+    'intensity': np.dtype(INTENSITY_DTYPE).newbyteorder('<'),
+    'precursors': PRECURSOR_DTYPE.newbyteorder('<'),
+    'scan_lookup': np.dtype('<i8'),
+    'scan_next': np.dtype('<i8'),
+}
+
+
+def is_spectrum_store(path):
+    return path.lower().rstrip("/\\").endswith(STORE_EXT)
+
+
+class SpectrumStoreWriter:
+    """Writes spectra to a .spectra directory, with the same start / write_spectrum / finish interface as the other writers.
+
+    The columns are written to <output_dir>.tmp and moved into place by finish(),
+    so readers never see a partially written store. abort() removes them instead.
+    """
+    def __init__(self, output_dir):
+        self.output_dir = output_dir.rstrip("/\\")
+        self.tmp_dir = self.output_dir + ".tmp"
+        self.files = dict()
+        self.raw_files = dict()
+        self.chunk = list()
+        self.num_spectra = 0
+        self.num_peaks = 0
+        self.num_precursors = 0
+
+    def write(self, spectra):
+        self.start()
+        for i, spectrum in enumerate(spectra):
+            self.write_spectrum(spectrum)
+            if i % 1000 == 0:
+                print("Handled %d spectra" % (i, ))
+        self.finish()
+
+    def start(self):
+        if os.path.isdir(self.tmp_dir):
+            shutil.rmtree(self.tmp_dir)
+        os.makedirs(self.tmp_dir)
+        for column in ['scannr', 'rtime', 'raw_file_idx', 'ms_level', 'peak_offsets', 'precursor_offsets', 'mz', 'intensity', 'precursors']:
+            self.files[column] = open(os.path.join(self.tmp_dir, column + ".bin"), 'wb')
+        self.files['peak_offsets'].write(np.zeros(1, dtype=COLUMNS['peak_offsets']).tobytes())
+        self.files['precursor_offsets'].write(np.zeros(1, dtype=COLUMNS['precursor_offsets']).tobytes())
+
+    def write_spectrum(self, spectrum):
+        self.chunk.append(spectrum)
+        if len(self.chunk) >= CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self.chunk:
+            return
+        spectra, self.chunk = self.chunk, list()
+
+        raw_file_idxs = [-1 if s.raw_file is None else self.raw_files.setdefault(s.raw_file, len(self.raw_files)) for s in spectra]
+        num_peaks = np.array([len(s.mz_array) for s in spectra], dtype=np.int64)
+        num_precursors = np.array([len(s.precursors) for s in spectra], dtype=np.int64)
+        columns = {
+            'scannr': [s.scannr for s in spectra],
+            'rtime': [np.nan if s.rtime is None else s.rtime for s in spectra],
+            'raw_file_idx': raw_file_idxs,
+            'ms_level': [s.ms_level for s in spectra],
+            'peak_offsets': self.num_peaks + np.cumsum(num_peaks),
+            'precursor_offsets': self.num_precursors + np.cumsum(num_precursors),
+        }
+        for column, values in columns.items():
+            self.files[column].write(np.asarray(values, dtype=COLUMNS[column]).tobytes())
+        self.files['mz'].write(np.concatenate([s.mz_array for s in spectra]).astype(COLUMNS['mz'], copy=False).tobytes())
+        self.files['intensity'].write(np.concatenate([s.intensity_array for s in spectra]).astype(COLUMNS['intensity'], copy=False).tobytes())
+        self.files['precursors'].write(np.concatenate([s.precursors for s in spectra]).astype(COLUMNS['precursors'], copy=False).tobytes())
+
+        self.num_spectra += len(spectra)
+        self.num_peaks += int(num_peaks.sum())
+        self.num_precursors += int(num_precursors.sum())
+
+    def finish(self):
+        self.flush()
+        for f in self.files.values():
+            f.close()
+        self.files = dict()
+
+        scannrs = read_column(self.tmp_dir, 'scannr', self.num_spectra)
+        scan_lookup, scan_next = build_scan_lookup(scannrs)
+        scan_lookup.astype(COLUMNS['scan_lookup']).tofile(os.path.join(self.tmp_dir, "scan_lookup.bin"))
+        scan_next.astype(COLUMNS['scan_next']).tofile(os.path.join(self.tmp_dir, "scan_next.bin"))
+        del scannrs
+
+        header = {
+            'version': STORE_VERSION,
+            'num_spectra': self.num_spectra,
+            'num_peaks': self.num_peaks,
+            'num_precursors': self.num_precursors,
+            'num_scan_lookup': len(scan_lookup),
+            'raw_files': sorted(self.raw_files.keys(), key=self.raw_files.get),
+            'columns': {column: dtype.descr if dtype.names else dtype.str for column, dtype in COLUMNS.items()},
+        }
+        with open(os.path.join(self.tmp_dir, HEADER_FILE), 'w') as f:
+            json.dump(header, f, indent=2)
+
+        if os.path.isdir(self.output_dir):
+            shutil.rmtree(self.output_dir)
+        os.replace(self.tmp_dir, self.output_dir)
+
+    def abort(self):
+        """Closes and removes the partially written columns, does nothing after finish()"""
+        for f in self.files.values():
+            f.close()
+        self.files = dict()
+        self.chunk = list()
+        if os.path.isdir(self.tmp_dir):
+            shutil.rmtree(self.tmp_dir)
+
+
+def build_scan_lookup(scannrs):
+    """Returns scan_lookup, with the first row of each scan number, and scan_next, with the next row with the same scan number, or -1"""
+    max_scannr = int(scannrs.max()) if len(scannrs) > 0 else -1
+    if max_scannr > 16 * len(scannrs) + 1024 or (len(scannrs) > 0 and scannrs.min() < 0):
+        # sparse scan numbers, e.g. from split precursors, would make a direct lookup table too large
+        return np.zeros(0, dtype=np.int64), np.full(len(scannrs), -1, dtype=np.int64)
+
+    scan_lookup = np.full(max_scannr + 1, -1, dtype=np.int64)
+    scan_next = np.full(len(scannrs), -1, dtype=np.int64)
+    order = np.argsort(scannrs, kind='stable')
+    sorted_scannrs = scannrs[order]
+    same_scan = sorted_scannrs[1:] == sorted_scannrs[:-1]
+    scan_next[order[:-1][same_scan]] = order[1:][same_scan]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = ~same_scan
+    scan_lookup[sorted_scannrs[first]] = order[first]
+    return scan_lookup, scan_next
+
+
+def read_column(store_dir, column, length):
+    if length == 0:
+        return np.zeros(0, dtype=COLUMNS[column])
+    return np.asarray(np.memmap(os.path.join(store_dir, column + ".bin"), dtype=COLUMNS[column], mode='r', shape=(length,)))
+
+
+class SpectrumStore:
+    """Read access to a .spectra directory, all columns are memory mapped"""
+    def __init__(self, store_dir):
+        self.store_dir = store_dir.rstrip("/\\")
+        header_file = os.path.join(self.store_dir, HEADER_FILE)
+        if not os.path.isfile(header_file):
+            raise FileNotFoundError("Not a spectrum store, missing %s" % header_file)
+        with open(header_file) as f:
+            self.header = json.load(f)
+        if self.header['version'] != STORE_VERSION:
+            raise ValueError("Unsupported spectrum store version %s in %s" % (self.header['version'], self.store_dir))
+
+        num_spectra = self.header['num_spectra']
+        self.raw_files = self.header['raw_files']
+        self.scannr = read_column(self.store_dir, 'scannr', num_spectra)
+        self.rtime = read_column(self.store_dir, 'rtime', num_spectra)
+        self.raw_file_idx = read_column(self.store_dir, 'raw_file_idx', num_spectra)
+        self.ms_level = read_column(self.store_dir, 'ms_level', num_spectra)
+        self.peak_offsets = read_column(self.store_dir, 'peak_offsets', num_spectra + 1)
+        self.precursor_offsets = read_column(self.store_dir, 'precursor_offsets', num_spectra + 1)
+        self.mz = read_column(self.store_dir, 'mz', self.header['num_peaks'])
+        self.intensity = read_column(self.store_dir, 'intensity', self.header['num_peaks'])
+        self.precursors = read_column(self.store_dir, 'precursors', self.header['num_precursors']).astype(PRECURSOR_DTYPE, copy=False)
+        self.scan_lookup = read_column(self.store_dir, 'scan_lookup', self.header['num_scan_lookup'])
+        self.scan_next = read_column(self.store_dir, 'scan_next', num_spectra)
+        self._scan_order = None
+
+    def __len__(self):
+        return len(self.scannr)
+
+    def __iter__(self):
+        return self.iter_rows(range(len(self)))
+
+    def __getitem__(self, row):
+        return self.get_spectrum(row)
+
+    def get_spectrum(self, row, storeFragmentIons=True):
+        start, end = (self.peak_offsets[row], self.peak_offsets[row + 1]) if storeFragmentIons else (0, 0)
+        raw_file_idx = self.raw_file_idx[row]
+        rtime = float(self.rtime[row])
+        return Spectrum.from_arrays(int(self.scannr[row]),
+                                    self.precursors[self.precursor_offsets[row]:self.precursor_offsets[row + 1]],
+                                    self.mz[start:end], self.intensity[start:end],
+                                    raw_file=None if raw_file_idx < 0 else self.raw_files[raw_file_idx],
+                                    ms_level=int(self.ms_level[row]),
+                                    rtime=None if np.isnan(rtime) else rtime)
+
+    def find(self, scannr, raw_file=None):
+        """Returns the row numbers of all spectra with this scan number, in file order"""
+        if len(self.scan_lookup) > 0 or len(self) == 0:
+            rows = list()
+            row = self.scan_lookup[scannr] if 0 <= scannr < len(self.scan_lookup) else -1
+            while row != -1:
+                rows.append(row)
+                row = self.scan_next[row]
+            rows = np.array(rows, dtype=np.int64)
+        else:
+            if self._scan_order is None:
+                self._scan_order = np.argsort(self.scannr, kind='stable')
+            sorted_scannrs = self.scannr[self._scan_order]
+            rows = self._scan_order[sorted_scannrs.searchsorted(scannr, side='left'):sorted_scannrs.searchsorted(scannr, side='right')]
+        if raw_file is not None:
+            raw_file_idx = self.raw_files.index(raw_file) if raw_file in self.raw_files else -2
+            rows = rows[self.raw_file_idx[rows] == raw_file_idx]
+        return rows
+
+    def get_by_scan(self, scannr, raw_file=None):
+        rows = self.find(scannr, raw_file)
+        return self.get_spectrum(rows[0]) if len(rows) > 0 else None
+
+    def iter_rows(self, rows, storeFragmentIons=True, spectrumFilter=None):
+        for row in rows:
+            spectrum = self.get_spectrum(row, storeFragmentIons)
+            if spectrumFilter is None or spectrumFilter.accepts(spectrum.scannr, spectrum.rtime, spectrum.precursors, spectrum.ms_level):
+                yield spectrum
+
+    def iter_spectra(self, storeFragmentIons=True, spectrumFilter=None):
+        """Yields the spectra in file order, without a filter only MS2 spectra are returned, like the other parsers"""
+        if spectrumFilter is None:
+            rows = np.flatnonzero(self.ms_level == 2)
+        else:
+            rows = np.flatnonzero(spectrumFilter.index_mask({'scannr': self.scannr, 'rtime': self.rtime}))
+        yield from self.iter_rows(rows, storeFragmentIons, spectrumFilter)
+
+
+def parse_spectrum_store(inputFile, storeFragmentIons=False, spectrumFilter=None):
+    yield from SpectrumStore(inputFile).iter_spectra(storeFragmentIons, spectrumFilter)
@@ -0,0 +1,149 @@
+import sys
+import os
+import csv
+
+import numpy as np
+
+from .simsalabim import __version__, __copyright__
+
+from .apl_parser import parse_apl_metadata
+from .mgf_parser import parse_mgf_metadata
+from .ms2_parser import parse_ms2_metadata
+from .mzml_parser import parse_mzml_metadata
+
+from . import helpers
+from . import spectrum_index
+
+
+TABLE_VERSION = 1
+TABLE_SUFFIX = ".meta.npz"
+
+COLUMNS = ['scannr', 'raw_file', 'rtime', 'precursor_mz', 'charge', 'intensity', 'num_peaks']
+COLUMN_DTYPES = {
+    'scannr': np.int64,
+    'raw_file': str,
+    'rtime': np.float64,
+    'precursor_mz': np.float64,
+    'charge': np.int32,
+    'intensity': np.float64,
+    'num_peaks': np.int64,
+}
+
+METADATA_PARSERS = {
+    ".apl": parse_apl_metadata,
+    ".mgf": parse_mgf_metadata,
+    ".ms2": parse_ms2_metadata,
+    ".mzml": parse_mzml_metadata,
+}
+
+
+def main(argv):
+    print('simsalabim-spectrum-table version %s\n%s' % (__version__, __copyright__))
+    print('Issued command:', os.path.basename(__file__) + " " + " ".join(map(str, sys.argv[1:])))
+
+    args, params = parseArgs()
+
+    table = load_spectrum_table(args.input_file, useCache=not args.no_cache)
+    write_table(table, args.output_fn)
+
+    print("Done")
+
+
+def parseArgs():
+    import argparse
+    apars = argparse.ArgumentParser(
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    apars.add_argument('input_file', default=None, metavar = "IN_FILE",
+                                         help='''input MS/MS file, either ms2, mgf, apl or mzML format.
+                                                    ''')
+
+    apars.add_argument('--output_fn', default = "spectra.tsv", metavar='OUT',
+                                         help='''output table, either in tab separated (.tsv) or numpy (.npz) format.
+                                                    ''')
+
+    apars.add_argument('--no_cache',
+                                         help='''do not read or write the cached table next to the input file.
+                                                    ''',
+                                         action='store_true')
+
+    # ------------------------------------------------
+    args = apars.parse_args()
+
+    params = dict()
+
+    return args, params
+
+
+def scan_metadata(input_file):
+    """Builds a columnar table with one row per MS2 spectrum, using the first precursor of each spectrum"""
+    input_format = helpers.getExt(helpers.stripCompressionExt(input_file)).lower()
+    if input_format not in METADATA_PARSERS:
+        sys.exit("ERROR: Unknown spectrum file format: " + input_file)
+
+    columns = {column: list() for column in COLUMNS}
+    for scannr, raw_file, rtime, precursors, num_peaks in METADATA_PARSERS[input_format](input_file):
+        p = precursors[0] if len(precursors) > 0 else None
+        columns['scannr'].append(scannr)
+        columns['raw_file'].append(raw_file or "")
+        columns['rtime'].append(np.nan if rtime is None else rtime)
+        columns['precursor_mz'].append(np.nan if p is None else p.mz)
+        columns['charge'].append(0 if p is None else p.charge)
+        columns['intensity'].append(np.nan if p is None or p.intensity is None else p.intensity)
+        columns['num_peaks'].append(num_peaks)
+
+    return {column: np.array(values, dtype=COLUMN_DTYPES[column]) for column, values in columns.items()}
+
+
+def get_table_file(input_file):
+    return input_file + TABLE_SUFFIX
+
+
+def load_spectrum_table(input_file, useCache=True):
+    """Returns the metadata table of input_file, reusing the cached sidecar if it is up to date"""
+    table_file = get_table_file(input_file)
+    stat = os.stat(input_file)
+    if useCache and os.path.isfile(table_file):
+        with np.load(table_file) as sidecar:
+            if spectrum_index.is_up_to_date(sidecar, stat, TABLE_VERSION):
+                return {column: sidecar[column] for column in COLUMNS}
+
+    table = scan_metadata(input_file)
+    if useCache:
+        try:
+            write_table(table, table_file, source_size=stat.st_size, source_mtime_ns=stat.st_mtime_ns, version=TABLE_VERSION)
+        except OSError:
+            print("WARNING: Could not write table file %s" % table_file)
+    return table
+
+
+def write_table(table, output_file, **extra):
+    if output_file.lower().endswith(".npz"):
+        tmp_file = output_file + ".tmp"
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, **table, **extra)
+        os.replace(tmp_file, output_file)
+    else:
+        with helpers.openVersionSafe(output_file, 'w') as f:
+            f.write("\t".join(COLUMNS) + "\n")
+            for row in zip(*[table[column].tolist() for column in COLUMNS]):
+                f.write("\t".join(map(str, row)) + "\n")
+
+
+def read_table(table_file):
+    if table_file.lower().endswith(".npz"):
+        with np.load(table_file) as f:
+            return {column: f[column] for column in COLUMNS}
+
+    with helpers.openVersionSafe(table_file, 'r') as f:
+        rd = csv.reader(f, delimiter='\t')
+        header = next(rd)
+        columns = {column: list() for column in header}
+        for row in rd:
+            for column, value in zip(header, row):
+                columns[column].append(value)
+    return {column: np.array(columns[column], dtype=COLUMN_DTYPES[column]) for column in COLUMNS}
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
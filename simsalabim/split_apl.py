@@ -15,7 +15,7 @@ def main(argv):
     
     args, params = parseArgs()
     
-    split_apl_by_raw_file(args.input_dir, args.output_dir)
+    split_apl_by_raw_file(args.input_dir, args.output_dir, params['workers'], params['compression'], params['maxOpenFiles'], params['bufferSize'])
 
 
 def parseArgs():
@@ -26,35 +26,57 @@ def parseArgs():
     requiredNamed = apars.add_argument_group('required arguments')
     
     apars.add_argument('input_dir', default=None, metavar = "IN",
-                                         help='''directory with files in APL format.
+                                         help='''directory with files in APL format, optionally compressed (.gz, .bz2, .xz or .zst).
                                                     ''')
     
     apars.add_argument('--output_dir', default=None, metavar='OUT', 
                                          help='''output directory.
                                                     ''')
     
+    apars.add_argument('--workers', default = 1, metavar='W', type=int,
+                                         help='''number of processes used to parse each APL file.
+                                                    ''')
+    
+    apars.add_argument('--compression', default = None, metavar='C', choices=helpers.COMPRESSION_SUFFIXES,
+                                         help='''compress the output APL files, e.g. .gz writes <raw_file>.apl.gz files.
+                                                    ''')
+    
+    apars.add_argument('--max_open_files', default = 64, metavar='N', type=int,
+                                         help='''maximum number of output files that are open at the same time.
+                                                    ''')
+    
+    apars.add_argument('--buffer_size', default = 64, metavar='MB', type=int,
+                                         help='''number of megabytes of spectra that are buffered in memory before they 
+                                                         are written to the output files.
+                                                    ''')
+    
     # ------------------------------------------------
     args = apars.parse_args()
     
     params = dict()
+    params['workers'] = args.workers
+    params['compression'] = args.compression
+    params['maxOpenFiles'] = args.max_open_files
+    params['bufferSize'] = args.buffer_size * 1024 * 1024
     
     return args, params
 
 
-def split_apl_by_raw_file(input_dir, output_dir):
+def split_apl_by_raw_file(input_dir, output_dir, workers=1, compression=None, maxOpenFiles=64, bufferSize=64 * 1024 * 1024):
     Path(output_dir).mkdir(parents=True, exist_ok=True)
     
-    spectra = get_all_spectra(input_dir)
+    spectra = get_all_spectra(input_dir, workers)
     
-    writer = AplWriterMultiFile(output_dir)
-    writer.write(spectra)
+    with AplWriterMultiFile(output_dir, compression, maxOpenFiles, bufferSize) as writer:
+        writer.write(spectra)
 
     print("Done")
 
 
-def get_all_spectra(input_dir):
-    for input_file in Path(input_dir).glob('*.apl'):
-        yield from parse_apl(str(input_file), storeFragmentIons=True)
+def get_all_spectra(input_dir, workers=1):
+    for input_file in Path(input_dir).glob('*.apl*'):
+        if helpers.stripCompressionExt(str(input_file)).lower().endswith(".apl"):
+            yield from parse_apl(str(input_file), storeFragmentIons=True, reader="mmap", workers=workers)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,91 @@
+# records and files shared by the tests of the parsers, writers and converters
+
+APL_RECORD = """peaklist start
+header=RawFile: run1 Index: 55569 Precursor: 0 _multi_
+mz=998.992706
+fragmentation=HCD
+charge=2+
+100.5 10.0
+200.25 20.5
+peaklist end
+
+"""
+
+MGF_RECORD = """BEGIN IONS
+TITLE=scan=12
+PEPMASS=500.5 1000.0
+RTINSECONDS=60.0
+CHARGE=2+
+SCANS=12
+100.5 10.0
+200.25 20.5
+END IONS
+"""
+
+MS2_RECORD = """H\tExtractor\tms2_writer.py
+S\t12\t12\t500.500000
+I\tRTime\t1.000000
+Z\t2\t998.992706
+100.5 10.0
+200.25 20.5
+"""
+
+MZML_SPECTRUM = """      <spectrum index="%d" id="%s" defaultArrayLength="1">
+        <referenceableParamGroupRef ref="ms2"/>
+        <scanList count="1">
+          <scan>
+            <cvParam cvRef="MS" accession="MS:1000016" name="scan start time" value="%s" unitCvRef="UO" unitAccession="UO:0000031" unitName="minute"/>
+          </scan>
+        </scanList>
+        <precursorList count="1">
+          <precursor>
+            <isolationWindow>
+              <cvParam cvRef="MS" accession="MS:1000827" name="isolation window target m/z" value="500.5" unitCvRef="MS" unitAccession="MS:1000040" unitName="m/z"/>
+              <cvParam cvRef="MS" accession="MS:1000828" name="isolation window lower offset" value="1.0" unitCvRef="MS" unitAccession="MS:1000040" unitName="m/z"/>
+              <cvParam cvRef="MS" accession="MS:1000829" name="isolation window upper offset" value="1.0" unitCvRef="MS" unitAccession="MS:1000040" unitName="m/z"/>
+            </isolationWindow>
+            <selectedIonList count="1">
+              <selectedIon>
+                <cvParam cvRef="MS" accession="MS:1000744" name="selected ion m/z" value="500.25" unitCvRef="MS" unitAccession="MS:1000040" unitName="m/z"/>
+                <cvParam cvRef="MS" accession="MS:1000041" name="charge state" value="2"/>
+              </selectedIon>
+            </selectedIonList>
+          </precursor>
+        </precursorList>
+        <binaryDataArrayList count="2">
+          <binaryDataArray encodedLength="12">
+            <cvParam cvRef="MS" accession="MS:1000523" name="64-bit float" value=""/>
+            <cvParam cvRef="MS" accession="MS:1000576" name="no compression" value=""/>
+            <cvParam cvRef="MS" accession="MS:1000514" name="m/z array" value="" unitCvRef="MS" unitAccession="MS:1000040" unitName="m/z"/>
+            <binary>AAAAAAAgWUA=</binary>
+          </binaryDataArray>
+          <binaryDataArray encodedLength="12">
+            <cvParam cvRef="MS" accession="MS:1000523" name="64-bit float" value=""/>
+            <cvParam cvRef="MS" accession="MS:1000576" name="no compression" value=""/>
+            <cvParam cvRef="MS" accession="MS:1000515" name="intensity array" value="" unitCvRef="MS" unitAccession="MS:1000131" unitName="number of counts"/>
+            <binary>AAAAAAAAJEA=</binary>
+          </binaryDataArray>
+        </binaryDataArrayList>
+      </spectrum>
+"""
+
+MZML_FILE = """<?xml version="1.0" encoding="utf-8"?>
+<mzML xmlns="http://psi.hupo.org/ms/mzml" version="1.1.0">
+  <cvList count="2">
+    <cv id="MS" fullName="Proteomics Standards Initiative Mass Spectrometry Ontology" URI="https://raw.githubusercontent.com/HUPO-PSI/psi-ms-CV/master/psi-ms.obo"/>
+    <cv id="UO" fullName="Unit Ontology" URI="http://ontologies.berkeleybop.org/uo.obo"/>
+  </cvList>
+  <referenceableParamGroupList count="1">
+    <referenceableParamGroup id="ms2">
+      <cvParam cvRef="MS" accession="MS:1000511" name="ms level" value="2"/>
+      <cvParam cvRef="MS" accession="MS:1000580" name="MSn spectrum" value=""/>
+    </referenceableParamGroup>
+  </referenceableParamGroupList>
+  <run id="run">
+    <spectrumList count="2">
+""" + MZML_SPECTRUM % (0, "scan=12", "1.5") + MZML_SPECTRUM % (1, "scan=13 &quot;a&quot;", "2.5") + """    </spectrumList>
+  </run>
+</mzML>
+"""
+
+DINOSAUR_HEADER = "mz\tmostAbundantMz\tcharge\trtStart\trtApex\trtEnd\tfwhm\tnIsotopes\tnScans\taveragineCorr\tmass\tmassCalib\tintensityApex\tintensitySum\n"
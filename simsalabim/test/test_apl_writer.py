@@ -0,0 +1,40 @@
+import unittest
+import os
+import tempfile
+
+import numpy as np
+
+from .. import apl_parser
+from ..apl_writer import AplWriterMultiFile
+from .fixtures import APL_RECORD
+
+
+class AplWriterMultiFileTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = tempfile.TemporaryDirectory()
+    records = [APL_RECORD.replace("55569", str(i)).replace("run1", "run%d" % (i % 5)) for i in range(40)]
+    self.apl_file = os.path.join(self.tmp_dir.name, "test.apl")
+    with open(self.apl_file, 'w') as f:
+      f.write("".join(records))
+
+  def tearDown(self):
+    self.tmp_dir.cleanup()
+
+  def test_write_handlePool(self):
+    for compression, maxOpenFiles, bufferSize in [(None, 64, 1 << 20), (None, 2, 1), (".gz", 2, 200)]:
+      output_dir = os.path.join(self.tmp_dir.name, "out%d_%d" % (maxOpenFiles, bufferSize))
+      os.makedirs(output_dir)
+      with AplWriterMultiFile(output_dir, compression, maxOpenFiles, bufferSize) as writer:
+        writer.write(apl_parser.parse_apl(self.apl_file, storeFragmentIons = True))
+        self.assertLessEqual(len(writer.open_files), maxOpenFiles)
+      self.assertEqual(len(writer.open_files), 0)
+      for r in range(5):
+        output_file = os.path.join(output_dir, "run%d.apl%s" % (r, compression or ""))
+        spectra = list(apl_parser.parse_apl(output_file, storeFragmentIons = True))
+        self.assertEqual([s.scannr for s in spectra], list(range(r, 40, 5)))
+        self.assertTrue(all(s.raw_file == "run%d" % r for s in spectra))
+        np.testing.assert_array_equal(spectra[0].mz_array, [100.5, 200.25])
+
+
+if __name__ == '__main__':
+  unittest.main()
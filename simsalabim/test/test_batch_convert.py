@@ -0,0 +1,42 @@
+import unittest
+import os
+import tempfile
+
+from .. import ms2_parser
+from .. import batch_convert
+from .fixtures import MGF_RECORD
+
+
+class BatchConvertTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = tempfile.TemporaryDirectory()
+    self.input_dir = os.path.join(self.tmp_dir.name, "in")
+    self.output_dir = os.path.join(self.tmp_dir.name, "out")
+    os.makedirs(self.input_dir)
+    for name in ["a.mgf", "b.mgf"]:
+      with open(os.path.join(self.input_dir, name), 'w') as f:
+        f.write("".join(MGF_RECORD.replace("=12", "=%d" % i) for i in range(1, 4)))
+    with open(os.path.join(self.input_dir, "bad.mgf"), 'w') as f:
+      f.write("BEGIN IONS\nPEPMASS=abc\n100.5 10.0\nEND IONS\n")
+    self.params = {'specPrecMapFile': "", 'splitPrecursors': True, 'jobs': 2}
+
+  def tearDown(self):
+    self.tmp_dir.cleanup()
+
+  def test_batch_convert(self):
+    results = batch_convert.batch_convert([self.input_dir], self.output_dir, [".mgf", ".ms2"], self.params)
+    self.assertEqual(sorted((os.path.basename(r['input_file']), r['status']) for r in results), [("a.mgf", "converted"), ("b.mgf", "converted"), ("bad.mgf", "failed")])
+    self.assertEqual(sorted(os.listdir(self.output_dir)), ["a.mgf", "a.ms2", "b.mgf", "b.ms2"])
+    self.assertEqual([s.scannr for s in ms2_parser.parse_ms2(os.path.join(self.output_dir, "b.ms2"))], [1, 2, 3])
+
+    results = batch_convert.batch_convert([os.path.join(self.input_dir, "*.mgf")], self.output_dir, [".mgf", ".ms2"], self.params)
+    self.assertEqual(sorted((os.path.basename(r['input_file']), r['status']) for r in results), [("a.mgf", "skipped"), ("b.mgf", "skipped"), ("bad.mgf", "failed")])
+
+    inputFile = os.path.join(self.input_dir, "a.mgf")
+    os.utime(inputFile, (os.path.getatime(inputFile), os.path.getmtime(os.path.join(self.output_dir, "a.ms2")) + 10))
+    results = batch_convert.batch_convert([inputFile], self.output_dir, [".mgf", ".ms2"], self.params)
+    self.assertEqual(results[0]['status'], "converted")
+
+
+if __name__ == '__main__':
+  unittest.main()
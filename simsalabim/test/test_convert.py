@@ -0,0 +1,52 @@
+import unittest
+import os
+import tempfile
+
+from .. import apl_parser
+from .. import ms2_parser
+from .. import mzml_parser
+from .. import convert
+from ..spectrum_filter import SpectrumFilter
+from .fixtures import APL_RECORD, MGF_RECORD
+
+
+class ConvertTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = tempfile.TemporaryDirectory()
+    self.mgf_file = os.path.join(self.tmp_dir.name, "test.mgf")
+    with open(self.mgf_file, 'w') as f:
+      f.write("".join(MGF_RECORD.replace("=12", "=%d" % i) for i in range(1, 4)))
+
+  def tearDown(self):
+    self.tmp_dir.cleanup()
+
+  def test_convert_fanOut(self):
+    params = {'specPrecMapFile': "", 'splitPrecursors': True}
+    single = os.path.join(self.tmp_dir.name, "single.mgf")
+    convert.convert(self.mgf_file, single, params)
+    outputs = [os.path.join(self.tmp_dir.name, "multi" + ext) for ext in [".mgf", ".ms2", ".apl.gz", ".mzML"]]
+    convert.convert(self.mgf_file, outputs, params)
+    with open(single) as f, open(outputs[0]) as g:
+      self.assertEqual(f.read(), g.read())
+    self.assertEqual([s.scannr for s in ms2_parser.parse_ms2(outputs[1])], [1, 2, 3])
+    self.assertEqual([s.scannr for s in apl_parser.parse_apl(outputs[2])], [1, 2, 3])
+    self.assertEqual([s.scannr for s in mzml_parser.parse_mzml(outputs[3])], [1, 2, 3])
+
+  def test_convert_aplRtimeFilter(self):
+    aplFile = os.path.join(self.tmp_dir.name, "test.apl")
+    with open(aplFile, 'w') as f:
+      f.write(APL_RECORD)
+    spectrumFilter = SpectrumFilter(minRtime = 10.0)
+    with self.assertRaises(SystemExit):
+      list(apl_parser.parse_apl(aplFile, spectrumFilter = spectrumFilter))
+    outputFile = os.path.join(self.tmp_dir.name, "filtered.mgf")
+    for pipelined in [False, True]:
+      with self.assertRaises(SystemExit):
+        convert.convert(aplFile, outputFile, {'specPrecMapFile': "", 'spectrumFilter': spectrumFilter, 'pipeline': pipelined})
+      self.assertFalse(os.path.exists(outputFile))
+    # the other filters still work on apl input
+    spectra = list(apl_parser.parse_apl(aplFile, spectrumFilter = SpectrumFilter(minCharge = 2)))
+    self.assertEqual(len(spectra), 1)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,164 @@
+import unittest
+import os
+import io
+import sys
+import shlex
+import contextlib
+import tempfile
+from unittest import mock
+
+from .. import dinosaur_adapter
+from ..work_queue import WorkQueue
+from .fixtures import MZML_FILE, DINOSAUR_HEADER
+
+# stands in for Dinosaur: writes a feature table for the mzML file, fails for files named fail*.mzML and
+# crashes with exit code 137 after writing the feature table for files named crash*.mzML
+FAKE_DINOSAUR = """import os, sys
+output_folder, mzml_fn = sys.argv[1:]
+if os.path.basename(mzml_fn).startswith("fail"):
+  sys.exit(1)
+with open(os.path.join(output_folder, os.path.basename(mzml_fn)[:-5] + ".features.tsv"), 'w') as f:
+  f.write(%r)
+  f.write("500.3\\t500.3\\t2\\t1.0\\t1.5\\t2.0\\t0.1\\t3\\t10\\t0.9\\t1000.0\\t1000.0\\t1.0\\t2000.0\\n")
+if os.path.basename(mzml_fn).startswith("crash"):
+  sys.exit(137)
+""" % DINOSAUR_HEADER
+
+
+class DinosaurAdapterTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = tempfile.TemporaryDirectory()
+    self.output_folder = os.path.join(self.tmp_dir.name, "dinosaur")
+    self.mzml_fns = list()
+    for name in ["run1.mzML", "run2.mzML", "fail.mzML"]:
+      self.mzml_fns.append(os.path.join(self.tmp_dir.name, name))
+      with open(self.mzml_fns[-1], 'w') as f:
+        f.write(MZML_FILE)
+    self.fake_dinosaur = os.path.join(self.tmp_dir.name, "fake_dinosaur.py")
+    with open(self.fake_dinosaur, 'w') as f:
+      f.write(FAKE_DINOSAUR)
+    self.params = {'splitPrecursors': False, 'dinosaurMemory': 1.0, 'dinosaurFlags': "", 'mzmlEncoding': None, 'jobs': 2, 'maxMemory': 1.0}
+
+  def tearDown(self):
+    self.tmp_dir.cleanup()
+
+  def fake_dinosaur_cmd(self, dinosaur_jar_path, mzml_fn, output_folder, params):
+    return " ".join(shlex.quote(arg) for arg in [sys.executable, self.fake_dinosaur, output_folder, mzml_fn])
+
+  def test_run_dinosaur_parallel(self):
+    self.assertEqual(dinosaur_adapter.get_num_dinosaur_slots(self.params), 1)
+    with mock.patch.object(dinosaur_adapter, 'get_dinosaur_cmd', self.fake_dinosaur_cmd):
+      results = dinosaur_adapter.run_dinosaur_parallel("dinosaur.jar", self.mzml_fns, self.output_folder, None, self.params)
+    self.assertEqual([r['status'] for r in results], ["done", "done", "failed"])
+    self.assertGreater(results[0]['assignment']['seconds'], 0.0)
+    if hasattr(os, 'wait4'):
+      self.assertGreater(results[0]['assignment']['peak_mb'], 0.0)
+    
+    with open(os.path.join(self.output_folder, "run2.feature_map.tsv")) as f:
+      rows = f.read().splitlines()
+    # the second spectrum at 2.5 minutes elutes after the feature
+    self.assertEqual(rows[1:], ['run2.mzML\tscan=12\t500.300000\t2\t90.000000\t2000.000000'])
+    self.assertFalse(os.path.exists(os.path.join(self.output_folder, "fail.feature_map.tsv")))
+    
+    # finished steps are not repeated
+    results = dinosaur_adapter.run_dinosaur_parallel("dinosaur.jar", self.mzml_fns[:2], self.output_folder, None, self.params)
+    self.assertEqual([(r['dinosaur'], r['assignment']) for r in results], [(None, None), (None, None)])
+    # the partial outputs of the failed run are removed
+    self.assertEqual([f for f in os.listdir(self.output_folder) if f.startswith(".tmp-")], [])
+
+  def test_num_dinosaur_slots(self):
+    # 2 Dinosaur runs of 8 GB and 2 assignments of 2 GB fit into 20 GB, 3 Dinosaur runs do not
+    params = {'jobs': 4, 'dinosaurMemory': 8.0, 'assignmentMemory': 2.0, 'maxMemory': 20.0}
+    self.assertEqual(dinosaur_adapter.get_num_dinosaur_slots(params), 2)
+    params['maxMemory'] = 100.0
+    self.assertEqual(dinosaur_adapter.get_num_dinosaur_slots(params), 4)
+    params['maxMemory'] = 4.0
+    self.assertEqual(dinosaur_adapter.get_num_dinosaur_slots(params), 1)
+
+  def test_main_jobs1(self):
+    # an explicit --jobs 1 reports the wall time and peak memory of the run
+    argv = ["dinosaur_adapter.py", "--dinosaur_jar_path", "dinosaur.jar", "--mzml_fns", self.mzml_fns[0], "--output_folder", self.output_folder, "--jobs", "1"]
+    out = io.StringIO()
+    with mock.patch.object(dinosaur_adapter, 'get_dinosaur_cmd', self.fake_dinosaur_cmd), mock.patch.object(sys, 'argv', argv), contextlib.redirect_stdout(out):
+      dinosaur_adapter.main(argv[1:])
+    self.assertIn("Processed 1 runs", out.getvalue())
+    self.assertTrue(os.path.isfile(os.path.join(self.output_folder, "run1.log")))
+
+  def test_run_dinosaur_parallel_error(self):
+    # an exception in one run does not end the other runs
+    mzml_fns = [self.mzml_fns[0], os.path.join(self.tmp_dir.name, "missing.mzML"), self.mzml_fns[1]]
+    with mock.patch.object(dinosaur_adapter, 'get_dinosaur_cmd', self.fake_dinosaur_cmd), contextlib.redirect_stdout(io.StringIO()):
+      results = dinosaur_adapter.run_dinosaur_parallel("dinosaur.jar", mzml_fns, self.output_folder, None, self.params)
+    self.assertEqual([r['status'] for r in results], ["done", "failed", "done"])
+    self.assertTrue(results[1]['error'].startswith("FileNotFoundError"))
+    self.assertTrue(os.path.isfile(os.path.join(self.output_folder, "run2.feature_map.tsv")))
+    with open(os.path.join(self.output_folder, "missing.log")) as f:
+      self.assertIn("Traceback", f.read())
+
+  def test_serial_matches_parallel(self):
+    outputs = list()
+    for jobs in [1, 2]:
+      output_folder = os.path.join(self.tmp_dir.name, "jobs%d" % jobs)
+      with mock.patch.object(dinosaur_adapter, 'get_dinosaur_cmd', self.fake_dinosaur_cmd), contextlib.redirect_stdout(io.StringIO()):
+        if jobs == 1:
+          dinosaur_adapter.run_dinosaur("dinosaur.jar", self.mzml_fns[:1], output_folder, "mgf", self.params)
+        else:
+          dinosaur_adapter.run_dinosaur_parallel("dinosaur.jar", self.mzml_fns[:1], output_folder, "mgf", self.params)
+      with open(os.path.join(output_folder, "run1.recalibrated.mgf")) as f:
+        outputs.append(f.read())
+    # MGF output always gets one spectrum per precursor
+    self.assertIn("TITLE=scan=1201 originalScan=12", outputs[0])
+    self.assertEqual(outputs[0], outputs[1])
+
+  def test_serial_crash(self):
+    crash_fn = os.path.join(self.tmp_dir.name, "crash.mzML")
+    with open(crash_fn, 'w') as f:
+      f.write(MZML_FILE)
+    with mock.patch.object(dinosaur_adapter, 'get_dinosaur_cmd', self.fake_dinosaur_cmd), contextlib.redirect_stdout(io.StringIO()):
+      with self.assertRaises(SystemExit):
+        dinosaur_adapter.run_dinosaur("dinosaur.jar", [crash_fn], self.output_folder, None, self.params)
+    # the partial feature table is neither moved into place nor recorded
+    self.assertEqual(os.listdir(self.output_folder), [])
+
+  def test_rerun_on_changed_inputs(self):
+    def run():
+      with mock.patch.object(dinosaur_adapter, 'get_dinosaur_cmd', self.fake_dinosaur_cmd):
+        result, = dinosaur_adapter.run_dinosaur_parallel("dinosaur.jar", self.mzml_fns[:1], self.output_folder, None, self.params)
+      return result['dinosaur'] is not None, result['assignment'] is not None
+    
+    self.assertEqual(run(), (True, True))
+    # a newer mtime without a content change only rehashes the file
+    os.utime(self.mzml_fns[0], (0, 0))
+    self.assertEqual(run(), (False, False))
+    
+    # the fake Dinosaur ignores the flags, the assignment is skipped as the features did not change
+    self.params['dinosaurFlags'] = "--minCharge=2"
+    self.assertEqual(run(), (True, False))
+    
+    self.params['splitPrecursors'] = True
+    self.assertEqual(run(), (False, True))
+    
+    with open(os.path.join(self.output_folder, "run1.feature_map.tsv"), 'a') as f:
+      f.write("\n")
+    self.assertEqual(run(), (False, True))
+    
+    with open(self.mzml_fns[0], 'a') as f:
+      f.write("\n")
+    self.assertEqual(run(), (True, True))
+
+  def test_run_dinosaur_distributed(self):
+    self.params['staleTimeout'] = 60.0
+    with mock.patch.object(dinosaur_adapter, 'get_dinosaur_cmd', self.fake_dinosaur_cmd):
+      results = dinosaur_adapter.run_dinosaur_distributed("dinosaur.jar", self.mzml_fns, self.output_folder, None, self.params)
+    self.assertEqual(sorted(r['status'] for r in results), ["done", "done", "failed"])
+    
+    queue = WorkQueue(self.output_folder)
+    status = queue.read_status("run1")
+    self.assertEqual((status['state'], status['result']['status']), ("finished", "done"))
+    self.assertTrue(status['worker'].startswith(queue.worker.rsplit("-", 1)[0]))
+    self.assertEqual(queue.read_status("fail")['result']['status'], "failed")
+    self.assertFalse(os.path.exists(queue.get_lock_file("run1")))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,117 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from .. import helpers
+from ..feature_index import FeatureSweep
+from .fixtures import DINOSAUR_HEADER
+from ..benchmark import get_candidate_precursors
+from ..add_quant_info import get_candidates, load_features, get_feature_reader, iter_chunks, iter_cached_chunks, to_sweep_order, FEATURE_DTYPE, FEATURE_CACHE_SUFFIX
+
+
+class FeatureSweepTest(unittest.TestCase):
+  def setUp(self):
+    rng = np.random.default_rng(1)
+    n = 2000
+    mzs = np.round(rng.uniform(400.0, 410.0, n), 2)
+    rt_lefts = np.round(rng.uniform(0.0, 600.0, n), 1)
+    # a few features span the whole run
+    widths = np.where(np.arange(n) % 100 == 0, 1000.0, np.round(rng.exponential(10.0, n), 1))
+    self.features = [[float(mz), 2, float(l), float(l + w), float(l + w / 2), 1.0] for mz, l, w in zip(mzs, rt_lefts, widths)]
+    self.features.sort(key = lambda x: x[3])
+    self.features.sort(key = lambda x: x[0])
+    self.fmz_all = np.array([f[0] for f in self.features])
+    # queries on feature boundaries test the inclusive m/z and exclusive RT bounds
+    self.queries = [(float(pmz), float(rt)) for pmz, rt in zip(rng.uniform(399.0, 411.0, 300), rng.uniform(-10.0, 700.0, 300))]
+    self.queries += [(f[0] + 0.5, f[2]) for f in self.features[:50]] + [(f[0] - 0.5, f[3] - 0.05) for f in self.features[50:100]]
+
+  def test_empty(self):
+    sweep = FeatureSweep(lambda: iter_chunks(to_sweep_order(np.empty(0, dtype = FEATURE_DTYPE))))
+    self.assertEqual(len(sweep.query(400.0, 401.0, 10.0)), 0)
+
+  def test_sweep(self):
+    swept = to_sweep_order(np.array([tuple(f) for f in self.features], dtype = FEATURE_DTYPE))
+    # small chunks, so that features open across chunk borders
+    sweep = FeatureSweep(lambda: iter_chunks(swept, 64))
+    # queries in RT order, with repeated RTs and a few RTs going back, which restart the sweep
+    queries = sorted(self.queries, key = lambda q: q[1])
+    queries = queries[:100] + queries[100:120] + queries[:50] + queries[100:]
+    for pmz, rt in queries:
+      expected = get_candidate_precursors(self.features, self.fmz_all, pmz, 0.5, 0.5, rt)
+      self.assertEqual([self.features[i] for i in sweep.query(pmz - 0.5, pmz + 0.5, rt)['mz_rank']], expected)
+    self.assertLess(len(sweep.active), len(self.features) // 10)
+
+  def test_query_batch(self):
+    swept = to_sweep_order(np.array([tuple(f) for f in self.features], dtype = FEATURE_DTYPE))
+    sweep = FeatureSweep(lambda: iter_chunks(swept, 64))
+    queries = sorted(self.queries, key = lambda q: q[1])
+    pmzs, rts = np.array([q[0] for q in queries]), np.array([q[1] for q in queries])
+    # batches that end between queries with the same RT
+    offsets, found = sweep.query_batch(pmzs - 0.5, pmzs + 0.5, rts, batchSize = 7)
+    self.assertEqual(len(offsets), len(queries) + 1)
+    for i, (pmz, rt) in enumerate(queries):
+      expected = get_candidate_precursors(self.features, self.fmz_all, pmz, 0.5, 0.5, rt)
+      self.assertEqual([self.features[j] for j in found['mz_rank'][offsets[i]:offsets[i + 1]]], expected)
+    # the sweep continues after the batch
+    pmz, rt = queries[-1]
+    self.assertEqual(sweep.query(pmz - 0.5, pmz + 0.5, rt).tolist(), found[offsets[-2]:].tolist())
+    with self.assertRaises(ValueError):
+      sweep.query_batch([400.0, 400.0], [401.0, 401.0], [20.0, 10.0])
+
+
+class FeatureTableTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.feature_fn = os.path.join(self.tmp_dir, "run.features.tsv")
+    rows = [(500.25, 2, 1.0, 1.5, 2.0, 200.0), (400.5, 3, 0.5, 0.7, 1.0, 100.0), (400.5, 2, 0.2, 0.3, 0.4, 50.0), (600.0, 0, 1.0, 1.1, 1.2, 10.0)]
+    with open(self.feature_fn, 'w') as f:
+      f.write(DINOSAUR_HEADER)
+      for mz, z, rtl, rt, rtr, intensity in rows:
+        f.write("%s\t%s\t%d\t%s\t%s\t%s\t0.1\t3\t10\t0.9\t1000.0\t1000.0\t1.0\t%s\n" % (mz, mz, z, rtl, rt, rtr, intensity))
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def test_loadDinosaur(self):
+    # without the cache the file is not hashed
+    with mock.patch.object(helpers, 'getFileHash', side_effect = AssertionError):
+      features = load_features(self.feature_fn, useCache = False)
+    # sorted by m/z and then by the right RT border, RTs in seconds, charge 0 features removed
+    self.assertEqual(features.tolist(), [(400.5, 2, 12.0, 24.0, 18.0, 50.0), (400.5, 3, 30.0, 60.0, 42.0, 100.0), (500.25, 2, 60.0, 120.0, 90.0, 200.0)])
+    self.assertFalse(os.path.exists(self.feature_fn + FEATURE_CACHE_SUFFIX))
+    
+    index = FeatureSweep(lambda: iter_chunks(to_sweep_order(features)))
+    fmz_all = features['mz']
+    self.assertEqual(get_candidates(index, 400.0, 1.0, 1.0, 40.0), [tuple(f) for f in get_candidate_precursors(features.tolist(), fmz_all, 400.0, 1.0, 1.0, 40.0)])
+
+  def test_cache(self):
+    features = load_features(self.feature_fn)
+    cache_file = self.feature_fn + FEATURE_CACHE_SUFFIX
+    self.assertTrue(os.path.isfile(cache_file))
+    np.testing.assert_array_equal(load_features(self.feature_fn), features)
+    # the cache is read in chunks in the order of the left RT border
+    chunks = list(iter_cached_chunks(cache_file, 2))
+    self.assertEqual([len(chunk) for chunk in chunks], [2, 1])
+    self.assertEqual(np.concatenate(chunks)['rt_left'].tolist(), [12.0, 30.0, 60.0])
+    self.assertEqual([len(chunk) for chunk in get_feature_reader(self.feature_fn)()], [3])
+    
+    # a changed feature table invalidates the cache
+    with open(self.feature_fn, 'w') as f:
+      f.write(DINOSAUR_HEADER)
+    self.assertEqual(len(load_features(self.feature_fn)), 0)
+
+  def test_loadOpenMS(self):
+    feature_fn = os.path.join(self.tmp_dir, "run.csv")
+    with open(feature_fn, 'w') as f:
+      f.write("#FEATURE,rt,mz,intensity,charge,width,quality,rt_quality,mz_quality,rt_start,rt_end\n")
+      f.write("FEATURE,30.0,450.5,1000.0,2,1.0,0.9,0.8,0.7,20.0,40.0\n")
+      f.write("FEATURE,10.0,350.5,500.0,1,1.0,0.9,0.8,0.7,5.0,15.0\n")
+    self.assertEqual(load_features(feature_fn, useCache = False).tolist(), [(350.5, 1, 5.0, 15.0, 10.0, 500.0), (450.5, 2, 20.0, 40.0, 30.0, 1000.0)])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,4 +1,8 @@
 import unittest
+import os
+import io
+import tempfile
+import threading
 from .. import helpers
 
 class HelpersIOTest(unittest.TestCase):
@@ -32,5 +36,61 @@ class HelpersMSTest(unittest.TestCase):
     self.assertAlmostEqual(helpers.precMassFromPrecMz(helpers.precMzFromPrecMass(1000.0, 2), 2), 1000.0, places = 4)
 
 
+
+class HelpersCompressionTest(unittest.TestCase):
+  def test_helpers_stripCompressionExt(self):
+    self.assertEqual(helpers.stripCompressionExt("/tmp/spectra.mgf.gz"), "/tmp/spectra.mgf")
+    self.assertEqual(helpers.stripCompressionExt("/tmp/spectra.mgf"), "/tmp/spectra.mgf")
+
+  def test_helpers_openVersionSafe_compressedRoundTrip(self):
+    content = "".join("%d %f\n" % (i, i / 3.0) for i in range(100000))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      for ext in [".gz", ".bz2", ".xz"]:
+        filename = os.path.join(tmp_dir, "test.txt" + ext)
+        with helpers.openVersionSafe(filename, 'w') as f:
+          f.write(content)
+        with helpers.openVersionSafe(filename, 'r') as f:
+          self.assertEqual(f.read(), content)
+        with helpers.openVersionSafe(filename, 'rb') as f:
+          self.assertEqual(f.readline(), b"0 0.000000\n")
+
+  def test_helpers_threadedReader_error(self):
+    class FailingStream(io.RawIOBase):
+      def __init__(self):
+        self.chunks = [b"12345"]
+      def read(self, size = -1):
+        if self.chunks:
+          return self.chunks.pop()
+        raise EOFError("truncated stream")
+    # reads in a separate thread, so that a read blocking on the chunk queue fails the test instead of hanging it
+    results = list()
+    def run():
+      reader = helpers.ThreadedReader(FailingStream())
+      b = bytearray(10)
+      results.append(bytes(b[:reader.readinto(b)]))
+      for _ in range(2):
+        try:
+          reader.readinto(b)
+        except EOFError as e:
+          results.append(str(e))
+      reader.close()
+    thread = threading.Thread(target = run, daemon = True)
+    thread.start()
+    thread.join(10)
+    self.assertFalse(thread.is_alive())
+    self.assertEqual(results, [b"12345", "truncated stream", "truncated stream"])
+
+  def test_helpers_bufferedTextWriter(self):
+    out = io.StringIO()
+    writer = helpers.BufferedTextWriter(out, bufferSize = 10)
+    writer.write("12345")
+    self.assertEqual(out.getvalue(), "")
+    writer.write("678901")
+    self.assertEqual(out.getvalue(), "12345678901")
+    writer.write("2")
+    writer.flush()
+    self.assertEqual(out.getvalue(), "123456789012")
+
+
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,37 @@
+import unittest
+import os
+import tempfile
+
+import numpy as np
+
+from .. import convert
+from ..mzml_encoding import MzMLEncoding
+from .fixtures import MGF_RECORD
+
+
+class MzMLEncodingTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = tempfile.TemporaryDirectory()
+    self.mgf_file = os.path.join(self.tmp_dir.name, "test.mgf")
+    with open(self.mgf_file, 'w') as f:
+      f.write("".join(MGF_RECORD.replace("=12", "=%d" % i) for i in range(1, 4)))
+
+  def tearDown(self):
+    self.tmp_dir.cleanup()
+
+  def test_convert_mzmlEncoding(self):
+    from pyteomics import mzml
+    for mzmlWriter in ["psims", "fast"]:
+      params = {'specPrecMapFile': "", 'splitPrecursors': True, 'mzmlWriter': mzmlWriter, 'mzmlEncoding': MzMLEncoding(32, 64, "none", "zlib")}
+      outputFile = os.path.join(self.tmp_dir.name, mzmlWriter + ".mzML")
+      convert.convert(self.mgf_file, outputFile, params)
+      with open(outputFile) as f:
+        content = f.read()
+      self.assertEqual(content.count('name="no compression"'), 3)
+      spectra = list(mzml.MzML(outputFile))
+      self.assertEqual(spectra[0]['m/z array'].dtype, np.float32)
+      self.assertEqual(spectra[0]['intensity array'].dtype, np.float64)
+      np.testing.assert_array_equal(spectra[0]['m/z array'], [100.5, 200.25])
+
+if __name__ == '__main__':
+  unittest.main()
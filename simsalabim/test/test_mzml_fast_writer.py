@@ -0,0 +1,104 @@
+import unittest
+import os
+import tempfile
+import io
+import re
+import gzip
+import hashlib
+
+import numpy as np
+
+from .. import convert
+from .. import add_quant_info
+from ..spectrum import Spectrum
+from ..precursor import Precursor
+from ..spectrum_filter import SpectrumFilter
+from ..mzml_fast_writer import FastMzMLWriter
+from .fixtures import MGF_RECORD, MZML_FILE, DINOSAUR_HEADER
+
+
+class FastMzMLWriterTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = tempfile.TemporaryDirectory()
+    self.mgf_file = os.path.join(self.tmp_dir.name, "test.mgf")
+    with open(self.mgf_file, 'w') as f:
+      f.write("".join(MGF_RECORD.replace("=12", "=%d" % i) for i in range(1, 4)))
+
+  def tearDown(self):
+    self.tmp_dir.cleanup()
+
+  def test_convert_fastMzmlWriter(self):
+    from pyteomics import mzml
+    params = {'specPrecMapFile': "", 'splitPrecursors': True}
+    psimsFile, fastFile = [os.path.join(self.tmp_dir.name, name) for name in ["psims.mzML", "fast.mzML"]]
+    convert.convert(self.mgf_file, psimsFile, params)
+    params['mzmlWriter'] = "fast"
+    convert.convert(self.mgf_file, fastFile, params)
+
+    expected, spectra = list(mzml.MzML(psimsFile)), list(mzml.MzML(fastFile))
+    self.assertEqual(len(expected), len(spectra))
+    for e, s in zip(expected, spectra):
+      for key in ['id', 'index', 'ms level', 'precursorList', 'MSn spectrum', 'centroid spectrum']:
+        self.assertEqual(e[key], s[key])
+      np.testing.assert_array_equal(e['m/z array'], s['m/z array'])
+      np.testing.assert_array_equal(e['intensity array'], s['intensity array'])
+
+    reader = mzml.PreIndexedMzML(fastFile)
+    self.assertEqual(reader.get_by_id("scan=2")['index'], 1)
+    with open(fastFile, 'rb') as f:
+      content = f.read()
+    self.assertIn(b'<spectrumList count="3"', content)
+    end = content.index(b'<fileChecksum>') + len(b'<fileChecksum>')
+    self.assertEqual(content[end:end + 40].decode(), hashlib.sha1(content[:end]).hexdigest())
+
+  def assertIndexed(self, content, numSpectra):
+    self.assertIn(b'<spectrumList count="%d"' % numSpectra, content)
+    offsets = [int(o) for o in re.findall(rb'<offset idRef=(?:"[^"]*"|\'[^\']*\')>(\d+)</offset>', content)]
+    self.assertEqual(len(offsets), numSpectra)
+    for offset in offsets:
+      self.assertEqual(content[offset:offset + 9], b'<spectrum')
+    indexListOffset = int(re.search(rb'<indexListOffset>(\d+)</indexListOffset>', content).group(1))
+    self.assertEqual(content[indexListOffset:indexListOffset + 10], b'<indexList')
+    end = content.index(b'<fileChecksum>') + len(b'<fileChecksum>')
+    self.assertEqual(content[end:end + 40].decode(), hashlib.sha1(content[:end]).hexdigest())
+
+  def test_offsets(self):
+    out = io.BytesIO()
+    spectra = [Spectrum(i, [Precursor(0.0, 500.5, 2, None)], [(100.0, 10.0)]) for i in range(1, 4)]
+    FastMzMLWriter(out).write(spectra)
+    self.assertIndexed(out.getvalue(), 3)
+
+  def test_convert_compressedOutput(self):
+    # the count comes from a pass over the input, the output cannot be patched afterwards
+    params = {'specPrecMapFile': "", 'splitPrecursors': True, 'mzmlWriter': "fast", 'spectrumFilter': SpectrumFilter(scannrs = [1, 3])}
+    for pipelined in [False, True]:
+      outputFile = os.path.join(self.tmp_dir.name, "fast%d.mzML.gz" % pipelined)
+      convert.convert(self.mgf_file, outputFile, dict(params, pipeline = pipelined))
+      with gzip.open(outputFile) as f:
+        self.assertIndexed(f.read(), 2)
+
+  def test_count_mismatch(self):
+    with self.assertRaises(ValueError):
+      FastMzMLWriter(io.BytesIO()).start()
+    writer = FastMzMLWriter(io.BytesIO(), numSpectra = 2)
+    writer.start()
+    writer.write_spectrum(Spectrum(1, [Precursor(0.0, 500.5, 2, None)], [(100.0, 10.0)]))
+    with self.assertRaises(ValueError):
+      writer.finish()
+
+  def test_add_accurate_precursors_splitPrecursors(self):
+    mzmlFile, featureFile, outputFile = [os.path.join(self.tmp_dir.name, name) for name in ["test.mzML", "test.features.tsv", "assigned.mzML"]]
+    with open(mzmlFile, 'w') as f:
+      f.write(MZML_FILE)
+    with open(featureFile, 'w') as f:
+      f.write(DINOSAUR_HEADER)
+      for mz in [500.3, 500.7]:
+        f.write("%s\t%s\t2\t1.0\t2.0\t3.0\t0.1\t3\t10\t0.9\t1000.0\t1000.0\t1.0\t2000.0\n" % (mz, mz))
+    # each spectrum is split into one spectrum per assigned feature
+    params = {'specPrecMapFile': "", 'splitPrecursors': True, 'mzmlWriter': "fast", 'featureCache': False}
+    add_quant_info.add_accurate_precursors(featureFile, mzmlFile, outputFile, params)
+    with open(outputFile, 'rb') as f:
+      self.assertIndexed(f.read(), 4)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,233 @@
+import unittest
+import os
+import tempfile
+import gzip
+
+import numpy as np
+
+from .. import apl_parser
+from .. import mgf_parser
+from .. import ms2_parser
+from .. import spectrum_index
+from .. import block_reader
+from .. import parallel_parser
+from .. import spectrum_table
+from .. import mzml_parser
+from .. import mzml_headers
+from .. import convert
+from ..spectrum_filter import SpectrumFilter
+from .fixtures import APL_RECORD, MGF_RECORD, MS2_RECORD, MZML_FILE
+
+
+class ParsersTest(unittest.TestCase):
+  def assertPeaks(self, spectrum):
+    np.testing.assert_array_equal(spectrum.mz_array, [100.5, 200.25])
+    np.testing.assert_array_equal(spectrum.intensity_array, [10.0, 20.5])
+
+  def test_parse_apl_lines(self):
+    spectra = list(apl_parser.parse_apl_lines(APL_RECORD.splitlines(True) * 2, storeFragmentIons = True))
+    self.assertEqual(len(spectra), 2)
+    self.assertEqual(spectra[0].scannr, 55569)
+    self.assertEqual(spectra[0].raw_file, "run1")
+    self.assertAlmostEqual(spectra[0].precursors['mz'][0], 500.0, places = 4)
+    self.assertPeaks(spectra[0])
+
+  def test_parse_apl_lines_noFragmentIons(self):
+    spectra = list(apl_parser.parse_apl_lines(APL_RECORD.splitlines(True)))
+    self.assertEqual(len(spectra), 1)
+    self.assertEqual(len(spectra[0].mz_array), 0)
+
+  def test_parse_mgf_lines(self):
+    spectra = list(mgf_parser.parse_mgf_lines(MGF_RECORD.splitlines(True), storeFragmentIons = True))
+    self.assertEqual(len(spectra), 1)
+    self.assertEqual(spectra[0].scannr, 12)
+    self.assertEqual(spectra[0].rtime, 60.0)
+    self.assertEqual(spectra[0].spectrum["precursor_information"], [{'mz': 500.5, 'charge': 2, 'intensity': 1000.0}])
+    self.assertPeaks(spectra[0])
+
+  def test_parse_ms2_lines(self):
+    spectra = list(ms2_parser.parse_ms2_lines(MS2_RECORD.splitlines(True), storeFragmentIons = True))
+    self.assertEqual(len(spectra), 1)
+    self.assertEqual(spectra[0].scannr, 12)
+    self.assertEqual(spectra[0].rtime, 60.0)
+    self.assertAlmostEqual(spectra[0].precursors['mz'][0], 500.0, places = 4)
+    self.assertPeaks(spectra[0])
+
+
+class SpectrumIndexTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = tempfile.TemporaryDirectory()
+    self.apl_file = os.path.join(self.tmp_dir.name, "test.apl")
+    with open(self.apl_file, 'w') as f:
+      f.write(APL_RECORD.replace("55569", "1") + APL_RECORD.replace("55569", "2").replace("run1", "run2") + APL_RECORD.replace("55569", "3"))
+
+  def tearDown(self):
+    self.tmp_dir.cleanup()
+
+  def test_get_by_scan(self):
+    spectrum = apl_parser.get_by_scan(self.apl_file, 2)
+    self.assertEqual(spectrum.scannr, 2)
+    self.assertEqual(spectrum.raw_file, "run2")
+    np.testing.assert_array_equal(spectrum.mz_array, [100.5, 200.25])
+    self.assertTrue(os.path.isfile(spectrum_index.get_index_file(self.apl_file)))
+
+  def test_get_by_scan_rawFile(self):
+    self.assertIsNone(apl_parser.get_by_scan(self.apl_file, 2, raw_file = "run1"))
+    self.assertIsNone(apl_parser.get_by_scan(self.apl_file, 4))
+
+  def test_iter_scans_requestedOrder(self):
+    self.assertEqual([s.scannr for s in apl_parser.iter_scans(self.apl_file, [3, 1])], [3, 1])
+
+  def test_load_index_invalidated(self):
+    self.assertEqual(len(apl_parser.load_apl_index(self.apl_file)), 3)
+    with open(self.apl_file, 'a') as f:
+      f.write(APL_RECORD.replace("55569", "4"))
+    self.assertEqual(len(apl_parser.load_apl_index(self.apl_file)), 4)
+    self.assertEqual(apl_parser.get_by_scan(self.apl_file, 4).scannr, 4)
+
+
+class BlockReaderTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = tempfile.TemporaryDirectory()
+
+  def tearDown(self):
+    self.tmp_dir.cleanup()
+
+  def writeFile(self, fileName, content):
+    inputFile = os.path.join(self.tmp_dir.name, fileName)
+    with open(inputFile, 'w') as f:
+      f.write(content)
+    return inputFile
+
+  def assertSameSpectra(self, parser, inputFile):
+    expected = list(parser(inputFile, storeFragmentIons = True, reader = "lines"))
+    for reader in ["mmap", "blocks"]:
+      spectra = list(parser(inputFile, storeFragmentIons = True, reader = reader))
+      self.assertEqual(len(spectra), len(expected))
+      for spectrum, expectedSpectrum in zip(spectra, expected):
+        self.assertEqual(spectrum.scannr, expectedSpectrum.scannr)
+        self.assertEqual(spectrum.raw_file, expectedSpectrum.raw_file)
+        self.assertEqual(spectrum.rtime, expectedSpectrum.rtime)
+        self.assertEqual(spectrum.spectrum["precursor_information"], expectedSpectrum.spectrum["precursor_information"])
+        np.testing.assert_array_equal(spectrum.mz_array, expectedSpectrum.mz_array)
+        np.testing.assert_array_equal(spectrum.intensity_array, expectedSpectrum.intensity_array)
+
+  def test_readers_apl(self):
+    self.assertSameSpectra(apl_parser.parse_apl, self.writeFile("test.apl", APL_RECORD * 3))
+
+  def test_readers_mgf(self):
+    self.assertSameSpectra(mgf_parser.parse_mgf, self.writeFile("test.mgf", "MASS=Monoisotopic\n" + MGF_RECORD * 3))
+
+  def test_readers_ms2(self):
+    self.assertSameSpectra(ms2_parser.parse_ms2, self.writeFile("test.ms2", MS2_RECORD + MS2_RECORD.split("\n", 1)[1] * 2))
+
+  def test_split_record(self):
+    data = (APL_RECORD + "trailer\n").encode()
+    headerLines, peakBlock = block_reader.split_record(memoryview(data), apl_parser.APL_RECORD_END)
+    # the peak block is a view into the record, not a copy
+    self.assertIs(peakBlock.obj, data)
+    self.assertEqual(bytes(peakBlock), b"100.5 10.0\n200.25 20.5\n")
+    self.assertEqual(headerLines[-3:], ["peaklist end\n", "\n", "trailer\n"])
+    self.assertEqual(block_reader.count_lines(peakBlock), 2)
+    self.assertEqual(block_reader.count_lines(peakBlock[:0]), 0)
+
+  def test_iter_records_from_stream_smallBlocks(self):
+    inputFile = self.writeFile("test.apl", "".join("junk %d\n" % i + APL_RECORD for i in range(3)))
+    with open(inputFile, 'rb') as f:
+      records = [bytes(r) for r in block_reader.iter_records_from_stream(f, apl_parser.APL_RECORD_START, blockSize = 16)]
+    self.assertEqual(len(records), 3)
+    self.assertTrue(all(r.startswith(b"peaklist start") and b"peaklist end" in r for r in records))
+
+  def test_parse_parallel_fileOrder(self):
+    inputFile = self.writeFile("test.apl", "".join(APL_RECORD.replace("55569", str(i)) for i in range(20)))
+    spectra = parallel_parser.parse_parallel(inputFile, apl_parser.APL_RECORD_START, apl_parser.parse_apl_header, True, apl_parser.APL_RECORD_END, workers = 2, chunkSize = 500)
+    self.assertEqual([s.scannr for s in spectra], list(range(20)))
+
+  def test_parse_mzml_parallel(self):
+    mgfFile = self.writeFile("test.mgf", "".join(MGF_RECORD.replace("=12", "=%d" % i) for i in range(1, 21)))
+    inputFile = os.path.join(self.tmp_dir.name, "test.mzML")
+    convert.convert(mgfFile, inputFile, {'specPrecMapFile': "", 'splitPrecursors': False})
+    expected = list(mzml_parser.parse_mzml(inputFile, storeFragmentIons = True))
+    spectra = list(mzml_parser.parse_mzml(inputFile, storeFragmentIons = True, workers = 2))
+    self.assertEqual([s.scannr for s in spectra], list(range(1, 21)))
+    for spectrum, expectedSpectrum in zip(spectra, expected):
+      self.assertEqual(spectrum.spectrum["precursor_information"], expectedSpectrum.spectrum["precursor_information"])
+      np.testing.assert_array_equal(spectrum.mz_array, expectedSpectrum.mz_array)
+
+  def test_mzml_headers(self):
+    inputFile = self.writeFile("test.mzML", MZML_FILE)
+    expected = list(mzml_parser.open_mzml(inputFile, decodeBinary = False).iterfind("spectrum"))
+    for blockSize in [mzml_headers.BLOCK_SIZE, 100]:
+      if blockSize == 100:
+        with open(inputFile, 'rb') as f, open(inputFile + ".gz", 'wb') as out:
+          out.write(gzip.compress(f.read()))
+        inputFile += ".gz"
+      spectra = list(mzml_headers.iter_spectrum_headers(inputFile, blockSize))
+      self.assertEqual(len(spectra), 2)
+      for spectrum, expectedSpectrum in zip(spectra, expected):
+        # pyteomics adds the attributes of the binary arrays to the spectrum
+        for key in ["m/z array", "intensity array", "count", "encodedLength"]:
+          expectedSpectrum.pop(key, None)
+        self.assertEqual(spectrum, expectedSpectrum)
+    self.assertEqual(spectra[1]["id"], 'scan=13 "a"')
+    self.assertEqual(spectra[1]["ms level"], 2)
+    self.assertEqual(spectra[0]["scanList"]["scan"][0]["scan start time"].unit_info, "minute")
+
+  def test_parse_metadata(self):
+    inputFile = self.writeFile("test.mgf", MGF_RECORD + MGF_RECORD.replace("200.25 20.5\n", ""))
+    rows = list(mgf_parser.parse_mgf_metadata(inputFile))
+    self.assertEqual([row[-1] for row in rows], [2, 1])
+    self.assertEqual(rows[0][:3], (12, None, 60.0))
+
+  def test_spectrum_table_roundTrip(self):
+    inputFile = self.writeFile("test.apl", APL_RECORD * 2)
+    table = spectrum_table.load_spectrum_table(inputFile)
+    self.assertTrue(os.path.isfile(spectrum_table.get_table_file(inputFile)))
+    for ext in [".tsv", ".npz"]:
+      tableFile = os.path.join(self.tmp_dir.name, "table" + ext)
+      spectrum_table.write_table(table, tableFile)
+      reloaded = spectrum_table.read_table(tableFile)
+      np.testing.assert_array_equal(reloaded['scannr'], [55569, 55569])
+      np.testing.assert_array_equal(reloaded['raw_file'], ["run1", "run1"])
+      np.testing.assert_array_equal(reloaded['num_peaks'], [2, 2])
+      np.testing.assert_array_almost_equal(reloaded['precursor_mz'], table['precursor_mz'])
+
+
+class SpectrumFilterTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = tempfile.TemporaryDirectory()
+    self.mgf_file = os.path.join(self.tmp_dir.name, "test.mgf")
+    with open(self.mgf_file, 'w') as f:
+      for i in range(1, 11):
+        f.write(MGF_RECORD.replace("=12", "=%d" % i).replace("60.0", "%.1f" % (i * 10.0)).replace("CHARGE=2", "CHARGE=%d" % (i % 3 + 1)))
+
+  def tearDown(self):
+    self.tmp_dir.cleanup()
+
+  def test_accepts(self):
+    spectrumFilter = SpectrumFilter(minRtime = 20.0, maxPrecMz = 600.0, minCharge = 2)
+    precursors = mgf_parser.parse_mgf_header(MGF_RECORD.splitlines(True))[3]
+    self.assertTrue(spectrumFilter.accepts(12, 60.0, precursors))
+    self.assertFalse(spectrumFilter.accepts(12, 10.0, precursors))
+    self.assertFalse(spectrumFilter.accepts(12, None, precursors))
+    self.assertFalse(spectrumFilter.accepts(12, 60.0, precursors, ms_level = 1))
+    self.assertFalse(SpectrumFilter(maxCharge = 1).accepts(12, 60.0, precursors))
+
+  def test_readers(self):
+    spectrumFilter = SpectrumFilter(scannrs = [2, 3, 5, 6, 8], minRtime = 30.0, minCharge = 2, maxCharge = 3)
+    for reader in block_reader.READERS:
+      spectra = list(mgf_parser.parse_mgf(self.mgf_file, storeFragmentIons = True, reader = reader, spectrumFilter = spectrumFilter))
+      self.assertEqual([s.scannr for s in spectra], [5, 8])
+      self.assertEqual(len(spectra[0].mz_array), 2)
+
+  def test_index(self):
+    spectrumFilter = SpectrumFilter(minRtime = 30.0, maxRtime = 60.0)
+    mgf_parser.load_mgf_index(self.mgf_file)
+    index = spectrum_index.load_existing_index(self.mgf_file, mgf_parser.parse_mgf_header, mgf_parser.MGF_RECORD_END)
+    self.assertEqual(np.flatnonzero(spectrumFilter.index_mask(index.records)).tolist(), [2, 3, 4, 5])
+    spectra = list(mgf_parser.parse_mgf(self.mgf_file, spectrumFilter = spectrumFilter))
+    self.assertEqual([s.scannr for s in spectra], [3, 4, 5, 6])
+
+
+if __name__ == '__main__':
+  unittest.main()
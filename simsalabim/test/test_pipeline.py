@@ -0,0 +1,77 @@
+import unittest
+import os
+import io
+import tempfile
+import threading
+import contextlib
+from unittest import mock
+
+from .. import convert
+from .. import pipeline
+from .fixtures import MGF_RECORD
+
+
+class PipelineTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = tempfile.TemporaryDirectory()
+    self.mgf_file = os.path.join(self.tmp_dir.name, "test.mgf")
+    with open(self.mgf_file, 'w') as f:
+      f.write("".join(MGF_RECORD.replace("=12", "=%d" % i) for i in range(1, 4)))
+
+  def tearDown(self):
+    self.tmp_dir.cleanup()
+
+  def test_convert_pipeline(self):
+    params = {'specPrecMapFile': "", 'splitPrecursors': True}
+    serial = [os.path.join(self.tmp_dir.name, "serial" + ext) for ext in [".mgf", ".apl"]]
+    convert.convert(self.mgf_file, serial, params)
+    params.update({'pipeline': True, 'workers': 2, 'batchSize': 1})
+    pipelined = [os.path.join(self.tmp_dir.name, "pipelined" + ext) for ext in [".mgf", ".apl"]]
+    convert.convert(self.mgf_file, pipelined, params)
+    for serialFile, pipelinedFile in zip(serial, pipelined):
+      with open(serialFile) as f, open(pipelinedFile) as g:
+        self.assertEqual(f.read(), g.read())
+
+  def runPipeline(self, inputFile, params, outputFile=None):
+    # runs the conversion in a separate thread, so that a hanging pipeline fails the test instead of blocking it
+    outputFile = outputFile or os.path.join(self.tmp_dir.name, "pipelined.mgf")
+    errors = list()
+    threads = set(threading.enumerate())
+    def run():
+      try:
+        with contextlib.redirect_stdout(io.StringIO()):
+          convert.convert(inputFile, outputFile, params)
+      except Exception as e:
+        errors.append(e)
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(60)
+    self.assertFalse(thread.is_alive())
+    # the reader and writer threads inherit the daemon flag, check that none of them was left blocking on its queue
+    self.assertEqual(set(threading.enumerate()), threads)
+    return errors
+
+  def test_convert_pipeline_parseError(self):
+    badFile = os.path.join(self.tmp_dir.name, "bad.mgf")
+    with open(badFile, 'w') as f:
+      f.write("".join(MGF_RECORD.replace("=12", "=%d" % i).replace("PEPMASS=", "PEPMASS=abc" if i == 5 else "PEPMASS=") for i in range(1, 51)))
+    params = {'specPrecMapFile': "", 'splitPrecursors': True, 'pipeline': True, 'workers': 2, 'batchSize': 1}
+    outputFiles = [os.path.join(self.tmp_dir.name, "pipelined" + ext) for ext in [".mgf", ".spectra"]]
+    errors = self.runPipeline(badFile, params, outputFiles)
+    self.assertEqual([type(e) for e in errors], [ValueError])
+    # the partially written spectrum store is removed
+    self.assertFalse(os.path.exists(outputFiles[1]))
+    self.assertFalse(os.path.exists(outputFiles[1] + ".tmp"))
+
+  def test_convert_pipeline_submitError(self):
+    from concurrent.futures import ThreadPoolExecutor
+    class FailingExecutor(ThreadPoolExecutor):
+      def submit(self, *args, **kwargs):
+        raise RuntimeError("worker pool broke")
+    params = {'specPrecMapFile': "", 'splitPrecursors': True, 'pipeline': True, 'workers': 1, 'batchSize': 1}
+    with mock.patch.object(pipeline, 'ProcessPoolExecutor', FailingExecutor):
+      errors = self.runPipeline(self.mgf_file, params)
+    self.assertEqual([str(e) for e in errors], ["worker pool broke"])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,55 @@
+import unittest
+
+import numpy as np
+
+from ..spectrum import Spectrum, peaks_from_text, peaks_to_text
+from ..precursor import Precursor
+
+class SpectrumTest(unittest.TestCase):
+  def test_spectrum_fragmentIons_pairs(self):
+    spectrum = Spectrum(12, [{'mz': 500.5, 'charge': 2, 'intensity': None}], [(100.0, 10.0), (200.0, 20.0)])
+    np.testing.assert_array_equal(spectrum.mz_array, [100.0, 200.0])
+    np.testing.assert_array_equal(spectrum.intensity_array, [10.0, 20.0])
+    self.assertTrue(spectrum.mz_array.flags['C_CONTIGUOUS'])
+
+  def test_spectrum_fragmentIons_none(self):
+    spectrum = Spectrum(12, [], None)
+    self.assertEqual(len(spectrum.mz_array), 0)
+    self.assertEqual(len(spectrum.intensity_array), 0)
+
+  def test_spectrum_dictView(self):
+    spectrum = Spectrum(12, [Precursor(0.0, 500.5, 2, None), Precursor(0.0, 600.5, 3, 1000.0)], [(100.0, 10.0)], raw_file="run1")
+    d = spectrum.spectrum
+    self.assertEqual(d["id"], "scan=12")
+    self.assertEqual(d["params"], [{'ms level': 2}])
+    self.assertEqual(d["precursor_information"], [{'mz': 500.5, 'charge': 2, 'intensity': None}, {'mz': 600.5, 'charge': 3, 'intensity': 1000.0}])
+
+  def test_spectrum_slots(self):
+    spectrum = Spectrum(12, [], None)
+    self.assertFalse(hasattr(spectrum, '__dict__'))
+    self.assertEqual(spectrum.ms_level, 2)
+    self.assertEqual(spectrum.get_ms_level(), 2)
+
+  def test_peaks_to_text(self):
+    mzs, intensities = [100.123456789, 200.0], np.array([1e6 / 3, 0.5], dtype=np.float32)
+    expected = "".join("%f %f\n" % (a, b) for a, b in zip(mzs, intensities))
+    self.assertEqual(peaks_to_text(mzs, intensities), expected)
+    self.assertEqual(peaks_to_text([], []), "")
+
+  def test_peaks_from_text(self):
+    expected = [[100.5, 10.0], [200.25, 20.0]]
+    for block in ["100.5 10\n200.25 20\n", b"100.5 10\n200.25 20", memoryview(b"100.5\t10\n200.25 20\n")]:
+      np.testing.assert_array_equal(peaks_from_text(block), expected)
+    self.assertEqual(peaks_from_text("").shape, (0, 2))
+
+  def test_peaks_from_text_extraColumns(self):
+    # an even number of values in total, which a plain reshape would mispair
+    block = "100.5 10 1\n200.25 20 2\n\n300.125 30\n400.0 40 1 0.5\n"
+    np.testing.assert_array_equal(peaks_from_text(block), [[100.5, 10.0], [200.25, 20.0], [300.125, 30.0], [400.0, 40.0]])
+    np.testing.assert_array_equal(peaks_from_text(block.encode()), [[100.5, 10.0], [200.25, 20.0], [300.125, 30.0], [400.0, 40.0]])
+    with self.assertRaises(ValueError):
+      peaks_from_text("100.5 10\n200.25\n300.125 30\n")
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+import os
+import tempfile
+
+import numpy as np
+
+from .. import apl_parser
+from .. import convert
+from .. import spectrum_store
+from ..spectrum_filter import SpectrumFilter
+from .fixtures import APL_RECORD
+
+
+class SpectrumStoreTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = tempfile.TemporaryDirectory()
+    # scan numbers repeat across raw files
+    records = [APL_RECORD.replace("55569", str(i % 10)).replace("run1", "run%d" % (i // 10)) for i in range(30)]
+    self.apl_file = os.path.join(self.tmp_dir.name, "test.apl")
+    with open(self.apl_file, 'w') as f:
+      f.write("".join(records))
+    self.store_dir = os.path.join(self.tmp_dir.name, "test.spectra")
+
+  def tearDown(self):
+    self.tmp_dir.cleanup()
+
+  def test_convert_roundTrip(self):
+    params = {'specPrecMapFile': "", 'splitPrecursors': True}
+    expectedFile, outputFile = [os.path.join(self.tmp_dir.name, name) for name in ["expected.mgf", "output.mgf"]]
+    convert.convert(self.apl_file, [self.store_dir, expectedFile], params)
+    convert.convert(self.store_dir, outputFile, params)
+    with open(expectedFile) as f, open(outputFile) as g:
+      self.assertEqual(f.read(), g.read())
+
+  def test_convert_parseError(self):
+    badFile = os.path.join(self.tmp_dir.name, "bad.apl")
+    with open(self.apl_file) as f, open(badFile, 'w') as g:
+      g.write(f.read() + APL_RECORD.replace("mz=", "mz=abc"))
+    with self.assertRaises(ValueError):
+      convert.convert(badFile, self.store_dir, {'specPrecMapFile': "", 'splitPrecursors': True})
+    self.assertFalse(os.path.exists(self.store_dir))
+    self.assertFalse(os.path.exists(self.store_dir + ".tmp"))
+
+  def test_find(self):
+    spectrum_store.SpectrumStoreWriter(self.store_dir).write(apl_parser.parse_apl(self.apl_file, storeFragmentIons = True))
+    store = spectrum_store.SpectrumStore(self.store_dir)
+    self.assertEqual(len(store), 30)
+    self.assertGreater(len(store.scan_lookup), 0)
+    self.assertEqual(list(store.find(3)), [3, 13, 23])
+    spectrum = store.get_by_scan(3, raw_file = "run2")
+    self.assertEqual((spectrum.scannr, spectrum.raw_file), (3, "run2"))
+    np.testing.assert_array_equal(spectrum.mz_array, [100.5, 200.25])
+    self.assertIsNone(store.get_by_scan(10))
+    self.assertEqual([s.scannr for s in spectrum_store.parse_spectrum_store(self.store_dir, spectrumFilter = SpectrumFilter(scannrs = [2, 4]))], [2, 4] * 3)
+
+  def test_precursorFilter(self):
+    spectra = list(apl_parser.parse_apl(self.apl_file, storeFragmentIons = True))
+    for i, s in enumerate(spectra):
+      s.precursors['mz'][0] = 500.0 + i
+      s.precursors['charge'][0] = 2 + i % 2
+    spectrum_store.SpectrumStoreWriter(self.store_dir).write(spectra)
+    spectrumFilter = SpectrumFilter(minPrecMz = 510.0, maxPrecMz = 520.0, minCharge = 3)
+    filtered = list(spectrum_store.parse_spectrum_store(self.store_dir, spectrumFilter = spectrumFilter))
+    self.assertEqual([s.precursors['mz'][0] for s in filtered], [511.0, 513.0, 515.0, 517.0, 519.0])
+
+  def test_find_sparseScannrs(self):
+    spectra = [s for s in apl_parser.parse_apl(self.apl_file, storeFragmentIons = True)]
+    for s in spectra:
+      s.scannr = s.scannr * 10**9
+    spectrum_store.SpectrumStoreWriter(self.store_dir).write(spectra)
+    store = spectrum_store.SpectrumStore(self.store_dir)
+    self.assertEqual(len(store.scan_lookup), 0)
+    self.assertEqual(list(store.find(3 * 10**9)), [3, 13, 23])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,49 @@
+import unittest
+import os
+import io
+import copy
+import tempfile
+
+from .. import convert
+from ..transform import MzMLTransformerMultiOut, PrecursorOverlay
+from .fixtures import MGF_RECORD
+
+
+class PrecursorOverlayTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = tempfile.TemporaryDirectory()
+    mgfFile = os.path.join(self.tmp_dir.name, "test.mgf")
+    with open(mgfFile, 'w') as f:
+      f.write(MGF_RECORD)
+    self.mzmlFile = os.path.join(self.tmp_dir.name, "test.mzML")
+    convert.convert(mgfFile, self.mzmlFile, {'specPrecMapFile': "", 'splitPrecursors': False})
+    self.transformer = MzMLTransformerMultiOut(self.mzmlFile, io.BytesIO())
+    self.spectrum = next(iter(self.transformer.iterspectrum()))
+
+  def tearDown(self):
+    self.transformer.reader.close()
+    self.tmp_dir.cleanup()
+
+  def test_format(self):
+    # reference: a modified copy of the spectrum
+    spectrum_copy = copy.deepcopy(self.spectrum)
+    spectrum_copy["id"] = "scan=1201 originalScan=12"
+    ion = spectrum_copy["precursorList"]["precursor"][0]["selectedIonList"]["selectedIon"][0]
+    ion["selected ion m/z"], ion["peak intensity"], ion["charge state"] = 501.25, 50.0, 3
+    expected = self.transformer.format_spectrum(spectrum_copy)
+
+    overlay = PrecursorOverlay(self.spectrum, "scan=1201 originalScan=12", [(0, 501.25, 3, 50.0), (0, 400.0, 2, 10.0)])
+    self.assertEqual(overlay["ms level"], 2)
+    formatted = overlay.format(self.transformer.format_spectrum(self.spectrum))
+    self.assertEqual(formatted["id"], expected["id"])
+    self.assertEqual(len(formatted["precursor_information"]), 2)
+    for key in ["mz", "charge", "intensity", "scan_id"]:
+      self.assertEqual(formatted["precursor_information"][0][key], expected["precursor_information"][0][key])
+    self.assertEqual(formatted["precursor_information"][1]["mz"], 400.0)
+    self.assertEqual(formatted["params"], expected["params"])
+    # the input spectrum is shared, not modified
+    self.assertEqual(self.spectrum["id"], "scan=12")
+
+
+if __name__ == '__main__':
+  unittest.main()
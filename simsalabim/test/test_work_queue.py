@@ -0,0 +1,139 @@
+import unittest
+import os
+import io
+import time
+import tempfile
+import threading
+import contextlib
+import multiprocessing
+from unittest import mock
+
+from ..work_queue import WorkQueue, create_exclusive, read_file
+
+NAMES = ["run%d" % i for i in range(12)]
+
+
+def process(folder, name):
+  # fails if the run was already processed by another worker
+  with open(os.path.join(folder, name + ".out"), 'x') as f:
+    f.write(str(os.getpid()))
+  time.sleep(0.05)
+  return name
+
+def run_worker(folder, barrier):
+  queue = WorkQueue(folder, staleTimeout=5.0, pollInterval=0.05)
+  barrier.wait()
+  queue.run(NAMES, lambda name: process(folder, name), jobs=2)
+
+
+class WorkQueueTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = tempfile.TemporaryDirectory()
+    self.folder = self.tmp_dir.name
+
+  def tearDown(self):
+    self.tmp_dir.cleanup()
+
+  def test_workers(self):
+    barrier = multiprocessing.Barrier(3)
+    workers = [multiprocessing.Process(target=run_worker, args=(self.folder, barrier)) for _ in range(3)]
+    for worker in workers:
+      worker.start()
+    for worker in workers:
+      worker.join(60)
+      self.assertEqual(worker.exitcode, 0)
+
+    queue = WorkQueue(self.folder)
+    for name in NAMES:
+      status = queue.read_status(name)
+      self.assertEqual(status['state'], "finished")
+      self.assertEqual(status['result'], name)
+      self.assertTrue(os.path.isfile(os.path.join(self.folder, name + ".out")))
+    self.assertEqual(sorted(f for f in os.listdir(self.folder) if f.endswith(".lock")), [])
+
+  def test_stale_claim(self):
+    queue = WorkQueue(self.folder, staleTimeout=0.5, pollInterval=0.05)
+    # a dead worker's lock that is already stale, and one that goes stale while waiting for it
+    for name in NAMES[:2]:
+      create_exclusive(queue.get_lock_file(name), "dead worker")
+    os.utime(queue.get_lock_file(NAMES[0]), (time.time() - 10, time.time() - 10))
+
+    start = time.time()
+    self.assertEqual(queue.next_run(NAMES[:2]), NAMES[0])
+    results = queue.run(NAMES[1:2], lambda name: process(self.folder, name))
+    self.assertEqual(results, NAMES[1:2])
+    self.assertGreater(time.time() - start, 0.5)
+
+  def test_live_claim(self):
+    owner = WorkQueue(self.folder, staleTimeout=0.5)
+    self.assertTrue(owner.claim(NAMES[0]))
+    other = WorkQueue(self.folder, staleTimeout=0.5)
+    self.assertFalse(other.claim(NAMES[0]))
+
+    # a lock renewed after the staleness check is put back
+    os.utime(owner.get_lock_file(NAMES[0]), (time.time() - 10, time.time() - 10))
+    self.assertTrue(other.is_stale(other.get_lock_file(NAMES[0])))
+    os.utime(owner.get_lock_file(NAMES[0]), None)
+    self.assertFalse(other.break_lock(other.get_lock_file(NAMES[0])))
+    self.assertEqual(read_file(owner.get_lock_file(NAMES[0])), owner.held[NAMES[0]])
+
+    owner.release(NAMES[0])
+    self.assertTrue(other.claim(NAMES[0]))
+
+  def test_release_during_heartbeat(self):
+    queue = WorkQueue(self.folder, staleTimeout=0.01)
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=queue.heartbeat, args=(stop,))
+    heartbeat.start()
+    try:
+      for _ in range(200):
+        with queue.mutex:
+          for name in NAMES[:2]:
+            self.assertTrue(queue.claim(name))
+        queue.release(NAMES[0])
+        queue.release(NAMES[1])
+      # the heartbeat keeps refreshing the claims that are held
+      self.assertTrue(heartbeat.is_alive())
+      with queue.mutex:
+        self.assertTrue(queue.claim(NAMES[2]))
+      lock_file = queue.get_lock_file(NAMES[2])
+      os.utime(lock_file, (0, 0))
+      time.sleep(0.05)
+      self.assertGreater(os.stat(lock_file).st_mtime, 0)
+    finally:
+      stop.set()
+      heartbeat.join()
+    self.assertEqual(queue.lost, set())
+
+  def test_heartbeat_after_failed_touch(self):
+    queue = WorkQueue(self.folder, staleTimeout=0.1)
+    with queue.mutex:
+      self.assertTrue(queue.claim(NAMES[0]))
+    lock_file = queue.get_lock_file(NAMES[0])
+    utime = os.utime
+    calls = list()
+    def fail_once(path, times):
+      calls.append(path)
+      if len(calls) == 1:
+        # as if the lock was removed right after the token check
+        raise FileNotFoundError(path)
+      utime(path, times)
+
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=queue.heartbeat, args=(stop,))
+    with mock.patch.object(os, 'utime', fail_once), contextlib.redirect_stdout(io.StringIO()):
+      heartbeat.start()
+      try:
+        while not calls:
+          time.sleep(0.01)
+        utime(lock_file, (0, 0))
+        time.sleep(0.1)
+        self.assertTrue(heartbeat.is_alive())
+        self.assertGreater(os.stat(lock_file).st_mtime, 0)
+      finally:
+        stop.set()
+        heartbeat.join()
+
+
+if __name__ == '__main__':
+  unittest.main()
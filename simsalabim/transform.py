@@ -1,51 +1,143 @@
-from psims.transform.mzml import MzMLTransformer
+import contextlib
+
+from psims.transform.mzml import MzMLTransformer, MzMLWriter
 
 from .mgf_writer import MgfWriter
 from .ms2_writer import Ms2Writer
+from .mzml_fast_writer import FastMzMLWriter, read_mzml_metadata
+from . import helpers
+
+
+class PrecursorOverlay:
+  """An output spectrum that shares all data with an input spectrum, except for its id and its
+  precursors. It is only turned into writer arguments when it is written, so the input spectrum
+  is neither copied nor modified.
+  """
+  __slots__ = ['spectrum', 'id', 'precursors']
+  
+  def __init__(self, spectrum, id, precursors):
+    self.spectrum = spectrum
+    self.id = id
+    # (index of the input precursor, selected ion m/z, charge, intensity) tuples
+    self.precursors = precursors
+  
+  def __getitem__(self, key):
+    if key == "id":
+      return self.id
+    return self.spectrum[key]
+  
+  def format(self, formatted):
+    """Applies the overlay to the writer arguments of the input spectrum"""
+    formatted = dict(formatted)
+    formatted['id'] = self.id
+    precursors = formatted['precursor_information']
+    formatted['precursor_information'] = [replace_selected_ion(precursors[precIdx], mz, charge, intensity) for precIdx, mz, charge, intensity in self.precursors]
+    return formatted
+
+
+def replace_selected_ion(precursor, mz, charge, intensity):
+  # only the values that are present in the input precursor are replaced
+  precursor = dict(precursor)
+  if 'mz' in precursor:
+    precursor['mz'] = mz
+  if precursor['intensity'] is not None:
+    precursor['intensity'] = intensity
+  if precursor['charge'] is not None:
+    precursor['charge'] = charge
+  return precursor
 
 
 class MzMLTransformerMultiOut(MzMLTransformer):
+  def __init__(self, input_stream, output_stream, transform=None, transform_description=None, sort_by_scan_time=False, workers=1, mzml_writer="psims", array_encoding=None, num_spectra=None):
+    super(MzMLTransformerMultiOut, self).__init__(input_stream, output_stream, transform=transform, transform_description=transform_description, sort_by_scan_time=sort_by_scan_time)
+    self.workers = workers
+    self.mzml_writer = mzml_writer
+    # MzMLEncoding that overrides the precision and compression of the input's binary arrays
+    self.array_encoding = array_encoding
+    # number of spectra written to mzML output, by default one per input spectrum
+    self.num_spectra = num_spectra
+  
+  def iterspectrum(self):
+    # the offset index of an uncompressed mzML file lets a process pool parse and decode the spectra
+    if self.workers > 1 and not self.sort_by_scan_time and isinstance(self.input_stream, str) and not helpers.getCompression(self.input_stream):
+      from .mzml_parallel import iter_spectra_parallel
+      return iter_spectra_parallel(self.input_stream, self.workers)
+    return super(MzMLTransformerMultiOut, self).iterspectrum()
+  
   def write(self):
     '''Write out the the transformed mzML file
     '''
-    writer = self.writer
-    with writer:
-      writer.controlled_vocabularies()
-      self.copy_metadata()
-      with writer.run(id="transformation_run"):
-        with writer.spectrum_list(len(self.reader._offset_index)):
-          self.reader.reset()
-          for i, spectrum in enumerate(self.iterspectrum()):
-            spectra = self.transform(spectrum)
-            for spectrum in spectra:
-              self.writer.write_spectrum(**self.format_spectrum(spectrum))
-            if i % 1000 == 0:
-              self.log("Handled %d spectra" % (i, ))
+    self.write_multi([(".mzML", self.output_stream)])
   
   def transform_only(self):
-    for i, spectrum in enumerate(self.iterspectrum()):
-      spectra = self.transform(spectrum)
-      if i % 1000 == 0:
-        self.log("Handled %d spectra" % (i, ))
-        
+    self.write_multi([])
+  
   def write_ms2(self):
-    writer = Ms2Writer(self.output_stream)
-    writer.write_ms2_headers()
-    for i, spectrum in enumerate(self.iterspectrum()):
-      spectra = self.transform(spectrum)
-      for spectrum in spectra:
-        if spectrum['ms level'] == 2:
-          writer.write_ms2_spectrum(**self.format_spectrum(spectrum))
-      if i % 1000 == 0:
-        self.log("Handled %d spectra" % (i, ))
+    self.write_multi([(".ms2", self.output_stream)])
   
   def write_mgf(self):
-    writer = MgfWriter(self.output_stream)
-    for i, spectrum in enumerate(self.iterspectrum()):
-      spectra = self.transform(spectrum)
-      for spectrum in spectra:
-        if spectrum['ms level'] == 2:
-          writer.write_mgf_spectrum(**self.format_spectrum(spectrum))
-      if i % 1000 == 0:
-        self.log("Handled %d spectra" % (i, ))
-
+    self.write_multi([(".mgf", self.output_stream)])
+  
+  def write_multi(self, outputs):
+    '''Write the transformed spectra to several outputs in a single pass, 
+    outputs is a list of (format, stream) tuples with format .mzML, .ms2 or .mgf
+    '''
+    with contextlib.ExitStack() as stack:
+      # (write function, only MS2 spectra)
+      writers = list()
+      for output_format, output_stream in outputs:
+        output_format = output_format.lower()
+        if output_format == ".mzml":
+          writers.append((self.start_mzml(output_stream, stack), False))
+        elif output_format == ".ms2":
+          writer = Ms2Writer(output_stream)
+          writer.start()
+          stack.callback(writer.finish)
+          writers.append((writer.write_ms2_spectrum, True))
+        elif output_format == ".mgf":
+          writer = MgfWriter(output_stream)
+          writer.start()
+          stack.callback(writer.finish)
+          writers.append((writer.write_mgf_spectrum, True))
+      
+      for i, spectrum in enumerate(self.iterspectrum()):
+        spectra = self.transform(spectrum)
+        if writers:
+          base, baseFormatted = None, None
+          for spectrum in spectra:
+            isMs2 = spectrum['ms level'] == 2
+            # format_spectrum pops the arrays from the spectrum, so it is only called once
+            if isinstance(spectrum, PrecursorOverlay):
+              if spectrum.spectrum is not base:
+                base, baseFormatted = spectrum.spectrum, self.format_spectrum(spectrum.spectrum)
+              formatted = spectrum.format(baseFormatted)
+            else:
+              formatted = self.format_spectrum(spectrum)
+            for write_spectrum, ms2Only in writers:
+              if isMs2 or not ms2Only:
+                write_spectrum(**formatted)
+        if i % 1000 == 0:
+          self.log("Handled %d spectra" % (i, ))
+  
+  def start_mzml(self, output_stream, stack):
+    if self.mzml_writer == "fast":
+      # the file level metadata of the input is copied verbatim
+      metadata = read_mzml_metadata(self.input_stream) if isinstance(self.input_stream, str) else None
+      num_spectra = self.num_spectra if self.num_spectra is not None else len(self.reader._offset_index)
+      writer = FastMzMLWriter(output_stream, metadata=metadata, numSpectra=num_spectra, array_encoding=self.array_encoding)
+      writer.start()
+      stack.callback(writer.finish)
+      return writer.write_spectrum
+    
+    if output_stream is not self.output_stream:
+      self.writer = MzMLWriter(output_stream)
+    writer = self.writer
+    stack.enter_context(writer)
+    writer.controlled_vocabularies()
+    self.copy_metadata()
+    stack.enter_context(writer.run(id="transformation_run"))
+    stack.enter_context(writer.spectrum_list(len(self.reader._offset_index)))
+    self.reader.reset()
+    if self.array_encoding is not None:
+      return lambda **kwargs: writer.write_spectrum(**self.array_encoding.apply(kwargs))
+    return writer.write_spectrum
@@ -0,0 +1,214 @@
+#################################################################
+## coordinator-free work queue on a shared (e.g. NFS) folder   ##
+##                                                             ##
+## workers that process the same list of runs claim a run by   ##
+## creating <run>.lock with O_EXCL, which only one of them can ##
+## do. The owner touches its locks every heartbeat interval,   ##
+## a lock that was not touched for staleTimeout seconds        ##
+## belongs to a dead worker and is broken by the next worker   ##
+## that wants the run. <run>.status.json records who processed ##
+## the run, when, and with which result                        ##
+##                                                             ##
+## staleness is judged on lock mtimes, so the clocks of the    ##
+## machines have to be synchronized (e.g. with NTP) to well    ##
+## below staleTimeout                                          ##
+#################################################################
+
+import os
+import json
+import time
+import uuid
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .result_cache import get_tmp_file
+
+
+LOCK_EXT = ".lock"
+STATUS_EXT = ".status.json"
+
+STALE_TIMEOUT = 300.0
+
+
+class WorkQueue:
+    def __init__(self, folder, staleTimeout=STALE_TIMEOUT, pollInterval=None):
+        self.folder = folder
+        self.staleTimeout = staleTimeout
+        self.heartbeatInterval = staleTimeout / 10
+        self.pollInterval = pollInterval if pollInterval is not None else min(10.0, staleTimeout / 10)
+        # pids are not unique across machines or containers
+        self.worker = "%s-%d-%s" % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:6])
+        # runs finished before this worker started are processed again, their inputs may have changed since
+        self.started = time.time()
+
+        # run name => token of the locks held by this worker
+        self.held = dict()
+        self.lost = set()
+        self.mutex = threading.Lock()
+
+    def run(self, names, func, jobs=1):
+        """Calls func(name) for the runs that no other worker processes, in up to jobs threads.
+        Returns the results of func for the runs processed by this worker."""
+        pending = list(names)
+        results = list()
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=self.heartbeat, args=(stop,), daemon=True)
+        heartbeat.start()
+        try:
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                for future in [executor.submit(self.work, pending, func, results) for _ in range(jobs)]:
+                    future.result()
+        finally:
+            stop.set()
+            heartbeat.join()
+        return results
+
+    def work(self, pending, func, results):
+        while True:
+            name = self.next_run(pending)
+            if name is None:
+                if not pending:
+                    return
+                # the remaining runs are processed by other workers, wait until they finish or their locks go stale
+                time.sleep(self.pollInterval)
+                continue
+
+            status = {'state': "running", 'worker': self.worker, 'started': time.time()}
+            self.write_status(name, status)
+            try:
+                result = func(name)
+                status.update({'state': "finished", 'result': result})
+                results.append(result)
+            except Exception as e:
+                status.update({'state': "error", 'error': "%s: %s" % (type(e).__name__, e)})
+            status['finished'] = time.time()
+            status['lostClaim'] = name in self.lost
+            self.write_status(name, status)
+            self.release(name)
+
+    def next_run(self, pending):
+        """Claims the next pending run and returns its name, or None if all of them are claimed by other workers"""
+        with self.mutex:
+            for name in list(pending):
+                if self.is_finished(name):
+                    pending.remove(name)
+                elif self.claim(name):
+                    pending.remove(name)
+                    # the previous owner writes the final status before it releases the lock
+                    if self.is_finished(name, checkLock=False):
+                        self.release(name, hasMutex=True)
+                        continue
+                    return name
+        return None
+
+    def get_lock_file(self, name):
+        return os.path.join(self.folder, name + LOCK_EXT)
+
+    def get_status_file(self, name):
+        return os.path.join(self.folder, name + STATUS_EXT)
+
+    def claim(self, name):
+        lock_file = self.get_lock_file(name)
+        token = "%s %s" % (self.worker, uuid.uuid4().hex)
+        if not create_exclusive(lock_file, token):
+            if not self.is_stale(lock_file) or not self.break_lock(lock_file):
+                return False
+            if not create_exclusive(lock_file, token):
+                return False
+        self.held[name] = token
+        return True
+
+    def is_stale(self, lock_file):
+        try:
+            return time.time() - os.stat(lock_file).st_mtime > self.staleTimeout
+        except FileNotFoundError:
+            return True
+
+    def break_lock(self, lock_file):
+        """Moves a stale lock out of the way, returns False if it was renewed or replaced in the meantime"""
+        stale_token = read_file(lock_file)
+        broken_file = "%s.broken-%s" % (lock_file, uuid.uuid4().hex)
+        try:
+            os.rename(lock_file, broken_file)
+        except FileNotFoundError:
+            return True
+        try:
+            if read_file(broken_file) == stale_token and self.is_stale(broken_file):
+                return True
+            # the lock was renewed or broken and claimed by another worker since it was checked, put it back
+            try:
+                os.link(broken_file, lock_file)
+            except OSError:
+                pass
+            return False
+        finally:
+            os.remove(broken_file)
+
+    def heartbeat(self, stop):
+        while not stop.wait(self.heartbeatInterval):
+            # under the mutex, so release cannot remove a lock between the token check and the touch
+            with self.mutex:
+                for name, token in self.held.items():
+                    try:
+                        self.touch(name, token)
+                    except OSError as e:
+                        # e.g. a network hiccup, the next heartbeat tries again
+                        print("WARNING: %s could not refresh its claim on %s: %s" % (self.worker, name, e))
+
+    def touch(self, name, token):
+        lock_file = self.get_lock_file(name)
+        if read_file(lock_file) == token:
+            os.utime(lock_file, None)
+        elif name not in self.lost:
+            # only happens if this worker did not heartbeat for staleTimeout seconds, e.g. after a suspend
+            print("WARNING: %s lost its claim on %s to another worker" % (self.worker, name))
+            self.lost.add(name)
+
+    def release(self, name, hasMutex=False):
+        if not hasMutex:
+            with self.mutex:
+                return self.release(name, hasMutex=True)
+        token = self.held.pop(name)
+        lock_file = self.get_lock_file(name)
+        if read_file(lock_file) == token:
+            os.remove(lock_file)
+
+    def read_status(self, name):
+        try:
+            with open(self.get_status_file(name)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def write_status(self, name, status):
+        status_file = self.get_status_file(name)
+        tmp_file = get_tmp_file(status_file)
+        with open(tmp_file, 'w') as f:
+            json.dump(status, f, indent=2)
+        os.replace(tmp_file, status_file)
+
+    def is_finished(self, name, checkLock=True):
+        """True if another worker finished the run after this worker started and no longer holds its lock"""
+        status = self.read_status(name)
+        if status is None or status['state'] == "running" or status['finished'] < self.started:
+            return False
+        return not checkLock or not os.path.exists(self.get_lock_file(name))
+
+
+def create_exclusive(path, content):
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, 'w') as f:
+        f.write(content)
+    return True
+
+
+def read_file(path):
+    try:
+        with open(path) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None